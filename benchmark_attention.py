@@ -0,0 +1,98 @@
+"""
+Batched Attention_Sep against the former one-SDPA-call-per-branch loop, across batch sizes.
+
+    python benchmark_attention.py --batch-sizes 1 4 16 64
+
+The loop reference rebuilds the per-branch computation from the batched module's own weights,
+so the max abs diff column checks numerical equivalence as well.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from model import multi_cnn_attn_conformer_share as share
+from model import multi_cnn_attn_conformer_split as split
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Attention_Sep benchmark', add_help=False)
+    parser.add_argument('--variant', default=['share', 'split'], nargs='+', choices=['share', 'split'])
+    parser.add_argument('--batch-sizes', default=[1, 4, 16], nargs='+', type=int)
+    parser.add_argument('--embed-dim', default=384, type=int)
+    parser.add_argument('--num-heads', default=6, type=int)
+    parser.add_argument('--tokens-per-branch', default=196, type=int)
+    parser.add_argument('--num-branch', default=4, type=int)
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    return parser
+
+
+def share_loop(attn, x):
+    B, N, C = x.shape
+    spb = (N - 1) // attn.num_branch
+    qkv = attn.qkv(x).reshape(B, N, 3, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+    cls = F.scaled_dot_product_attention(q[:, :, 0:1, :], k, v, scale=attn.scale).reshape(B, 1, C) + x[:, 0:1, :]
+    qkv_cls = attn.qkv(cls).reshape(B, 1, 3, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4)
+    q_cls, k_cls, v_cls = qkv_cls[0], qkv_cls[1], qkv_cls[2]
+    xs = []
+    for i in range(attn.num_branch):
+        s = slice(1 + i * spb, 1 + (i + 1) * spb)
+        xs.append(F.scaled_dot_product_attention(torch.cat((q_cls, q[:, :, s]), 2), torch.cat((k_cls, k[:, :, s]), 2),
+                                                 torch.cat((v_cls, v[:, :, s]), 2), scale=attn.scale)[:, :, 1:, :].reshape(B, spb, C))
+    return attn.proj(torch.cat([cls] + xs, 1))
+
+
+def split_loop(attn, x):
+    B, N, C = x.shape
+    spb = (N - 1) // attn.num_branch
+    cls = x[:, 0:1, :]
+    q = attn.fuse_q(cls).reshape(B, 1, 1, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4)[0]
+    kv = attn.fuse_kv(x).reshape(B, N, 2, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4)
+    cls = F.scaled_dot_product_attention(q, kv[0], kv[1], scale=attn.scale).reshape(B, 1, C) + cls
+    xs = []
+    for i in range(attn.num_branch):
+        qkv_w = attn.qkv.weight[i * 3 * C:(i + 1) * 3 * C]
+        qkv_b = attn.qkv.bias[i * 3 * C:(i + 1) * 3 * C] if attn.qkv.bias is not None else None
+        qkv = F.linear(torch.cat((cls, x[:, 1 + i * spb:1 + (i + 1) * spb]), 1), qkv_w, qkv_b)
+        qkv = qkv.reshape(B, spb + 1, 3, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4)
+        _x = F.scaled_dot_product_attention(qkv[0], qkv[1], qkv[2], scale=attn.scale)[:, :, 1:, :].reshape(B, spb, C)
+        xs.append(F.linear(_x, attn.proj.weight[i * C:(i + 1) * C], attn.proj.bias[i * C:(i + 1) * C]))
+    return torch.cat([attn.cls_proj(cls)] + xs, 1)
+
+
+def timeit(fn, x, steps, device):
+    fn(x)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn(x)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return 1000 * (time.perf_counter() - start) / steps
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    variants = dict(share=(share.Attention_Sep, share_loop), split=(split.Attention_Sep, split_loop))
+
+    print(f"{'variant':<10}{'batch':>6}{'loop ms':>12}{'batched ms':>12}{'speedup':>10}{'max abs diff':>15}")
+    for name in args.variant:
+        attn_cls, loop = variants[name]
+        attn = attn_cls(args.embed_dim, num_heads=args.num_heads, qkv_bias=True, num_branch=args.num_branch).to(device).eval()
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, 1 + args.num_branch * args.tokens_per_branch, args.embed_dim, device=device)
+            diff = (attn(x) - loop(attn, x)).abs().max().item()
+            t_loop = timeit(lambda t: loop(attn, t), x, args.steps, device)
+            t_batched = timeit(attn, x, args.steps, device)
+            print(f"{name:<10}{batch_size:>6}{t_loop:>12.2f}{t_batched:>12.2f}{t_loop / t_batched:>9.2f}x{diff:>15.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Attention_Sep benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
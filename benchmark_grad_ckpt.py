@@ -0,0 +1,92 @@
+"""
+Peak memory against step time for different activation checkpointing ranges.
+
+    python benchmark_grad_ckpt.py --model cnn_share_attn --batch-size 4 \
+        --configs none enc:2-12 dec:0-12 enc:2-12,dec:0-12
+
+Every config is a comma separated list of enc:START-END / dec:START-END stage ranges (python
+ranges over the conv_trans stage numbers), or "none". The saved activation column counts the bytes autograd
+keeps for the backward pass and works on any device; peak memory is only reported on CUDA.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from timm.models import create_model
+
+import models
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('activation checkpointing benchmark', add_help=False)
+    parser.add_argument('--model', default='cnn_share_attn', type=str)
+    parser.add_argument('--batch-size', default=4, type=int)
+    parser.add_argument('--im-size', default=224, type=int)
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--configs', default=['none', 'enc:2-12', 'dec:0-12', 'enc:2-12,dec:0-12'], nargs='+', type=str)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    return parser
+
+
+def parse_config(config):
+    stages = dict(enc=(), dec=())
+    if config != 'none':
+        for part in config.split(','):
+            name, span = part.split(':')
+            start, end = span.split('-')
+            stages[name] = range(int(start), int(end))
+    return stages['enc'], stages['dec']
+
+
+def saved_bytes(model, im):
+    total = 0
+
+    def pack(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        model(im)
+    # the graph is freed on return, only its size is kept
+    return total
+
+
+def step(model, optimizer, im):
+    outputs, _, _ = model(im)
+    loss = F.mse_loss(outputs, im)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = create_model(args.model, pretrained=False).to(device)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+    im = torch.randn(args.batch_size, 3 * model.num_branch, args.im_size, args.im_size, device=device)
+
+    print(f"{'config':<24}{'saved MB':>12}{'peak MB':>12}{'ms / step':>12}")
+    for config in args.configs:
+        model.set_grad_checkpointing(*parse_config(config))
+        step(model, optimizer, im)
+        nbytes = saved_bytes(model, im)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            step(model, optimizer, im)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_time = (time.perf_counter() - start) / args.steps
+        peak = f"{torch.cuda.max_memory_allocated(device) / 2 ** 20:.0f}" if device.type == 'cuda' else "-"
+        print(f"{config:<24}{nbytes / 2 ** 20:>12.0f}{peak:>12}{1000 * step_time:>12.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('activation checkpointing benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
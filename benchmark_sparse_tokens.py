@@ -0,0 +1,94 @@
+"""
+FLOPs, latency and reconstruction error of cnn_share_attn with sparse foreground tokens.
+
+    python benchmark_sparse_tokens.py --checkpoint mix_output/cnn_share_attn/checkpoint_200.pth \
+        --data-path ../gravityspy/mixed_split/val/ --coverage 0 0.05 0.1 0.25
+
+For every --coverage (see set_sparse_tokens, 0 is the dense model) the table gives the share of
+patch tokens kept, the encoder GFLOPs per sample and ms per batch, the L1 / L2 reconstruction
+error and the max abs diff of the latent against the dense model. Without --data-path random
+thresholded noise is used, which only makes the FLOP and latency columns meaningful.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from timm.models import create_model
+from torch.utils.data import DataLoader
+from torch.utils.flop_counter import FlopCounterMode
+
+import models
+from data import four_scale_dataset_with_fname
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('sparse token benchmark', add_help=False)
+    parser.add_argument('--checkpoint', default='', type=str)
+    parser.add_argument('--data-path', default='', type=str)
+    parser.add_argument('--threshold', default=0, type=float)
+    parser.add_argument('--coverage', default=[0, 0.05, 0.1, 0.25], nargs='+', type=float)
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--batches', default=8, type=int)
+    parser.add_argument('--im-size', default=224, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    return parser
+
+
+def load_batches(args, device):
+    if not args.data_path:
+        ims = torch.rand(args.batches, args.batch_size, 12, args.im_size, args.im_size, device=device)
+        return list((ims * (ims > 0.9) - 0.5) / 0.5)
+    dataset = four_scale_dataset_with_fname(args.data_path, args.threshold, im_size=args.im_size)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+    batches = []
+    for im, _, _, _ in loader:
+        batches.append(im.to(device))
+        if len(batches) == args.batches:
+            break
+    return batches
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = create_model('cnn_share_attn', pretrained=False, use_vae=False)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu')["model"])
+    model = model.to(device).eval()
+    batches = load_batches(args, device)
+
+    model.set_sparse_tokens(0)
+    with torch.no_grad():
+        dense = [model.encode(im) for im in batches]
+
+    print(f"{'coverage':>10}{'kept':>8}{'GFLOPs':>10}{'ms / batch':>12}{'L1':>10}{'L2':>10}{'latent diff':>14}")
+    for coverage in args.coverage:
+        model.set_sparse_tokens(coverage)
+        with torch.no_grad():
+            kept = model.encoder.token_keep(batches[0]).float().mean().item() if coverage > 0 else 1.
+            with FlopCounterMode(display=False) as counter:
+                model.encode(batches[0])
+            flops = counter.get_total_flops() / args.batch_size
+
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            for im in batches:
+                model.encode(im)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            step_time = (time.perf_counter() - start) / len(batches)
+
+            l1 = l2 = diff = 0
+            for im, ref in zip(batches, dense):
+                pred, mu, _ = model(im)
+                l1 += F.l1_loss(pred, im).item() / len(batches)
+                l2 += F.mse_loss(pred, im).item() / len(batches)
+                diff = max(diff, (mu - ref).abs().max().item())
+        print(f"{coverage:>10.2f}{kept:>8.2f}{flops / 1e9:>10.2f}{1000 * step_time:>12.1f}{l1:>10.4f}{l2:>10.4f}{diff:>14.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('sparse token benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
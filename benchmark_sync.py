@@ -0,0 +1,81 @@
+"""
+Step time of the training loop with the old per-step host syncs (loss.item(), cuda.synchronize()
+and one .item() per logged tensor) against the deferred MetricLogger path of engine.py.
+
+    python benchmark_sync.py --model cnn_share_attn --batch-size 4 --im-size 224
+
+Runs on whatever device is available; on CPU the syncs are almost free, the gap shows up on
+accelerators where the host would otherwise run ahead of the device.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from timm.models import create_model
+from timm.utils import NativeScaler
+
+import models
+import utils
+from engine import kl_loss
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('host sync benchmark', add_help=False)
+    parser.add_argument('--model', default='cnn_share_attn', type=str)
+    parser.add_argument('--batch-size', default=4, type=int)
+    parser.add_argument('--im-size', default=224, type=int)
+    parser.add_argument('--steps', default=50, type=int)
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--print-freq', default=10, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    return parser
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run(model, optimizer, loss_scaler, im, steps, print_freq, sync):
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    for step in range(steps):
+        with torch.cuda.amp.autocast(enabled=im.device.type == 'cuda'):
+            outputs, mu, var = model(im)
+            loss_mse = F.mse_loss(outputs, im)
+            kl_div = 1e-2 * kl_loss(mu, var) if var is not None else 0
+            loss = loss_mse + kl_div
+        if sync:
+            loss.item()
+        optimizer.zero_grad()
+        loss_scaler(loss, optimizer, parameters=model.parameters())
+        if sync:
+            synchronize(im.device)
+        metric_logger.update(loss_mse=loss_mse, kl_div=kl_div, loss=loss, lr=optimizer.param_groups[0]["lr"])
+        if sync:
+            metric_logger.flush()
+        if step % print_freq == 0:
+            str(metric_logger)
+    synchronize(im.device)
+    return metric_logger
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = create_model(args.model, pretrained=False).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    loss_scaler = NativeScaler()
+    im = torch.randn(args.batch_size, 3 * model.num_branch, args.im_size, args.im_size, device=device)
+
+    run(model, optimizer, loss_scaler, im, args.warmup, args.print_freq, sync=True)
+    for sync in (True, False):
+        start = time.perf_counter()
+        run(model, optimizer, loss_scaler, im, args.steps, args.print_freq, sync=sync)
+        step_time = (time.perf_counter() - start) / args.steps
+        print(f"{args.model} on {device}, {'per-step syncs' if sync else 'deferred metrics'}: {1000 * step_time:.1f} ms / step")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('host sync benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,76 @@
+"""
+Write a four-scale split (<split>/sub_<scale>/<class>/<name>_<scale>.png) as one uint8 array.
+
+images.npy is a numpy memmap of shape [N, num_scale, 3, H, W] and meta.npz holds the sidecar
+fnames (<class>/<name>.png, as returned by four_scale_dataset_with_fname), labels, classes and
+scale arrays. Read it back with data.four_scale_memmap_dataset and data.four_scale_collate.
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('four-scale memmap build script', add_help=False)
+    parser.add_argument('--data-path', required=True, type=str, help='split to convert, e.g. ../gravityspy/train/')
+    parser.add_argument('--output-dir', required=True, type=str)
+    parser.add_argument('--scale', default=["0.5", "1.0", "2.0", "4.0"], nargs='+', type=str)
+    parser.add_argument('--im-size', default=0, type=int,
+                        help='pre-resize planes to this size, 0 keeps the native resolution')
+    parser.add_argument('--num_workers', default=8, type=int)
+    return parser
+
+
+def load_sample(path, fname, scale, im_size):
+    resize = transforms.Resize(im_size, antialias=True) if im_size > 0 else None
+    planes = []
+    for s in scale:
+        im = np.asarray(Image.open(os.path.join(path, f"sub_{s}", fname.replace(".png", f"_{s}.png"))).convert("RGB"))
+        im = torch.from_numpy(im).permute(2, 0, 1).contiguous()
+        if resize is not None:
+            im = resize(im)
+        planes.append(im)
+    return torch.stack(planes, 0).numpy()
+
+
+def _load_sample(job):
+    return load_sample(*job)
+
+
+def main(args):
+    ref = os.path.join(args.data_path, f"sub_{args.scale[0]}")
+    classes = sorted(os.listdir(ref))
+    fnames, labels = [], []
+    for label, c in enumerate(classes):
+        for f in sorted(os.listdir(os.path.join(ref, c))):
+            fnames.append(os.path.join(c, f.replace(f"_{args.scale[0]}", "")))
+            labels.append(label)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    shape = load_sample(args.data_path, fnames[0], args.scale, args.im_size).shape
+    ims = np.lib.format.open_memmap(os.path.join(args.output_dir, "images.npy"), mode="w+",
+                                    dtype=np.uint8, shape=(len(fnames),) + shape)
+    with Pool(args.num_workers) as pool:
+        jobs = ((args.data_path, fname, args.scale, args.im_size) for fname in fnames)
+        for i, im in enumerate(pool.imap(_load_sample, jobs, chunksize=16)):
+            if im.shape != shape:
+                raise ValueError(f"{fnames[i]} has shape {im.shape}, expected {shape}; pass --im-size")
+            ims[i] = im
+            if i % 1000 == 0:
+                print(f"[{i}/{len(fnames)}]")
+    ims.flush()
+
+    np.savez(os.path.join(args.output_dir, "meta.npz"), fnames=np.array(fnames), labels=np.array(labels),
+             classes=np.array(classes), scale=np.array(args.scale))
+    print(f"wrote {len(fnames)} samples of shape {shape} to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('four-scale memmap build script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -1,10 +1,50 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import os
 from PIL import Image
 import numpy as np
 from torchvision import transforms
 import random
+import pickle
+import queue
+import tempfile
+import threading
+import time
+import zlib
+import utils
+from manifest import FileManifest
+
+
+def read_planes(fnames, cache=None):
+    """
+    Decode the PNGs of one glitch into a raw uint8 [num_scale, 3, H, W] array, going through
+    the shared decode cache when one is given.
+    """
+    if cache is not None:
+        planes = cache.get("|".join(fnames))
+        if planes is not None:
+            return planes
+    planes = np.stack([np.asarray(Image.open(fname).convert("RGB")).transpose(2, 0, 1) for fname in fnames], 0)
+    if cache is not None:
+        cache.put("|".join(fnames), planes)
+    return planes
+
+
+def planes_to_sample(planes, threshold, normalize):
+    """
+    Per-sample (msk_im, im, msk) from raw uint8 planes, identical to decoding the PNGs with ToTensor.
+    """
+    msk_ims = []
+    ims = []
+    msks = []
+    for plane in torch.from_numpy(np.array(planes)):
+        im = plane.float().div(255)
+        msk = (im > threshold).any(0, keepdim=True)
+        msk_ims.append(normalize(msk * im))
+        ims.append(normalize(im))
+        msks.append(msk)
+    return torch.concat(msk_ims, 0), torch.concat(ims, 0), torch.concat(msks, 0)
+
 
 # class folder_dataset(Dataset):
 #     def __init__(self, path, threshold):
@@ -27,20 +67,29 @@ import random
 
 
 class four_scale_dataset(Dataset):
-    def __init__(self, path, threshold, im_size=224):
+    def __init__(self, path, threshold, im_size=224, raw=False, manifest=None, cache=None, scale=None):
         super().__init__()
         self.path = path
-        self.scale = ["0.5", "1.0", "2.0", "4.0"]
-        # self.scale = ["4.0"]
-        self.fnames = [os.path.join(dir, f.replace("_4.0", "")) for dir in os.listdir(f"{path}/sub_4.0/") for f in os.listdir(os.path.join(f"{path}/sub_4.0/", dir))]
+        # only the requested scales are ever opened, e.g. ["4.0"] for single-branch models
+        self.scale = scale if scale is not None else ["0.5", "1.0", "2.0", "4.0"]
+        if manifest is not None:
+            self.fnames = manifest.fnames("four_scale", self.scale)
+        else:
+            ref = self.scale[-1]
+            self.fnames = sorted(os.path.join(dir, f.replace(f"_{ref}", "")) for dir in os.listdir(f"{path}/sub_{ref}/") for f in os.listdir(os.path.join(f"{path}/sub_{ref}/", dir)))
         self.to_tensor = transforms.Compose([transforms.ToTensor()])
         self.normalize = transforms.Compose([transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
                                              transforms.Resize(im_size, antialias=True)])
         self.threshold = threshold
+        self.raw = raw
+        self.cache = cache
     def __len__(self):
         return len(self.fnames)
     
     def __getitem__(self, idx):
+        if self.raw or self.cache is not None:
+            planes = read_planes([os.path.join(self.path, f"sub_{scale}", self.fnames[idx].replace(".png", f"_{scale}.png")) for scale in self.scale], self.cache)
+            return planes if self.raw else planes_to_sample(planes, self.threshold, self.normalize)
         msk_ims = []
         ims = []
         msks = []
@@ -78,21 +127,31 @@ class four_scale_dataset(Dataset):
 
 
 class four_scale_dataset_with_fname(Dataset):
-    def __init__(self, path, threshold, im_size=224):
+    def __init__(self, path, threshold, im_size=224, raw=False, manifest=None, cache=None, scale=None):
         super().__init__()
         self.path = path
-        self.scale = ["0.5", "1.0", "2.0", "4.0"]
-        # self.scale = ["4.0"]
-        self.fnames = [os.path.join(dir, f.replace("_0.5", "")) for dir in os.listdir(f"{path}/sub_0.5/") for f in os.listdir(os.path.join(f"{path}/sub_0.5/", dir))]
+        self.scale = scale if scale is not None else ["0.5", "1.0", "2.0", "4.0"]
+        if manifest is not None:
+            self.fnames = manifest.fnames("four_scale", self.scale)
+        else:
+            ref = self.scale[0]
+            self.fnames = sorted(os.path.join(dir, f.replace(f"_{ref}", "")) for dir in os.listdir(f"{path}/sub_{ref}/") for f in os.listdir(os.path.join(f"{path}/sub_{ref}/", dir)))
         
         self.to_tensor = transforms.Compose([transforms.ToTensor()])
         self.normalize = transforms.Compose([transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
                                              transforms.Resize(im_size, antialias=True)])
         self.threshold = threshold
+        self.raw = raw
+        self.cache = cache
     def __len__(self):
         return len(self.fnames)
     
     def __getitem__(self, idx):
+        if self.raw or self.cache is not None:
+            planes = read_planes([os.path.join(self.path, f"sub_{scale}", self.fnames[idx].replace(".png", f"_{scale}.png")) for scale in self.scale], self.cache)
+            if self.raw:
+                return planes, self.fnames[idx]
+            return (*planes_to_sample(planes, self.threshold, self.normalize), self.fnames[idx])
         msk_ims = []
         ims = []
         msks = []
@@ -112,29 +171,345 @@ class four_scale_dataset_with_fname(Dataset):
 
 
 class gs2_dataset(Dataset):
-    def __init__(self, path, threshold, im_size=224):
+    def __init__(self, path, threshold, im_size=224, raw=False, manifest=None, cache=None, scale=None):
         super().__init__()
         self.path = path
-        self.scale = ["0.5", "1.0", "2.0", "4.0"]
-        self.fnames = [os.path.join(root, fname) for root, _, fnames in os.walk(path) for fname in fnames if "0.5" in fname]
-        random.shuffle(self.fnames)
+        # fnames are always the _0.5 paths, the requested scales are derived from them on load
+        self.scale = scale if scale is not None else ["0.5", "1.0", "2.0", "4.0"]
+        if manifest is not None:
+            self.fnames = manifest.fnames("gs2", self.scale)
+        else:
+            self.fnames = sorted(os.path.join(root, fname) for root, _, fnames in os.walk(path) for fname in fnames if "0.5" in fname)
+        # canonical order, shuffling is left to the sampler (samplers.ShardedSampler) so that every
+        # rank agrees on what index i is
         self.to_tensor = transforms.Compose([transforms.ToTensor()])
         self.normalize = transforms.Compose([transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
                                              transforms.Resize(im_size, antialias=True)])
         self.threshold = threshold
+        self.raw = raw
+        self.cache = cache
     def __len__(self):
         return len(self.fnames)
     
     def __getitem__(self, idx):
+        return self.load(self.fnames[idx])
+
+    def load(self, fname):
+        if self.raw or self.cache is not None:
+            planes = read_planes([fname.replace("_0.5.png", f"_{scale}.png") for scale in self.scale], self.cache)
+            return (planes, fname) if self.raw else (*planes_to_sample(planes, self.threshold, self.normalize), fname)
         msk_ims = []
         ims = []
         msks = []
         for scale in self.scale:
-            im = Image.open(self.fnames[idx].replace("_0.5.png", f"_{scale}.png"))
+            im = Image.open(fname.replace("_0.5.png", f"_{scale}.png"))
             im = self.to_tensor(im)
             msk = (im > self.threshold).any(0, keepdim=True)
             msk_ims.append(self.normalize(msk * im))
             ims.append(self.normalize(im))
             msks.append(msk)
 
-        return torch.concat(msk_ims, 0), torch.concat(ims, 0), torch.concat(msks, 0), self.fnames[idx] 
+        return torch.concat(msk_ims, 0), torch.concat(ims, 0), torch.concat(msks, 0), fname 
+
+
+
+
+class gs2_shard_dataset(Dataset):
+    """
+    Reads the packed shards written by pack_gs2.py and yields the same (msk_im, im, msk, fname)
+    tuples as gs2_dataset, without opening one PNG per scale.
+    """
+    def __init__(self, path, threshold, im_size=224, raw=False, scale=None):
+        super().__init__()
+        self.path = path
+        with open(os.path.join(path, "index.pkl"), "rb") as fh:
+            index = pickle.load(fh)
+        self.scale = scale if scale is not None else index["scale"]
+        self.select = [index["scale"].index(s) for s in self.scale] if self.scale != index["scale"] else None
+        # kept in the canonical (fname sorted) order written by pack_gs2.py, see gs2_dataset
+        self.records = index["records"]
+        self.shards = {}
+        self.normalize = transforms.Compose([transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+                                             transforms.Resize(im_size, antialias=True)])
+        self.threshold = threshold
+        self.raw = raw
+    def __len__(self):
+        return len(self.records)
+
+    def read_record(self, idx):
+        fname, shard, offset, shape = self.records[idx]
+        # opened lazily so every DataLoader worker maps the shard on its own
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.path, f"shard_{shard:05d}.bin"), dtype=np.uint8, mode="r")
+        planes = self.shards[shard][offset : offset + int(np.prod(shape))].reshape(shape)
+        # fancy indexing only touches the pages of the selected planes
+        return (planes if self.select is None else planes[self.select]), fname
+
+    def __getitem__(self, idx):
+        planes, fname = self.read_record(idx)
+        if self.raw:
+            return planes, fname
+        return (*planes_to_sample(planes, self.threshold, self.normalize), fname)
+
+
+
+
+class gs2_stream_dataset(IterableDataset):
+    """
+    Streaming variant of gs2_dataset for a directory that keeps receiving glitches.
+
+    Every poll_interval seconds the tree is re-listed through a FileManifest (only changed
+    directories are rescanned) and glitches whose scales are all present, and whose newest file is
+    at least settle seconds old, are yielded once. Glitches are assigned to a (rank, worker) shard by
+    a crc32 of their fname, so DDP ranks and DataLoader workers never yield the same glitch.
+    With several DataLoader workers only a thread of worker 0 polls the tree; it appends the new
+    glitches to a feed file that every worker of the rank reads from where it left off, so the
+    tree is scanned once per rank instead of once per worker.
+    With prefetch > 0 a background thread decodes up to prefetch samples ahead; when the consumer
+    falls behind the bounded queue fills up and stalls the decoding (the polling too, without a feed).
+    The stream ends after max_idle seconds without new glitches, or never if max_idle is None.
+    """
+    def __init__(self, path, threshold, im_size=224, raw=False, manifest=None, poll_interval=10., settle=2.,
+                 max_idle=None, prefetch=0, rank=None, world_size=None, cache=None, scale=None):
+        super().__init__()
+        self.path = path
+        self.scale = scale if scale is not None else ["0.5", "1.0", "2.0", "4.0"]
+        self.manifest = manifest if manifest is not None else FileManifest(path)
+        self.to_tensor = transforms.Compose([transforms.ToTensor()])
+        self.normalize = transforms.Compose([transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+                                             transforms.Resize(im_size, antialias=True)])
+        self.threshold = threshold
+        self.raw = raw
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.max_idle = max_idle
+        self.prefetch = prefetch
+        self.rank = utils.get_rank() if rank is None else rank
+        self.world_size = utils.get_world_size() if world_size is None else world_size
+
+    load = gs2_dataset.load
+
+    def poll(self, seen):
+        """
+        Refreshes the manifest and returns the complete, settled glitches that are not in seen.
+        seen is updated with them and pruned to the glitches the manifest still lists.
+        """
+        self.manifest.refresh()
+        now = time.time()
+        listed, new = set(), []
+        for fname, _, present, mtime in self.manifest.glitches("gs2", self.scale):
+            listed.add(fname)
+            if len(present) == len(self.scale) and now - mtime >= self.settle and fname not in seen:
+                new.append(fname)
+        seen &= listed
+        seen.update(new)
+        return new
+
+    def publish(self, feed):
+        """
+        Polls the manifest and appends every new glitch to the feed file, then an empty line once
+        the stream has been idle for max_idle. Runs in a thread of one DataLoader worker per rank.
+        """
+        # finished feeds of the earlier iterators of this process and of processes that are gone
+        folder, name = os.path.split(feed)
+        for old in os.listdir(folder):
+            parts = old[:-len(".feed")].split("_")
+            if not (old.startswith("gs2_stream_") and old.endswith(".feed") and len(parts) == 4) or old == name:
+                continue
+            if parts[2] != str(os.getppid()) and process_alive(int(parts[2])):
+                continue
+            try:
+                os.remove(os.path.join(folder, old))
+            except FileNotFoundError:
+                pass
+        seen = set()
+        last_new = time.time()
+        while True:
+            new = self.poll(seen)
+            now = time.time()
+            done = not new and self.max_idle is not None and now - last_new > self.max_idle
+            if new or done:
+                with open(feed, "ab") as fh:
+                    fh.write("".join(fname + "\n" for fname in new + [""] * done).encode())
+            if done:
+                return
+            if new:
+                last_new = now
+            else:
+                time.sleep(self.poll_interval)
+
+    def tail(self, shard, num_shards, feed=None):
+        """
+        Yields the new glitches of shard, polling the manifest itself or, given a feed file,
+        reading the glitches publish() appends to it up to its closing empty line.
+        """
+        seen = set()
+        offset = 0
+        last_new = time.time()
+        while True:
+            if feed is None:
+                new = self.poll(seen)
+                done = False
+            else:
+                new, offset = read_feed(feed, offset)
+                done = "" in new
+                new = new[:new.index("")] if done else new
+            now = time.time()
+            for fname in new:
+                if zlib.crc32(fname.encode()) % num_shards == shard:
+                    yield fname
+            if done:
+                return
+            if new:
+                last_new = now
+            elif feed is None and self.max_idle is not None and now - last_new > self.max_idle:
+                return
+            else:
+                time.sleep(self.poll_interval)
+
+    def prefetched(self, fnames):
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for fname in fnames:
+                    if not put(self.load(fname)):
+                        return
+            except Exception as e:
+                put(e)
+            put(end)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        feed = None
+        if info is not None and num_workers > 1:
+            # info.seed - worker_id is the same for all the workers of one DataLoader iterator
+            feed = os.path.join(tempfile.gettempdir(), f"gs2_stream_{os.getppid()}_{info.seed - worker_id}.feed")
+            if worker_id == 0:
+                threading.Thread(target=self.publish, args=(feed,), daemon=True).start()
+        fnames = self.tail(self.rank * num_workers + worker_id, self.world_size * num_workers, feed)
+        if self.prefetch > 0:
+            return self.prefetched(fnames)
+        return (self.load(fname) for fname in fnames)
+
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_feed(feed, offset):
+    """
+    The complete lines appended to feed since byte offset, and the offset to read from next.
+    """
+    if not os.path.exists(feed):
+        return [], offset
+    with open(feed, "rb") as fh:
+        fh.seek(offset)
+        data = fh.read()
+    end = data.rfind(b"\n") + 1
+    return data[:end].decode().splitlines(), offset + end
+
+
+class batch_transform(object):
+    """
+    Vectorized version of the per-sample thresholding, masking, normalization and resizing.
+    Takes raw uint8 [B, num_scale, 3, H, W] batches on any device and returns (msk_im, im, msk)
+    as the datasets would have stacked them.
+    """
+    def __init__(self, threshold, im_size=224):
+        self.normalize = transforms.Compose([transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+                                             transforms.Resize(im_size, antialias=True)])
+        self.threshold = threshold
+
+    def __call__(self, ims):
+        B, S, C, H, W = ims.shape
+        im = ims.flatten(0, 1).float().div(255)
+        msk = (im > self.threshold).any(1, keepdim=True)
+        msk_im = self.normalize(msk * im)
+        im = self.normalize(im)
+        h, w = im.shape[-2:]
+        return msk_im.reshape(B, S * C, h, w), im.reshape(B, S * C, h, w), msk.reshape(B, S, H, W)
+
+
+
+class four_scale_collate(object):
+    """
+    Collate for raw samples (the memmap datasets, or any dataset built with raw=True).
+    Stacks the uint8 [num_scale, 3, H, W] samples and, if a batch_transform is given, applies it
+    in the worker. Without one the uint8 batch is returned so the transform can run on the device.
+    """
+    def __init__(self, transform=None):
+        self.transform = transform
+
+    def __call__(self, batch):
+        if isinstance(batch[0], tuple):
+            ims, fnames = zip(*batch)
+            ims = torch.from_numpy(np.stack(ims, 0))
+            if self.transform is None:
+                return ims, list(fnames)
+            return (*self.transform(ims), list(fnames))
+        ims = torch.from_numpy(np.stack(batch, 0))
+        return ims if self.transform is None else self.transform(ims)
+
+
+
+class four_scale_memmap_dataset(Dataset):
+    """
+    Indexes the [N, num_scale, 3, H, W] uint8 array written by build_memmap.py without copying.
+    Samples are raw uint8 and have to be batched with four_scale_collate and a batch_transform.
+    """
+    def __init__(self, path, scale=None):
+        super().__init__()
+        self.path = path
+        self.ims = np.load(os.path.join(path, "images.npy"), mmap_mode="r")
+        meta = np.load(os.path.join(path, "meta.npz"))
+        self.fnames = meta["fnames"]
+        self.labels = meta["labels"]
+        self.classes = [str(c) for c in meta["classes"]]
+        stored = [str(s) for s in meta["scale"]]
+        self.scale = scale if scale is not None else stored
+        self.select = [stored.index(s) for s in self.scale] if self.scale != stored else None
+    def __len__(self):
+        return len(self.ims)
+
+    def __getitem__(self, idx):
+        return self.ims[idx] if self.select is None else self.ims[idx][self.select]
+
+
+
+class four_scale_memmap_dataset_with_fname(four_scale_memmap_dataset):
+    def __getitem__(self, idx):
+        return super().__getitem__(idx), str(self.fnames[idx])
@@ -0,0 +1,112 @@
+"""
+Exponential moving average of the model weights, updated with multi-tensor (torch._foreach) ops.
+"""
+from copy import deepcopy
+
+import torch
+
+
+class ModelEma(object):
+    """
+    Drop-in for timm's ModelEma (same constructor, update(), _load_checkpoint() and state_dict
+    through timm.utils.get_state_dict) that updates every floating point tensor of the state in
+    one torch._foreach_lerp_ call instead of one small kernel per tensor.
+
+    update_every=K only applies every K-th update() call, with the decay raised to the power K so
+    the average covers the same number of steps. With device='cpu' the EMA lives in host memory:
+    an update only queues non-blocking copies of the weights into pinned buffers, the averaging
+    itself runs on the CPU at the next update (or state_dict()), once the copies have landed.
+    """
+
+    def __init__(self, model, decay=0.9999, device='', resume='', update_every=1):
+        self.ema = deepcopy(model)
+        self.ema.eval()
+        self.decay = decay
+        self.device = device
+        self.update_every = update_every
+        if device:
+            self.ema.to(device=device)
+        for p in self.ema.parameters():
+            p.requires_grad_(False)
+        self.calls = 0
+        self.pending = None  # (event, pinned copies) of a CPU update not averaged yet
+        if resume:
+            self._load_checkpoint(resume)
+
+        # views of the EMA tensors, updated in place
+        state = self.ema.state_dict()
+        self.keys = list(state.keys())
+        self.float_keys = [k for k in self.keys if state[k].is_floating_point()]
+        self.other_keys = [k for k in self.keys if not state[k].is_floating_point()]
+        self.ema_float = [state[k] for k in self.float_keys]
+        self.ema_other = [state[k] for k in self.other_keys]
+
+        # host copies of the model state for the CPU EMA, allocated (and pinned) once and refilled by
+        # every update: the previous copy has always been averaged in by then, see update()
+        self.pin = torch.cuda.is_available()
+        self.staging = None
+        if device:
+            self.staging = [torch.empty_like(t, device='cpu', pin_memory=self.pin) for t in self.ema_float + self.ema_other]
+
+    @staticmethod
+    def _unwrap(model):
+        model = getattr(model, '_orig_mod', model)  # torch.compile
+        return model.module if hasattr(model, 'module') else model
+
+    def update(self, model):
+        self.calls += 1
+        if self.calls % self.update_every:
+            return
+        state = self._unwrap(model).state_dict()
+        model_float = [state[k].detach() for k in self.float_keys]
+        model_other = [state[k] for k in self.other_keys]
+        with torch.no_grad():
+            if not self.device or model_float[0].device == self.ema_float[0].device:
+                torch._foreach_lerp_(self.ema_float, [t.to(self.ema_float[0].device) for t in model_float],
+                                     1. - self.decay ** self.update_every)
+                for e, m in zip(self.ema_other, model_other):
+                    e.copy_(m)
+                return
+            self._apply_pending()
+            for s, t in zip(self.staging, model_float + model_other):
+                s.copy_(t, non_blocking=self.pin)
+            event = None
+            if self.pin and model_float[0].is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+            self.pending = (event, self.staging)
+
+    def _apply_pending(self):
+        if self.pending is None:
+            return
+        event, copies = self.pending
+        self.pending = None
+        if event is not None:
+            event.synchronize()
+        n = len(self.ema_float)
+        with torch.no_grad():
+            torch._foreach_lerp_(self.ema_float, copies[:n], 1. - self.decay ** self.update_every)
+            for e, m in zip(self.ema_other, copies[n:]):
+                e.copy_(m)
+
+    def averaged(self):
+        """
+        The EMA module itself, with any pending CPU update applied, e.g. to evaluate it.
+        """
+        self._apply_pending()
+        return self.ema
+
+    def state_dict(self):
+        self._apply_pending()
+        return self.ema.state_dict()
+
+    def _load_checkpoint(self, checkpoint_path):
+        """
+        Accepts the plain EMA state dict train.py saves as checkpoint['model_ema'] as well as
+        timm's {'state_dict_ema': ...}; see utils._load_checkpoint_for_ema.
+        """
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        state = checkpoint.get('state_dict_ema', checkpoint)
+        state = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state.items()}
+        self.pending = None
+        self.ema.load_state_dict(state)
@@ -1,6 +1,7 @@
 """
 Train and eval functions used in main.py
 """
+import contextlib
 import math
 import sys
 from typing import Iterable, Optional
@@ -8,9 +9,10 @@ from typing import Iterable, Optional
 import torch
 
 from timm.data import Mixup
-from timm.utils import accuracy, ModelEma
+from timm.utils import accuracy
 
 import utils
+from ema import ModelEma
 from torchvision.utils import save_image
 import torch.nn.functional as F
 
@@ -23,8 +25,20 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0,
                     model_ema: Optional[ModelEma] = None, mixcup_fn: Optional[Mixup] = None,
-                    set_training_mode=True
+                    set_training_mode=True, batch_transform=None,
+                    start_step=0, checkpoint_freq=0, checkpoint_fn=None, accum_iter=1, im_size=None
                     ):
+    """
+    start_step is the number of batches of this epoch already trained on before a mid-epoch
+    resume (the sampler skips their samples); checkpoint_fn(step) is called every
+    checkpoint_freq steps of the epoch, on optimizer step boundaries only.
+
+    With accum_iter > 1 the gradients of accum_iter consecutive batches are accumulated before
+    every optimizer step; the DDP all-reduce only runs on the last of them.
+
+    im_size, when given, resizes the batches on the device before the forward pass (progressive
+    resolution training).
+    """
     # TODO fix this for finetuning
     model.train(set_training_mode)
     criterion.train()
@@ -32,12 +46,29 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
-
-    for msk_im, _, msk, _ in metric_logger.log_every(data_loader, print_freq, header):
-        msk_im = msk_im.to(device, non_blocking=True)
-        msk = msk.to(device, non_blocking=True)
-
-        with torch.cuda.amp.autocast():
+    cache = getattr(data_loader.dataset, "cache", None)
+    last_step = start_step + len(data_loader)
+    optimizer.zero_grad()
+    ddp = getattr(model, '_orig_mod', model)  # torch.compile wraps the DDP module
+    if not isinstance(ddp, torch.nn.parallel.DistributedDataParallel):
+        ddp = None
+
+    for step, samples in enumerate(metric_logger.log_every(data_loader, print_freq, header), start_step + 1):
+        if batch_transform is not None:
+            # raw uint8 batch, thresholded and normalized on the device
+            msk_im, _, msk = batch_transform(samples[0].to(device, non_blocking=True))
+        else:
+            msk_im, _, msk, _ = samples
+            msk_im = msk_im.to(device, non_blocking=True)
+            msk = msk.to(device, non_blocking=True)
+        if im_size is not None and msk_im.shape[-1] != im_size:
+            msk_im = F.interpolate(msk_im, size=im_size, mode='bilinear', align_corners=False, antialias=True)
+
+        # the last batches of the epoch form a shorter window rather than being dropped
+        update = step % accum_iter == 0 or step == last_step
+        # DDP decides in the forward pass whether the backward all-reduces
+        no_sync = ddp.no_sync() if ddp is not None and not update else contextlib.nullcontext()
+        with no_sync, torch.cuda.amp.autocast():
             # outputs = model(msk_im)
             # if isinstance(outputs, list):
             #     loss_list = [criterion(o, targets) / len(outputs) for o in outputs]
@@ -53,22 +84,20 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             loss = loss_mse + kl_div
 
 
-        loss_value = loss.item()
-
+        # no loss.item() here: the losses stay on the device and the metric logger reads them
+        # back every print_freq steps, so the host can queue the next step in the meantime
         # if not math.isfinite(loss_value):
         #     print("Loss is {}, stopping training".format(loss_value))
         #     sys.exit(1)
 
-        optimizer.zero_grad()
-
         # this attribute is added by timm on one optimizer (adahessian)
         is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        loss_scaler(loss, optimizer, clip_grad=max_norm,
-                    parameters=model.parameters(), create_graph=is_second_order)
-
-        torch.cuda.synchronize()
-        if model_ema is not None:
-            model_ema.update(model)
+        loss_scaler(loss / accum_iter, optimizer, clip_grad=max_norm,
+                    parameters=model.parameters(), create_graph=is_second_order, need_update=update)
+        if update:
+            optimizer.zero_grad()
+            if model_ema is not None:
+                model_ema.update(model)
 
         # if isinstance(outputs, list):
         #     metric_logger.update(loss_0=loss_list[0].item())
@@ -77,8 +106,13 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         #     metric_logger.update(loss=loss_value)
         metric_logger.update(loss_mse=loss_mse)
         metric_logger.update(kl_div=kl_div)
-        metric_logger.update(loss=loss_value)
+        metric_logger.update(loss=loss)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+        if cache is not None:
+            cache_stats = cache.stats()
+            metric_logger.update(cache_hit_rate=cache_stats["hit_rate"], cache_fill=cache_stats["fill"])
+        if checkpoint_fn is not None and checkpoint_freq > 0 and update and step % checkpoint_freq == 0:
+            checkpoint_fn(step)
 
 
 
@@ -91,6 +125,22 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+@torch.no_grad()
+def reconstruction_error(model, ims, batch_size=16):
+    """
+    Mean L1 / L2 reconstruction error of model (in eval mode) over the cached CPU batch ims,
+    moved to the model's device batch_size samples at a time.
+    """
+    device = next(model.parameters()).device
+    l1 = l2 = 0.
+    for x in ims.split(batch_size):
+        x = x.to(device, non_blocking=True).float()
+        pred = model(x)[0]
+        l1 += F.l1_loss(pred, x, reduction='sum').item()
+        l2 += F.mse_loss(pred, x, reduction='sum').item()
+    return l1 / ims.numel(), l2 / ims.numel()
+
+
 @torch.no_grad()
 def evaluate(data_loader, model, device):
     criterion = torch.nn.CrossEntropyLoss()
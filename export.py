@@ -0,0 +1,146 @@
+"""
+Export the encoder of a registered autoencoder as a frozen CPU artifact for latent extraction.
+
+    python export.py --model cnn_share_attn cnn_split_attn --checkpoint mix_output/cnn_share_attn/checkpoint_100.pth \
+        --format torchscript --output-dir exported
+
+For every model the artifact (<output-dir>/<model>_encoder.pt for TorchScript, .pt2 for
+torch.export) only holds the path from the input to the latent mean returned by model.encode.
+It is checked against eager mode on a random batch and then timed on the CPU. A model that
+fails to export, or whose artifact has a max abs diff relative to the largest eager output
+above --rtol, is reported and the run exits non-zero.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from timm.models import create_model
+
+import models
+from utils import load_encoder_state_dict
+
+
+MODELS = ['cnn', 'vit_share', 'vit_split', 'conformer', 'cnn_share_attn', 'cnn_split_attn', 'cnn_nofuse_attn', 'cnn_concat_attn']
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('encoder export', add_help=False)
+    parser.add_argument('--model', default=MODELS, nargs='+', choices=MODELS)
+    parser.add_argument('--checkpoint', default='', type=str,
+                        help='checkpoint_<epoch>.pth to export, only with a single --model (random weights otherwise)')
+    parser.add_argument('--format', default='torchscript', choices=['torchscript', 'export'], type=str)
+    parser.add_argument('--output-dir', default='exported', type=str)
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--im-size', default=224, type=int)
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='torch CPU threads, 0 keeps the default')
+    parser.add_argument('--rtol', default=1e-5, type=float,
+                        help='parity tolerance relative to max |eager output|; freezing folds BatchNorm into the convs')
+    return parser
+
+
+class Encoder(torch.nn.Module):
+    """
+    model.encode as the forward pass, so tracing / export only sees the encoder.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.encode(x)
+
+
+def build(name, checkpoint):
+    model = create_model(name, pretrained=False, use_decoder=False)
+    if checkpoint:
+        load_encoder_state_dict(model, torch.load(checkpoint, map_location='cpu')["model"])
+    return Encoder(model).eval()
+
+
+def batch_range(n):
+    """
+    (min, max) batch size of the torch.export program traced at batch n. Sizes 0 and 1 are
+    specialized on, and on the CPU the convolution backend is picked by batch < 16, which the
+    trace guards on, so the range stays on n's side of 16.
+    """
+    return (2, 15) if n < 16 else (16, None)
+
+
+def export(encoder, sample, fmt, path):
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            artifact = torch.jit.freeze(torch.jit.trace(encoder, sample))
+            torch.jit.save(artifact, path)
+            return torch.jit.load(path)
+        low, high = batch_range(len(sample))
+        if hasattr(torch.export, 'Dim'):
+            batch = torch.export.Dim('batch', min=low, max=high)
+            program = torch.export.export(encoder, (sample,), dynamic_shapes={'x': {0: batch}})
+        else:  # torch 2.1
+            constraints = [torch.export.dynamic_dim(sample, 0) >= low]
+            if high is not None:
+                constraints.append(torch.export.dynamic_dim(sample, 0) <= high)
+            program = torch.export.export(encoder, (sample,), constraints=constraints)
+        torch.export.save(program, path)
+        return torch.export.load(path).module()
+
+
+def latency(fn, sample, steps):
+    with torch.no_grad():
+        fn(sample)
+        start = time.perf_counter()
+        for _ in range(steps):
+            fn(sample)
+    return (time.perf_counter() - start) / steps
+
+
+def main(args):
+    if args.checkpoint and len(args.model) > 1:
+        raise ValueError("--checkpoint can only be used with a single --model")
+    if args.format == 'export' and args.batch_size < 2:
+        raise ValueError("--format export needs --batch-size >= 2")
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.output_dir, exist_ok=True)
+    suffix = '.pt' if args.format == 'torchscript' else '.pt2'
+
+    failed = []
+    print(f"{'model':<18}{'max rel diff':>14}{'eager ms':>12}{'export ms':>12}{'samples / s':>14}")
+    for name in args.model:
+        encoder = build(name, args.checkpoint)
+        sample = torch.randn(args.batch_size, 3 * encoder.model.num_branch, args.im_size, args.im_size)
+        try:
+            artifact = export(encoder, sample, args.format, os.path.join(args.output_dir, f"{name}_encoder{suffix}"))
+        except Exception as e:
+            # e.g. torch 2.1 cannot serialize scaled_dot_product_attention in a torch.export program
+            print(f"{name:<18}export failed: {type(e).__name__}: {str(e).splitlines()[0]}")
+            failed.append(name)
+            continue
+
+        # a second batch size shows the artifact did not bake in the traced one
+        check = sample[: max(batch_range(args.batch_size)[0], args.batch_size // 2)]
+        with torch.no_grad():
+            diff = 0.
+            for x in (sample, check):
+                expected = encoder(x)
+                diff = max(diff, ((artifact(x) - expected).abs().max() / expected.abs().max()).item())
+        if diff > args.rtol:
+            failed.append(name)
+
+        eager = latency(encoder, sample, args.steps)
+        exported = latency(artifact, sample, args.steps)
+        print(f"{name:<18}{diff:>14.2e}{1000 * eager:>12.1f}{1000 * exported:>12.1f}{args.batch_size / exported:>14.1f}")
+
+    if failed:
+        print(f"export or parity check (rtol {args.rtol}) failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('encoder export', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -9,16 +9,14 @@ from models import cnn_share_attn, cnn_split_attn, cnn, vit_share, conformer, cn
 import shutil
 import json
 import torch.nn.functional as F
+from utils import compile_model, load_encoder_state_dict
+from export import Encoder
+from latent_store import LatentWriter, is_complete
 
 
-def main(idx, dir, out_dir, model_class, split):
-    latent_dir = os.path.join(out_dir, f"{split}/test_{idx}")
-    im_dir = os.path.join(out_dir, f"{split}/test_im_{idx}")
-
-    if os.path.exists(latent_dir):
-        return
-
-    model = model_class(use_vae=False)
+def load_model(idx, dir, model_class):
+    # without reconstruction metrics the decoder is never built, only model.encode runs
+    model = model_class(use_vae=False, use_decoder=recon_every > 0)
     # if hasattr(model, "encoder"):
     #     print(f"Number of encoder parameters: {sum(p.numel() for p in model.encoder.parameters() if p.requires_grad)}")
     # else:
@@ -29,59 +27,76 @@ def main(idx, dir, out_dir, model_class, split):
     #     print(f"Number of encoder parameters: {sum(p.numel() for i in range(model.num_branch) for p in getattr(model, f'decoder_{i}').parameters()  if p.requires_grad)}") 
 
     # exit()
-    model.load_state_dict(torch.load(f"{dir}/checkpoint_{idx}.pth", map_location=device)["model"])
+    state_dict = torch.load(f"{dir}/checkpoint_{idx}.pth", map_location=device)["model"]
+    if recon_every > 0:
+        model.load_state_dict(state_dict)
+    else:
+        load_encoder_state_dict(model, state_dict)
     model = model.to(device)
     model.eval()
-    dataset = four_scale_dataset_with_fname(f"../gravityspy/mixed_split/{split}/", 0)
-    C = dataset[0][0].shape[0]
-    dataloader = DataLoader(dataset=dataset, batch_size=batch, shuffle=False, num_workers=4)
-    l2 = 0
-    l1 = 0
+    encode = model.encode
+    if use_compile:
+        encode = compile_model(Encoder(model), torch.randn(batch, 3 * model.num_branch, 224, 224, device=device))
+    return model, encode
+
+
+def main(idxs, dir, out_dir, model_class, split):
+    """
+    Extract the latents of every checkpoint in idxs from a single pass over the split: each batch
+    is decoded once and goes through all of the checkpoints' encoders.
+    """
+    idxs = [idx for idx in idxs if not is_complete(os.path.join(out_dir, f"{split}/test_{idx}"))]
+    if not idxs:
+        return
+
+    encoders = [load_model(idx, dir, model_class) for idx in idxs]
+    # single-branch models only see the 4.0 scale, the others are never decoded
+    scale = ["4.0"] if encoders[0][0].num_branch == 1 else ["0.5", "1.0", "2.0", "4.0"]
+    dataset = four_scale_dataset_with_fname(f"../gravityspy/mixed_split/{split}/", 0, raw=transform_on_device, scale=scale)
+    transform = batch_transform(0)
+    dataloader = DataLoader(dataset=dataset, batch_size=batch, shuffle=False, num_workers=4,
+                            collate_fn=four_scale_collate() if transform_on_device else None)
+    writers = [LatentWriter(os.path.join(out_dir, f"{split}/test_{idx}"), dataset.fnames) for idx in idxs]
+    l2 = [0] * len(idxs)
+    l1 = [0] * len(idxs)
+    n_recon = 0
 
 
     
     with torch.no_grad():
-        for im, ori_im, msk, fnames in tqdm(dataloader):
-
-
-
-
-            pred, latent, var = model(im.to(device))
-
-            l1 += F.l1_loss(pred, im.to(device)) / len(dataloader)
-            l2 += F.mse_loss(pred, im.to(device)) / len(dataloader)
-            if latent.ndim == 3:
-                latent = latent[:, 0, :]
-
-
-
-
-
-            for i, fname in enumerate(fnames):
-                if not os.path.exists(os.path.join(latent_dir, fname.split("/")[-2])):
-                    os.makedirs(os.path.join(latent_dir, fname.split("/")[-2]))
-
-                # if not os.path.exists(os.path.join(im_dir, fname.split("/")[-2])):
-                #     os.makedirs(os.path.join(im_dir, fname.split("/")[-2]))
-                _im = torch.cat([im[i:i+1, 3*j : 3*(j+1), ...] for j in range(C // 3)], 0)
-                _ori_im = torch.cat([ori_im[i:i+1, 3*j : 3*(j+1), ...] for j in range(C // 3)], 0)
-                _pred = torch.cat([pred[i:i+1, 3*j : 3*(j+1), ...] for j in range(C // 3)], 0)
-                res = torch.cat([_im.cpu(), _pred.cpu()], dim=0)
-                # comp = np.load(os.path.join("_test", fname.split("/")[-2],fname.split("/")[-1])+".npy")
-                # if not (comp == latent[i:i+1, ...].detach().cpu().numpy()).all().item():
-                #     print(fname)
-                #     print(comp)
-                #     print(latent[i:i+1, ...].detach().cpu().numpy())
-                
-                np.save(os.path.join(latent_dir, fname.split("/")[-2],fname.split("/")[-1]), latent[i:i+1, ...].detach().cpu().numpy())
-                #save_image(res, os.path.join(im_dir, fname.split("/")[-2],fname.split("/")[-1]), normalize=True, value_range=(-1, 1), nrow=4)
-            
+        for step, samples in enumerate(tqdm(dataloader)):
+            if transform_on_device:
+                im, ori_im, msk = transform(samples[0].to(device))
+                fnames = samples[1]
+            else:
+                im, ori_im, msk, fnames = samples
+
+            im = im.to(device)
+            recon = recon_every > 0 and step % recon_every == 0
+            n_recon += recon
+            for j, (model, encode) in enumerate(encoders):
+                if recon:
+                    pred, latent, var = model(im)
+                    l1[j] += F.l1_loss(pred, im)
+                    l2[j] += F.mse_loss(pred, im)
+                else:
+                    latent = encode(im)
+                if latent.ndim == 3:
+                    latent = latent[:, 0, :]
+                writers[j].write(latent.float().cpu().numpy())
+
+        for writer in writers:
+            writer.close()
+
+        if n_recon == 0:
+            return
         res = {}
         if os.path.exists(os.path.join(out_dir.split("/")[0], "l1_l2.json")):
             with open(os.path.join(out_dir.split("/")[0], "l1_l2.json")) as fh:
                 res = json.load(fh)
         
-        res[f"{out_dir.split('/')[1]}_{split}_{idx}"] = f"l1 : {l1.item()} l2 : {l2.item()}"
+        for j, idx in enumerate(idxs):
+            res[f"{out_dir.split('/')[1]}_{split}_{idx}"] = f"l1 : {l1[j].item() / n_recon} l2 : {l2[j].item() / n_recon}"
 
 
         with open(os.path.join(out_dir.split("/")[0], "l1_l2.json"), "w") as fh: 
@@ -91,13 +106,20 @@ def main(idx, dir, out_dir, model_class, split):
 #     shutil.rmtree("./test_out")
 
 batch = 32
+# decode raw uint8 in the workers and threshold / normalize whole batches on the device
+transform_on_device = False
+# torch.compile model.encode before extracting and print its speedup over eager mode
+use_compile = False
+# L1 / L2 reconstruction metrics on every recon_every-th batch, 0 never builds the decoder
+recon_every = 0
+# checkpoints whose encoders share one pass over the data, bounded by device memory
+ckpt_per_pass = 8
 for name in ["cnn_split_attn"]:
     indir = f"mix_output/{name}"
     outdir = f"latent_code/{name}"
     for split in ["val", "test"]:
         device = "cuda"
         ckpt_num = [int(fname.split(".")[0]) for fname in os.listdir(indir) if fname.endswith(".png")]
-        ckpt_num.sort()
-        for i in ckpt_num:
-            if i % 20 == 0:
-                main(i, indir, outdir, eval(name), split)
\ No newline at end of file
+        ckpt_num = sorted(i for i in ckpt_num if i % 20 == 0)
+        for start in range(0, len(ckpt_num), ckpt_per_pass):
+            main(ckpt_num[start : start + ckpt_per_pass], indir, outdir, eval(name), split)
\ No newline at end of file
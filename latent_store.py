@@ -0,0 +1,70 @@
+"""
+One array per checkpoint and split for the latents written by extract.py, instead of one .npy
+file per glitch.
+
+<path>/latents.npy is a float32 numpy memmap of shape [N, D], row i belongs to fnames[i], and
+<path>/meta.npz holds the fnames (<class>/<name>.png), labels and classes. meta.npz is written
+last, so a directory without it is an interrupted extraction.
+"""
+import os
+
+import numpy as np
+
+
+def is_complete(path):
+    return os.path.exists(os.path.join(path, "meta.npz"))
+
+
+class LatentWriter(object):
+    """
+    Appends batches of latents for fnames, in order. The array is created on the first write,
+    once the latent size is known.
+    """
+
+    def __init__(self, path, fnames):
+        self.path = path
+        self.fnames = np.array(fnames)
+        self.classes = np.array(sorted(set(fname.split("/")[-2] for fname in fnames)))
+        self.labels = np.searchsorted(self.classes, [fname.split("/")[-2] for fname in fnames])
+        self.latents = None
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, latent):
+        if self.latents is None:
+            self.latents = np.lib.format.open_memmap(os.path.join(self.path, "latents.npy"), mode="w+", dtype=np.float32,
+                                                     shape=(len(self.fnames), latent.shape[1]))
+        self.latents[self.count : self.count + len(latent)] = latent
+        self.count += len(latent)
+
+    def close(self):
+        if self.count != len(self.fnames):
+            raise ValueError(f"wrote {self.count} latents for {len(self.fnames)} fnames in {self.path}")
+        self.latents.flush()
+        np.savez(os.path.join(self.path, "meta.npz"), fnames=self.fnames, labels=self.labels, classes=self.classes)
+
+
+def load_latents(path, mmap=False):
+    """
+    Returns (latents [N, D], labels [N], fnames [N], classes) of one checkpoint and split.
+    """
+    meta = np.load(os.path.join(path, "meta.npz"))
+    latents = np.load(os.path.join(path, "latents.npy"), mmap_mode="r" if mmap else None)
+    return latents, meta["labels"], meta["fnames"], meta["classes"]
+
+
+def load_split(split_dir):
+    """
+    Every completed latent_code/<model>/<split>/test_<idx> as the lists k_means.ipynb clusters:
+    dict(data, labels, fnames, idx_num, classes), sorted by checkpoint index.
+    """
+    idx_num = sorted(int(d.split("_")[-1]) for d in os.listdir(split_dir)
+                     if d.startswith("test_") and d.split("_")[-1].isdigit() and is_complete(os.path.join(split_dir, d)))
+    res = dict(data=[], labels=[], fnames=[], idx_num=idx_num, classes=None)
+    for idx in idx_num:
+        latents, labels, fnames, classes = load_latents(os.path.join(split_dir, f"test_{idx}"))
+        res["data"].append(np.nan_to_num(latents))
+        res["labels"].append(labels)
+        res["fnames"].append(fnames)
+        res["classes"] = classes
+    return res
@@ -0,0 +1,122 @@
+"""
+Persistent file index for the dataset trees, so that building a dataset does not have to
+os.walk / os.listdir hundreds of thousands of files on every start and on every rank.
+"""
+import os
+import pickle
+import re
+
+import torch.distributed as dist
+
+import utils
+
+
+SCALE_PATTERN = re.compile(r"^(.*)_(\d+\.\d+)\.png$")
+
+
+class FileManifest(object):
+    """
+    Listing of every directory under root: its mtime, its subdirectories and the mtime of each
+    png in it. refresh() only re-lists directories whose mtime changed since the last refresh,
+    which is enough to pick up added, removed and renamed files (files rewritten in place keep
+    the directory mtime and are not noticed).
+
+    Two layouts are understood:
+      gs2:        <root>/.../<class>/<name>_<scale>.png, fnames are the full _0.5 paths
+      four_scale: <root>/sub_<scale>/<class>/<name>_<scale>.png, fnames are <class>/<name>.png
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {}
+
+    def refresh(self):
+        dirs = {}
+        rescanned = 0
+        stack = [self.root]
+        while stack:
+            top = stack.pop()
+            mtime = os.stat(top).st_mtime_ns
+            cached = self.dirs.get(top)
+            if cached is None or cached[0] != mtime:
+                subdirs, files = [], {}
+                with os.scandir(top) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.name.endswith(".png"):
+                            files[entry.name] = entry.stat().st_mtime
+                cached = (mtime, sorted(subdirs), files)
+                rescanned += 1
+            dirs[top] = cached
+            # joined like os.walk does, so fnames match the ones the datasets used to build
+            stack.extend(os.path.join(top, d) for d in cached[1])
+        self.dirs = dirs
+        return rescanned
+
+    def glitches(self, layout, scale):
+        """
+        Returns (fname, class, scales present, newest mtime) for every glitch with at least one
+        of the requested scales, sorted by fname.
+        """
+        groups = {}
+        for top, (_, _, files) in self.dirs.items():
+            if layout == "four_scale":
+                parts = os.path.relpath(top, self.root).split(os.sep)
+                if len(parts) != 2 or not parts[0].startswith("sub_"):
+                    continue
+                c = parts[1]
+            elif layout == "gs2":
+                c = os.path.basename(os.path.normpath(top))
+            else:
+                raise ValueError(f"unknown layout {layout}")
+            for name, mtime in files.items():
+                m = SCALE_PATTERN.match(name)
+                if m is None or m.group(2) not in scale:
+                    continue
+                if layout == "four_scale":
+                    fname = os.path.join(c, f"{m.group(1)}.png")
+                else:
+                    fname = os.path.join(top, f"{m.group(1)}_0.5.png")
+                group = groups.setdefault(fname, [c, {}])
+                group[1][m.group(2)] = mtime
+        return [(fname, c, tuple(s for s in scale if s in present), max(present.values()))
+                for fname, (c, present) in sorted(groups.items())]
+
+    def fnames(self, layout, scale):
+        """
+        fnames of the glitches that have every requested scale.
+        """
+        return [fname for fname, _, present, _ in self.glitches(layout, scale) if len(present) == len(scale)]
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as fh:
+            pickle.dump(dict(root=self.root, dirs=self.dirs), fh)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fh:
+            state = pickle.load(fh)
+        manifest = cls(state["root"])
+        manifest.dirs = state["dirs"]
+        return manifest
+
+
+def load_manifest(root, path):
+    """
+    Rank 0 loads the manifest at path (if any), refreshes it against root and saves it back;
+    the other ranks wait for it and load the result.
+    """
+    if utils.is_main_process():
+        manifest = FileManifest.load(path) if os.path.exists(path) else FileManifest(root)
+        if manifest.root != root:
+            manifest = FileManifest(root)
+        rescanned = manifest.refresh()
+        manifest.save(path)
+        print(f"manifest {path}: {len(manifest.dirs)} directories, {rescanned} rescanned")
+    if utils.is_dist_avail_and_initialized():
+        dist.barrier()
+    if not utils.is_main_process():
+        manifest = FileManifest.load(path)
+    return manifest
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from functools import partial
 
 from timm.models.layers import DropPath, trunc_normal_
+from .state_dict_compat import remap_stage_state_dict
 
 
 
@@ -304,10 +305,12 @@ class encoder(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, res_conv, s,
                         num_med_block=num_med_block
@@ -323,7 +326,7 @@ class encoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s,
                         num_med_block=num_med_block
@@ -339,7 +342,7 @@ class encoder(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s,
                         num_med_block=num_med_block, last_fusion=last_fusion
@@ -367,6 +370,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -384,8 +391,8 @@ class encoder(nn.Module):
         x = self.conv_1(x_base, return_x_2=False)
 
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x = eval('self.conv_trans_' + str(i))(x)
+        for block in self.conv_trans:
+            x = block(x)
 
 
         x_p = self.pooling(x).flatten(1)
@@ -428,11 +435,13 @@ class decoder(nn.Module):
         init_stage = 0  # 0
         fin_stage = init_stage
         fin_stage = fin_stage + depth // 3  # 4
+        self.first_stage = 0
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_1_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_1_channel, res_conv, s,
                         num_med_block=num_med_block, decode=True
@@ -447,7 +456,7 @@ class decoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, 
                         num_med_block=num_med_block, decode=True
@@ -465,7 +474,7 @@ class decoder(nn.Module):
             last_fusion = True if i == fin_stage - 1 else False
             res_conv = True if i == init_stage or last_fusion else False
             channel = stage_3_channel // 2 if i == fin_stage - 1 else stage_3_channel
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, channel, res_conv, s,
                         num_med_block=num_med_block, last_fusion=last_fusion, decode=True
@@ -509,6 +518,10 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -521,8 +534,8 @@ class decoder(nn.Module):
         x = self.frist_up(x)
 
         # 1 ~ final 
-        for i in range(self.fin_stage):
-            x = eval('self.conv_trans_' + str(i))(x)
+        for block in self.conv_trans:
+            x = block(x)
 
         x = self.conv_last(x, return_x_2=False)
         return x
@@ -564,7 +577,7 @@ class decoder(nn.Module):
 class auto_encoder_cnn(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384, base_channel=64, channel_ratio_encoder=4, channel_ratio_decoder=4,
-                  num_med_block=0, embed_dim=768, depth=12, im_size=224, first_up=2, use_vae=True, num_branch=4, **kwargs):
+                  num_med_block=0, embed_dim=768, depth=12, im_size=224, first_up=2, use_vae=True, num_branch=4, use_decoder=True, **kwargs):
         
         super().__init__()
         self.num_branch = num_branch
@@ -575,10 +588,11 @@ class auto_encoder_cnn(nn.Module):
                                 im_size=im_size, use_vae=use_vae))
 
 
-        for i in range(num_branch):
-            setattr(self, f"decoder_{i}", decoder(patch_size=patch_size, base_channel=base_channel, 
-                               channel_ratio=channel_ratio_decoder, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
-                                im_size=im_size, first_up=first_up))
+        if use_decoder:
+            for i in range(num_branch):
+                setattr(self, f"decoder_{i}", decoder(patch_size=patch_size, base_channel=base_channel, 
+                                   channel_ratio=channel_ratio_decoder, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
+                                    im_size=im_size, first_up=first_up))
 
         self.mlp_mean = nn.Linear(decode_embed * num_branch, decode_embed)
         self.mlp_var = nn.Linear(decode_embed * num_branch, decode_embed) if use_vae else None
@@ -595,6 +609,14 @@ class auto_encoder_cnn(nn.Module):
 
 
 
+    def encode(self, x):
+        """
+        Latent mean of x without running the decoders (what extract.py keeps as the embedding).
+        """
+        mus = [getattr(self, f"encoder_{i}")(x[:, i*3 : i*3+3, :, :])[0] for i in range(self.num_branch)]
+        return self.mlp_mean(torch.cat(mus, 1))
+
+
     def forward(self, x):
         mus = []
         vars = []
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from functools import partial
 
 from timm.models.layers import DropPath, trunc_normal_
+from .state_dict_compat import remap_stage_state_dict
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -425,8 +426,10 @@ class Conformer(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, False, 1, dw_stride=trans_dw_stride, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -444,7 +447,7 @@ class Conformer(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -462,7 +465,7 @@ class Conformer(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 4, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -499,6 +502,10 @@ class Conformer(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -520,8 +527,8 @@ class Conformer(nn.Module):
         x_t = self.trans_1(x_t)
         
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x, x_t = eval('self.conv_trans_' + str(i))(x, x_t)
+        for block in self.conv_trans:
+            x, x_t = block(x, x_t)
 
         # conv classification
         x_p = self.pooling(x).flatten(1)
@@ -596,10 +603,12 @@ class encoder(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride // 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -617,7 +626,7 @@ class encoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 4, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -635,7 +644,7 @@ class encoder(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 8, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -667,6 +676,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -689,8 +702,8 @@ class encoder(nn.Module):
         x_t = self.trans_1(x_t)
     
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x, x_t = eval('self.conv_trans_' + str(i))(x, x_t)
+        for block in self.conv_trans:
+            x, x_t = block(x, x_t)
 
 
         x_p = self.pooling(x).flatten(1)
@@ -741,11 +754,13 @@ class decoder(nn.Module):
         init_stage = 0  # 0
         fin_stage = init_stage
         fin_stage = fin_stage + depth // 3  # 4
+        self.first_stage = 0
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_1_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -762,7 +777,7 @@ class decoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -782,7 +797,7 @@ class decoder(nn.Module):
             last_fusion = True if i == fin_stage - 1 else False
             res_conv = True if i == init_stage or last_fusion else False
             channel = stage_3_channel // 2 if i == fin_stage - 1 else stage_3_channel
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -836,6 +851,10 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -853,8 +872,8 @@ class decoder(nn.Module):
         xt = xt + pos_embed
 
         # 1 ~ final 
-        for i in range(self.fin_stage):
-            x, xt = eval('self.conv_trans_' + str(i))(x, xt)
+        for block in self.conv_trans:
+            x, xt = block(x, xt)
 
         _, _, H, W = x.shape
         x = self.conv_last(x, return_x_2=False)
@@ -901,7 +920,7 @@ class auto_encoder(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384, base_channel=64, channel_ratio=4, num_med_block=0,
                  embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, **kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, use_decoder=True, **kwargs):
         
         super().__init__()
         
@@ -909,14 +928,24 @@ class auto_encoder(nn.Module):
                                channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=embed_dim, depth=depth, 
                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size)
-        self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
-                               channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up)
+        self.decoder = None
+        if use_decoder:
+            self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
+                                   channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up)
+        self.num_branch = 1
 
 
 
 
+    def encode(self, x):
+        """
+        Latent of x without running the decoder (what extract.py keeps as the embedding).
+        """
+        return self.encoder(x)
+
+
     def forward(self, x):
         latent  = self.encoder(x)
         pred = self.decoder(latent)
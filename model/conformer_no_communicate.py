@@ -4,6 +4,8 @@ import torch.nn.functional as F
 from functools import partial
 
 from timm.models.layers import DropPath, trunc_normal_
+from .grad_ckpt import checkpoint_stage
+from .state_dict_compat import remap_stage_state_dict
 
 
 
@@ -425,10 +427,12 @@ class encoder(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride // 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -446,7 +450,7 @@ class encoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 4, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -464,7 +468,7 @@ class encoder(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 8, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -473,6 +477,7 @@ class encoder(nn.Module):
                     )
             )
         self.fin_stage = fin_stage
+        self.grad_ckpt_stages = set()  # conv_trans stages recomputed in backward, see set_grad_checkpointing
 
         trunc_normal_(self.cls_token, std=.02)
 
@@ -495,6 +500,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -516,8 +525,11 @@ class encoder(nn.Module):
         x_t = self.trans_1(x_t)
     
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x, x_t = eval('self.conv_trans_' + str(i))(x, x_t)
+        for i, block in enumerate(self.conv_trans, self.first_stage):
+            if i in self.grad_ckpt_stages and self.training and torch.is_grad_enabled():
+                x, x_t = checkpoint_stage(block, x, x_t)
+            else:
+                x, x_t = block(x, x_t)
 
 
         x_p = self.pooling(x).flatten(1)
@@ -567,11 +579,13 @@ class decoder(nn.Module):
         init_stage = 0  # 0
         fin_stage = init_stage
         fin_stage = fin_stage + depth // 3  # 4
+        self.first_stage = 0
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_1_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -588,7 +602,7 @@ class decoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -608,7 +622,7 @@ class decoder(nn.Module):
             last_fusion = True if i == fin_stage - 1 else False
             res_conv = True if i == init_stage or last_fusion else False
             channel = stage_3_channel // 2 if i == fin_stage - 1 else stage_3_channel
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -618,6 +632,7 @@ class decoder(nn.Module):
             )
         
         self.fin_stage = fin_stage
+        self.grad_ckpt_stages = set()  # conv_trans stages recomputed in backward, see set_grad_checkpointing
         self.dw_stride = trans_dw_stride * 2 * 2 * 2 * 2
 
 
@@ -661,6 +676,10 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -676,8 +695,11 @@ class decoder(nn.Module):
         xt = torch.cat([cls_tokens, xt], 1)
 
         # 1 ~ final 
-        for i in range(self.fin_stage):
-            x, xt = eval('self.conv_trans_' + str(i))(x, xt)
+        for i, block in enumerate(self.conv_trans, self.first_stage):
+            if i in self.grad_ckpt_stages and self.training and torch.is_grad_enabled():
+                x, xt = checkpoint_stage(block, x, xt)
+            else:
+                x, xt = block(x, xt)
 
         _, _, H, W = x.shape
         x = self.conv_last(x, return_x_2=False)
@@ -725,7 +747,7 @@ class auto_encoder_no_comm(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384, base_channel=64, channel_ratio=4, num_med_block=0,
                 embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_vae=False, **kwargs):
+                drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_vae=False, use_decoder=True, **kwargs):
         
         super().__init__()
 
@@ -737,11 +759,12 @@ class auto_encoder_no_comm(nn.Module):
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, use_vae=use_vae))
 
 
-        for i in range(num_branch):
-            setattr(self, f"decoder_{i}", decoder(patch_size=patch_size, base_channel=base_channel, 
-                               channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up))
+        if use_decoder:
+            for i in range(num_branch):
+                setattr(self, f"decoder_{i}", decoder(patch_size=patch_size, base_channel=base_channel, 
+                                   channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up))
 
 
 
@@ -749,6 +772,17 @@ class auto_encoder_no_comm(nn.Module):
         self.mlp_var = nn.Linear(decode_embed * 4, decode_embed) if use_vae else None
 
 
+    @torch.jit.ignore
+    def set_grad_checkpointing(self, encoder_stages=(), decoder_stages=()):
+        """
+        Recompute the given conv_trans stages of every branch's encoder / decoder in the backward
+        pass instead of keeping their activations alive (training only).
+        """
+        for i in range(self.num_branch):
+            getattr(self, f"encoder_{i}").grad_ckpt_stages = set(encoder_stages)
+            if hasattr(self, f"decoder_{i}"):
+                getattr(self, f"decoder_{i}").grad_ckpt_stages = set(decoder_stages)
+
     def sample(self, mu, log_var):
         if log_var is not None:
             var = torch.exp(0.5 * log_var)
@@ -760,6 +794,14 @@ class auto_encoder_no_comm(nn.Module):
 
 
 
+    def encode(self, x):
+        """
+        Latent mean of x without running the decoders (what extract.py keeps as the embedding).
+        """
+        mus = [getattr(self, f"encoder_{i}")(x[:, i*3 : i*3+3, :, :])[0] for i in range(self.num_branch)]
+        return self.mlp_mean(torch.cat(mus, 1))
+
+
     def forward(self, x):
         mus = []
         vars = []
@@ -0,0 +1,43 @@
+"""
+Activation checkpointing of the conv_trans stages, see set_grad_checkpointing of the share / split /
+no-comm autoencoders.
+"""
+import contextlib
+
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    """
+    The BatchNorm layers of module keep normalizing with the batch statistics, but leave their
+    running_mean / running_var (momentum 0) and num_batches_tracked untouched.
+    """
+    bns = [m for m in module.modules() if isinstance(m, _BatchNorm) and m.training and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, count) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(count)
+
+
+def checkpoint_stage(block, *args):
+    """
+    Non-reentrant checkpoint(block, *args). The recomputation in the backward pass runs with
+    frozen BatchNorm stats, so the running stats are updated once per step, as without it.
+    """
+    calls = []
+
+    def run(*args):
+        calls.append(None)
+        if len(calls) == 1:
+            return block(*args)
+        with frozen_bn_stats(block):
+            return block(*args)
+
+    return checkpoint(run, *args, use_reentrant=False)
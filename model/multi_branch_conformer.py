@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from functools import partial
 
 from timm.models.layers import DropPath, trunc_normal_
+from .state_dict_compat import merge_branch_state_dict, remap_stage_state_dict
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -71,30 +72,51 @@ class Block(nn.Module):
         return x
 
 
-class ConvBlockSingle(nn.Module):
+class BranchLayerNorm(nn.Module):
+    """ LayerNorm with its own affine parameters per branch, x: [B, num_branch, N, C]
+    """
+
+    def __init__(self, dim, num_branch=4, eps=1e-6):
+        super(BranchLayerNorm, self).__init__()
+        self.dim = dim
+        self.num_branch = num_branch
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_branch * dim))
+        self.bias = nn.Parameter(torch.zeros(num_branch * dim))
+
+    def forward(self, x):
+        x = F.layer_norm(x, (self.dim,), eps=self.eps)
+        return x * self.weight.view(self.num_branch, 1, self.dim) + self.bias.view(self.num_branch, 1, self.dim)
+
+
+class ConvBlock(nn.Module):
+    """ num_branch bottleneck blocks side by side, every branch on its own slice of the channels.
+    The branches are run as grouped convolutions (groups=num_branch) in a single call.
+    """
 
     def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None):
-        super(ConvBlockSingle, self).__init__()
+                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
+        super(ConvBlock, self).__init__()
+        self.num_branch = num_branch
 
         expansion = 4
         med_planes = outplanes // expansion if outplanes > expansion else outplanes
 
-        self.conv1 = nn.Conv2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.Conv2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.Conv2d(med_planes, med_planes, kernel_size=3, stride=stride, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.Conv2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=stride, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.Conv2d(med_planes, outplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(outplanes)
+        self.conv3 = nn.Conv2d(med_planes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(outplanes * num_branch)
         self.act3 = act_layer()
 
         if res_conv:
-            self.residual_conv = nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=stride, padding=0, bias=False)
-            self.residual_bn = norm_layer(outplanes)
+            self.residual_conv = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=stride, padding=0, groups=num_branch, bias=False)
+            self.residual_bn = norm_layer(outplanes * num_branch)
 
         self.res_conv = res_conv
         self.drop_block = drop_block
@@ -103,6 +125,11 @@ class ConvBlockSingle(nn.Module):
     def zero_init_last_bn(self):
         nn.init.zeros_(self.bn3.weight)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_{}.", prefix, self.num_branch)
+        # shared with ConvBlockDecode / Med_ConvBlock, hence no super()
+        nn.Module._load_from_state_dict(self, state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, x_t=None, return_x_2=True):
         residual = x
 
@@ -124,7 +151,9 @@ class ConvBlockSingle(nn.Module):
             x = self.drop_block(x)
 
         if self.drop_path is not None:
-            x = self.drop_path(x)
+            # one drop decision per sample and branch, as with separate blocks
+            B, C, H, W = x.shape
+            x = self.drop_path(x.reshape(B * self.num_branch, C // self.num_branch, H, W)).reshape(B, C, H, W)
 
         if self.res_conv:
             residual = self.residual_conv(residual)
@@ -139,132 +168,41 @@ class ConvBlockSingle(nn.Module):
             return x
 
 
-class ConvBlock(nn.Module):
+class ConvBlockDecode(nn.Module):
+    """ Transposed-convolution counterpart of ConvBlock, also grouped per branch.
+    """
 
     def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
                  norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlock, self).__init__()
+        super(ConvBlockDecode, self).__init__()
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", ConvBlockSingle(inplanes, outplanes, stride, res_conv, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
-
-    def forward(self, x, x_t=None, return_x_2=True):
-        xs = []
-        x2s = []
-        cpb = x.shape[1] // self.num_branch
-        spb = x_t.shape[1] // self.num_branch if x_t is not None else 0
-        for i in range(self.num_branch):
-            _x, _x2 = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :], x_t[:, spb*i : spb*i+spb, :] if x_t is not None else x_t, True)
-            xs.append(_x)
-            x2s.append(_x2)
-        if return_x_2: 
-            return torch.cat(xs, 1), torch.cat(x2s, 1)  
-        else:
-            return torch.cat(xs, 1)
-
-
-
-class ConvBlockDecodeSingle(nn.Module):
-
-    def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None):
-        super(ConvBlockDecodeSingle, self).__init__()
 
         expansion = 4
         med_planes = outplanes // expansion if outplanes > expansion else outplanes
 
-        self.conv1 = nn.ConvTranspose2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.ConvTranspose2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.ConvTranspose2d(med_planes, med_planes, kernel_size=3, stride=stride, output_padding=stride-1, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.ConvTranspose2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=stride, output_padding=stride-1, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.ConvTranspose2d(med_planes, outplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(outplanes)
+        self.conv3 = nn.ConvTranspose2d(med_planes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(outplanes * num_branch)
         self.act3 = act_layer()
 
         if res_conv:
-            self.residual_conv = nn.ConvTranspose2d(inplanes, outplanes, kernel_size=1, stride=stride, output_padding=stride-1, padding=0, bias=False)
-            self.residual_bn = norm_layer(outplanes)
+            self.residual_conv = nn.ConvTranspose2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=stride, output_padding=stride-1, padding=0, groups=num_branch, bias=False)
+            self.residual_bn = norm_layer(outplanes * num_branch)
 
         self.res_conv = res_conv
         self.drop_block = drop_block
         self.drop_path = drop_path
 
-    def zero_init_last_bn(self):
-        nn.init.zeros_(self.bn3.weight)
-
-    def forward(self, x, x_t=None, return_x_2=True):
-        residual = x
-
-        x = self.conv1(x)
-        x = self.bn1(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act1(x)
-
-        x = self.conv2(x) if x_t is None else self.conv2(x + x_t)
-        x = self.bn2(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x2 = self.act2(x)
-
-        x = self.conv3(x2)
-        x = self.bn3(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-
-        if self.drop_path is not None:
-            x = self.drop_path(x)
-
-        if self.res_conv:
-            residual = self.residual_conv(residual)
-            residual = self.residual_bn(residual)
-
-        x += residual
-        x = self.act3(x)
-
-        if return_x_2:
-            return x, x2
-        else:
-            return x
-
-
-
-class ConvBlockDecode(nn.Module):
-
-    def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlockDecode, self).__init__()
-        self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", ConvBlockDecodeSingle(inplanes, outplanes, stride, res_conv, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
-
-    def forward(self, x, x_t=None, return_x_2=True):    
-        xs = []
-        x2s = []
-        cpb = x.shape[1] // self.num_branch
-        spb = x_t.shape[1] // self.num_branch if x_t is not None else 0
-        for i in range(self.num_branch):
-            _x, _x2 = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :], x_t[:, spb*i : spb*i+spb, :] if x_t is not None else x_t, True)
-            xs.append(_x)
-            x2s.append(_x2)
-        if return_x_2: 
-            return torch.cat(xs, 1), torch.cat(x2s, 1)  
-        else:
-            return torch.cat(xs, 1)
+    zero_init_last_bn = ConvBlock.zero_init_last_bn
+    _load_from_state_dict = ConvBlock._load_from_state_dict
+    forward = ConvBlock.forward
 
 
 class FCUDown(nn.Module):
@@ -276,30 +214,36 @@ class FCUDown(nn.Module):
         super(FCUDown, self).__init__()
         self.dw_stride = dw_stride
         self.num_branch = num_branch
- 
-        for i in range(num_branch):
-            setattr(self, f"conv_project_{i}", nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=1, padding=0))
-            setattr(self, f"ln_{i}", norm_layer(outplanes))
 
+        self.conv_project = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch)
+        self.ln = BranchLayerNorm(outplanes, num_branch=num_branch, eps=norm_layer(outplanes).eps)
 
         self.sample_pooling = nn.AvgPool2d(kernel_size=dw_stride, stride=dw_stride)
 
         self.act = act_layer()
 
-    def forward(self, x, x_t):
-        xs = []
-        cpb = x.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x = getattr(self, f"conv_project_{i}")(x[:, i*cpb : i*cpb + cpb, :, :])
-            _x = self.sample_pooling(_x).flatten(2).transpose(1, 2)
-            _x = getattr(self, f"ln_{i}")(_x)
-            xs.append(_x)
-        x = torch.cat(xs, 1)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_project_{}.", prefix + "conv_project.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "ln_{}.", prefix + "ln.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def project(self, x):
+        """ the grouped 1x1 projection on [B, num_branch, N, C_in] tokens as one batched matmul
+        """
+        w = self.conv_project.weight.view(self.num_branch, -1, x.shape[-1])
+        return torch.matmul(x, w.transpose(1, 2)) + self.conv_project.bias.view(self.num_branch, 1, -1)
+
+    def forward(self, x, x_t):
+        # a 1x1 projection commutes with average pooling, pooling first projects dw_stride ** 2 fewer pixels
+        x = self.sample_pooling(x)
+        B, C, H, W = x.shape
+        # [B, num_branch * C, H, W] -> branch-major tokens [B, num_branch * H * W, C]
+        x = x.reshape(B, self.num_branch, C // self.num_branch, H * W).transpose(2, 3)
+        x = self.ln(self.project(x)).flatten(1, 2)
 
         x = self.act(x)
 
-        x = torch.cat([x_t[:, 0][:, None, :], x], dim=1)
+        x = torch.cat([x_t[:, 0:1], x], dim=1)
 
         return x
 
@@ -314,112 +258,62 @@ class FCUUp(nn.Module):
 
         self.up_stride = up_stride
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_project_{i}", nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=1, padding=0))
-            setattr(self, f"bn_{i}", norm_layer(outplanes))
-
+        self.conv_project = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch)
+        self.bn = norm_layer(outplanes * num_branch)
 
         self.act = act_layer()
 
-    def forward(self, x, H, W):
-        B, _, C = x.shape
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_project_{}.", prefix + "conv_project.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "bn_{}.", prefix + "bn.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        x_r = x[:, 1:]
-        xrs = []
-        cpb = x_r.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x_r = x_r[:, i*cpb : i*cpb + cpb, :].transpose(1, 2).reshape(B, C, H, W)
-            _x_r = getattr(self, f"conv_project_{i}")(_x_r)
-            _x_r = self.act(getattr(self, f"bn_{i}")(_x_r))
-            _x_r = F.interpolate(_x_r, size=(H * self.up_stride, W * self.up_stride))
-            xrs.append(_x_r)
-        _x_r = torch.cat(xrs, 1)
+    project = FCUDown.project
 
+    def forward(self, x, H, W):
+        B, _, C = x.shape
 
+        # branch-major tokens [B, num_branch * H * W, C] -> [B, num_branch * C_out, H, W]
+        x_r = self.project(x[:, 1:].reshape(B, self.num_branch, H * W, C))
+        x_r = x_r.transpose(2, 3).reshape(B, -1, H, W)
+        x_r = self.act(self.bn(x_r))
 
-        return _x_r
+        return F.interpolate(x_r, size=(H * self.up_stride, W * self.up_stride))
 
 
-class Med_ConvBlockSingle(nn.Module):
-    """ special case for Convblock with down sampling,
+class Med_ConvBlock(nn.Module):
+    """ special case for Convblock with down sampling, grouped per branch like ConvBlock
     """
     def __init__(self, inplanes, act_layer=nn.LeakyReLU, groups=1, norm_layer=partial(nn.BatchNorm2d, eps=1e-6),
-                 drop_block=None, drop_path=None):
+                 drop_block=None, drop_path=None, num_branch=4):
 
-        super(Med_ConvBlockSingle, self).__init__()
+        super(Med_ConvBlock, self).__init__()
+        self.num_branch = num_branch
 
         expansion = 4
         med_planes = inplanes // expansion
 
-        self.conv1 = nn.Conv2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.Conv2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.Conv2d(med_planes, med_planes, kernel_size=3, stride=1, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.Conv2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=1, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.Conv2d(med_planes, inplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(inplanes)
+        self.conv3 = nn.Conv2d(med_planes * num_branch, inplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(inplanes * num_branch)
         self.act3 = act_layer()
 
         self.drop_block = drop_block
         self.drop_path = drop_path
+        self.res_conv = False
 
-    def zero_init_last_bn(self):
-        nn.init.zeros_(self.bn3.weight)
-
-    def forward(self, x):
-        residual = x
-
-        x = self.conv1(x)
-        x = self.bn1(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act1(x)
-
-        x = self.conv2(x)
-        x = self.bn2(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act2(x)
-
-        x = self.conv3(x)
-        x = self.bn3(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-
-        if self.drop_path is not None:
-            x = self.drop_path(x)
-
-        x += residual
-        x = self.act3(x)
-
-        return x
-
-
-
-class Med_ConvBlock(nn.Module):
-
-    def __init__(self, inplanes, act_layer=nn.LeakyReLU, groups=1, norm_layer=partial(nn.BatchNorm2d, eps=1e-6),
-                 drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlockDecode, self).__init__()
-        self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", Med_ConvBlockSingle(inplanes, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
+    zero_init_last_bn = ConvBlock.zero_init_last_bn
+    _load_from_state_dict = ConvBlock._load_from_state_dict
 
     def forward(self, x):
-        xs = []
-        cpb = x.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :])
-            xs.append(_x)
-        return torch.cat(xs, 1)
+        return ConvBlock.forward(self, x, return_x_2=False)
 
 
 class ConvTransBlock(nn.Module):
@@ -550,10 +444,12 @@ class encoder(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride // 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -571,7 +467,7 @@ class encoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 4, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -589,7 +485,7 @@ class encoder(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 8, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -621,6 +517,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -655,8 +555,8 @@ class encoder(nn.Module):
 
     
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x, x_t = eval('self.conv_trans_' + str(i))(x, x_t)
+        for block in self.conv_trans:
+            x, x_t = block(x, x_t)
 
 
         x_p = self.pooling(x).flatten(1)
@@ -717,11 +617,13 @@ class decoder(nn.Module):
         init_stage = 0  # 0
         fin_stage = init_stage
         fin_stage = fin_stage + depth // 3  # 4
+        self.first_stage = 0
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_1_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -738,7 +640,7 @@ class decoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -758,7 +660,7 @@ class decoder(nn.Module):
             last_fusion = True if i == fin_stage - 1 else False
             res_conv = True if i == init_stage or last_fusion else False
             channel = stage_3_channel // 2 if i == fin_stage - 1 else stage_3_channel
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -812,6 +714,10 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -837,8 +743,8 @@ class decoder(nn.Module):
         xt = xt + pos_embed
 
         # 1 ~ final 
-        for i in range(self.fin_stage):
-            x, xt = eval('self.conv_trans_' + str(i))(x, xt)
+        for block in self.conv_trans:
+            x, xt = block(x, xt)
 
         _, _, H, W = x.shape
         x = self.conv_last(x, return_x_2=False)
@@ -885,21 +791,31 @@ class auto_encoder_multi_branch(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384, base_channel=64, channel_ratio=4, num_med_block=0,
                  embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, **kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_decoder=True, **kwargs):
         
         super().__init__()
         self.encoder = encoder(patch_size=patch_size, in_chans=in_chans, decode_embed=decode_embed, base_channel=base_channel, 
                                channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=embed_dim, depth=depth, 
                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, num_branch=num_branch)
-        self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
-                               channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up, num_branch=num_branch)
+        self.decoder = None
+        if use_decoder:
+            self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
+                                   channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up, num_branch=num_branch)
+        self.num_branch = num_branch
 
 
 
 
+    def encode(self, x):
+        """
+        Latent of x without running the decoder (what extract.py keeps as the embedding).
+        """
+        return self.encoder(x)
+
+
     def forward(self, x):
         latent  = self.encoder(x)
         pred = self.decoder(latent)
@@ -5,6 +5,9 @@ from functools import partial
 import random
 
 from timm.models.layers import DropPath, trunc_normal_
+from .grad_ckpt import checkpoint_stage
+from .pos_embed import pos_embed_for
+from .state_dict_compat import merge_branch_state_dict, remap_stage_state_dict
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -42,9 +45,9 @@ class Attention_Sep(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, valid=None):
         B, N, C = x.shape
-        spb = N // self.num_branch
+        spb = (N-1) // self.num_branch
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # [B, num_head, seq_len, dim]
 
@@ -52,23 +55,34 @@ class Attention_Sep(nn.Module):
 
         # CLS collect information 
         cls = x[:, 0:1, :]
-        cls = F.scaled_dot_product_attention(q[:, :, 0:1, :], k, v, scale=self.scale, dropout_p=self.attn_drop).reshape(B, 1, C) + cls
+        # valid [B, num_branch, spb] marks the packed tokens that are not padding (sparse token mode)
+        cls_mask = branch_mask = None
+        if valid is not None:
+            cls_valid = valid.new_ones(B, 1)
+            cls_mask = torch.cat([cls_valid, valid.flatten(1)], 1).view(B, 1, 1, N)
+            branch_mask = torch.cat([cls_valid.expand(B, self.num_branch).unsqueeze(-1), valid], 2).view(B * self.num_branch, 1, 1, 1 + spb)
+        cls = F.scaled_dot_product_attention(q[:, :, 0:1, :], k, v, attn_mask=cls_mask, scale=self.scale, dropout_p=self.attn_drop).reshape(B, 1, C) + cls
         qkv_cls = self.qkv(cls).reshape(B, 1, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q_cls, k_cls, v_cls = qkv_cls[0], qkv_cls[1], qkv_cls[2]  # [B, num_head, 1, dim]
 
         
 
-        xs = []
-        for i in range(self.num_branch):
-            xs.append(F.scaled_dot_product_attention(torch.cat((q_cls, q[:, :, 1+i*spb:1+i*spb+spb, :]), 2), 
-                                                     torch.cat((k_cls, k[:, :, 1+i*spb:1+i*spb+spb, :]), 2), 
-                                                     torch.cat((v_cls, v[:, :, 1+i*spb:1+i*spb+spb, :]), 2), 
-                                                     scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :].reshape(B, (N-1) // self.num_branch, C))
-
+        # every branch attends over [updated CLS, its own tokens]: one SDPA call on a
+        # [B * num_branch, num_head, 1 + spb, dim] batch instead of one call per branch
+        H, D = self.num_heads, C // self.num_heads
 
+        def per_branch(t, t_cls):
+            return torch.cat((t_cls.unsqueeze(1).expand(B, self.num_branch, H, 1, D),
+                              t[:, :, 1:].reshape(B, H, self.num_branch, spb, D).transpose(1, 2)), 3) \
+                .reshape(B * self.num_branch, H, 1 + spb, D)
 
+        # called once per tensor rather than unpacked from a generator, which torch.export cannot trace
+        q, k, v = per_branch(q, q_cls), per_branch(k, k_cls), per_branch(v, v_cls)
+        xs = F.scaled_dot_product_attention(q, k, v, attn_mask=branch_mask, scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :]
+        # same (head-major) flattening of every branch's [num_head, spb, dim] output as before
+        xs = xs.reshape(B, self.num_branch * spb, C)
 
-        x = torch.cat([cls] + xs, 1)
+        x = torch.cat([cls, xs], 1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -113,135 +127,101 @@ class Block(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x):
-        x = x + self.drop_path(self.attn(self.norm1(x)))
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
-        return x
-
-
-
-class ConvBlockSingle(nn.Module):
-
-    def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None):
-        super(ConvBlockSingle, self).__init__()
-
-        expansion = 4
-        med_planes = outplanes // expansion if outplanes > expansion else outplanes
-
-        self.conv1 = nn.Conv2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
-        self.act1 = act_layer()
-
-        self.conv2 = nn.Conv2d(med_planes, med_planes, kernel_size=3, stride=stride, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
-        self.act2 = act_layer()
+    def forward(self, x, packing=None):
+        if packing is None:
+            x = x + self.drop_path(self.attn(self.norm1(x)))
+            x = x + self.drop_path(self.mlp(self.norm2(x)))
+            return x
 
-        self.conv3 = nn.Conv2d(med_planes, outplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(outplanes)
-        self.act3 = act_layer()
+        # sparse token mode: only the kept tokens go through the block, the others pass unchanged
+        valid, idx = packing
+        packed = pack_tokens(x, idx)
+        packed = packed + self.drop_path(self.attn(self.norm1(packed), valid))
+        packed = packed + self.drop_path(self.mlp(self.norm2(packed)))
+        return unpack_tokens(x, packed, valid, idx)
 
-        if res_conv:
-            self.residual_conv = nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=stride, padding=0, bias=False)
-            self.residual_bn = norm_layer(outplanes)
 
-        self.res_conv = res_conv
-        self.drop_block = drop_block
-        self.drop_path = drop_path
+def token_packing(keep):
+    """
+    keep: [B, num_branch, spb] bool. Orders the kept tokens of every branch first and cuts all
+    branches to the largest kept count K, returning the [B, num_branch, K] mask of the entries
+    that are not padding and the [B, num_branch, K] source index of each. Built once per encoder
+    forward (reading K back is its only host sync) and shared by all the blocks.
+    """
+    K = max(int(keep.sum(-1).max()), 1)
+    idx = torch.argsort((~keep).to(torch.uint8), dim=-1, stable=True)[..., :K]
+    return keep.gather(-1, idx), idx
 
-    def zero_init_last_bn(self):
-        nn.init.zeros_(self.bn3.weight)
 
-    def forward(self, x, x_t=None, return_x_2=True):
-        residual = x
+def pack_tokens(x, idx):
+    """
+    x: branch-major tokens [B, 1 + num_branch * spb, C] -> the [B, 1 + num_branch * K, C] tokens
+    at the token_packing index idx, CLS first.
+    """
+    B, num_branch, K = idx.shape
+    C = x.shape[-1]
+    tokens = x[:, 1:].reshape(B, num_branch, -1, C).gather(2, idx.unsqueeze(-1).expand(-1, -1, -1, C))
+    return torch.cat([x[:, 0:1], tokens.flatten(1, 2)], 1)
 
-        x = self.conv1(x)
-        x = self.bn1(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act1(x)
 
-        x = self.conv2(x) if x_t is None else self.conv2(x + x_t)
-        x = self.bn2(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x2 = self.act2(x)
+def unpack_tokens(x, packed, valid, idx):
+    """
+    Scatters the valid tokens of pack_tokens' output back into x; dropped tokens keep their value.
+    """
+    B, num_branch, K = idx.shape
+    C = x.shape[-1]
+    tokens = x[:, 1:].reshape(B, num_branch, -1, C)
+    idx = idx.unsqueeze(-1).expand(-1, -1, -1, C)
+    new = torch.where(valid.unsqueeze(-1), packed[:, 1:].reshape(B, num_branch, K, C), tokens.gather(2, idx))
+    return torch.cat([packed[:, 0:1], tokens.scatter(2, idx, new).flatten(1, 2)], 1)
 
-        x = self.conv3(x2)
-        x = self.bn3(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
 
-        if self.drop_path is not None:
-            x = self.drop_path(x)
 
-        if self.res_conv:
-            residual = self.residual_conv(residual)
-            residual = self.residual_bn(residual)
+class BranchLayerNorm(nn.Module):
+    """ LayerNorm with its own affine parameters per branch, x: [B, num_branch, N, C]
+    """
 
-        x += residual
-        x = self.act3(x)
+    def __init__(self, dim, num_branch=4, eps=1e-6):
+        super(BranchLayerNorm, self).__init__()
+        self.dim = dim
+        self.num_branch = num_branch
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_branch * dim))
+        self.bias = nn.Parameter(torch.zeros(num_branch * dim))
 
-        if return_x_2:
-            return x, x2
-        else:
-            return x
+    def forward(self, x):
+        x = F.layer_norm(x, (self.dim,), eps=self.eps)
+        return x * self.weight.view(self.num_branch, 1, self.dim) + self.bias.view(self.num_branch, 1, self.dim)
 
 
 class ConvBlock(nn.Module):
+    """ num_branch bottleneck blocks side by side, every branch on its own slice of the channels.
+    The branches are run as grouped convolutions (groups=num_branch) in a single call.
+    """
 
     def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
                  norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
         super(ConvBlock, self).__init__()
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", ConvBlockSingle(inplanes, outplanes, stride, res_conv, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
-
-    def forward(self, x, x_t=None, return_x_2=True):
-        xs = []
-        x2s = []
-        cpb = x.shape[1] // self.num_branch
-        spb = x_t.shape[1] // self.num_branch if x_t is not None else 0
-        for i in range(self.num_branch):
-            _x, _x2 = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :], x_t[:, spb*i : spb*i+spb, :] if x_t is not None else x_t, True)
-            xs.append(_x)
-            x2s.append(_x2)
-        if return_x_2: 
-            return torch.cat(xs, 1), torch.cat(x2s, 1)  
-        else:
-            return torch.cat(xs, 1)
-
-
-
-class ConvBlockDecodeSingle(nn.Module):
-
-    def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None):
-        super(ConvBlockDecodeSingle, self).__init__()
 
         expansion = 4
         med_planes = outplanes // expansion if outplanes > expansion else outplanes
 
-        self.conv1 = nn.ConvTranspose2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.Conv2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.ConvTranspose2d(med_planes, med_planes, kernel_size=3, stride=stride, output_padding=stride-1, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.Conv2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=stride, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.ConvTranspose2d(med_planes, outplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(outplanes)
+        self.conv3 = nn.Conv2d(med_planes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(outplanes * num_branch)
         self.act3 = act_layer()
 
         if res_conv:
-            self.residual_conv = nn.ConvTranspose2d(inplanes, outplanes, kernel_size=1, stride=stride, output_padding=stride-1, padding=0, bias=False)
-            self.residual_bn = norm_layer(outplanes)
+            self.residual_conv = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=stride, padding=0, groups=num_branch, bias=False)
+            self.residual_bn = norm_layer(outplanes * num_branch)
 
         self.res_conv = res_conv
         self.drop_block = drop_block
@@ -250,6 +230,11 @@ class ConvBlockDecodeSingle(nn.Module):
     def zero_init_last_bn(self):
         nn.init.zeros_(self.bn3.weight)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_{}.", prefix, self.num_branch)
+        # shared with ConvBlockDecode / Med_ConvBlock, hence no super()
+        nn.Module._load_from_state_dict(self, state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, x_t=None, return_x_2=True):
         residual = x
 
@@ -271,7 +256,9 @@ class ConvBlockDecodeSingle(nn.Module):
             x = self.drop_block(x)
 
         if self.drop_path is not None:
-            x = self.drop_path(x)
+            # one drop decision per sample and branch, as with separate blocks
+            B, C, H, W = x.shape
+            x = self.drop_path(x.reshape(B * self.num_branch, C // self.num_branch, H, W)).reshape(B, C, H, W)
 
         if self.res_conv:
             residual = self.residual_conv(residual)
@@ -286,34 +273,41 @@ class ConvBlockDecodeSingle(nn.Module):
             return x
 
 
-
 class ConvBlockDecode(nn.Module):
+    """ Transposed-convolution counterpart of ConvBlock, also grouped per branch.
+    """
 
     def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
                  norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
         super(ConvBlockDecode, self).__init__()
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", ConvBlockDecodeSingle(inplanes, outplanes, stride, res_conv, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
 
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
+        expansion = 4
+        med_planes = outplanes // expansion if outplanes > expansion else outplanes
 
-    def forward(self, x, x_t=None, return_x_2=True):    
-        xs = []
-        x2s = []
-        cpb = x.shape[1] // self.num_branch
-        spb = x_t.shape[1] // self.num_branch if x_t is not None else 0
-        for i in range(self.num_branch):
-            _x, _x2 = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :], x_t[:, spb*i : spb*i+spb, :] if x_t is not None else x_t, True)
-            xs.append(_x)
-            x2s.append(_x2)
-        if return_x_2: 
-            return torch.cat(xs, 1), torch.cat(x2s, 1)  
-        else:
-            return torch.cat(xs, 1)
+        self.conv1 = nn.ConvTranspose2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
+        self.act1 = act_layer()
+
+        self.conv2 = nn.ConvTranspose2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=stride, output_padding=stride-1, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
+        self.act2 = act_layer()
+
+        self.conv3 = nn.ConvTranspose2d(med_planes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(outplanes * num_branch)
+        self.act3 = act_layer()
+
+        if res_conv:
+            self.residual_conv = nn.ConvTranspose2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=stride, output_padding=stride-1, padding=0, groups=num_branch, bias=False)
+            self.residual_bn = norm_layer(outplanes * num_branch)
+
+        self.res_conv = res_conv
+        self.drop_block = drop_block
+        self.drop_path = drop_path
+
+    zero_init_last_bn = ConvBlock.zero_init_last_bn
+    _load_from_state_dict = ConvBlock._load_from_state_dict
+    forward = ConvBlock.forward
 
 
 class FCUDown(nn.Module):
@@ -325,26 +319,32 @@ class FCUDown(nn.Module):
         super(FCUDown, self).__init__()
         self.dw_stride = dw_stride
         self.num_branch = num_branch
- 
-        for i in range(num_branch):
-            setattr(self, f"conv_project_{i}", nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=1, padding=0))
-            setattr(self, f"ln_{i}", norm_layer(outplanes))
 
+        self.conv_project = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch)
+        self.ln = BranchLayerNorm(outplanes, num_branch=num_branch, eps=norm_layer(outplanes).eps)
 
         self.sample_pooling = nn.AvgPool2d(kernel_size=dw_stride, stride=dw_stride)
 
         self.act = act_layer()
 
-    def forward(self, x, x_t):
-        xs = []
-        cpb = x.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x = getattr(self, f"conv_project_{i}")(x[:, i*cpb : i*cpb + cpb, :, :])
-            _x = self.sample_pooling(_x).flatten(2).transpose(1, 2)
-            _x = getattr(self, f"ln_{i}")(_x)
-            xs.append(_x)
-        x = torch.cat(xs, 1)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_project_{}.", prefix + "conv_project.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "ln_{}.", prefix + "ln.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project(self, x):
+        """ the grouped 1x1 projection on [B, num_branch, N, C_in] tokens as one batched matmul
+        """
+        w = self.conv_project.weight.view(self.num_branch, -1, x.shape[-1])
+        return torch.matmul(x, w.transpose(1, 2)) + self.conv_project.bias.view(self.num_branch, 1, -1)
 
+    def forward(self, x, x_t):
+        # a 1x1 projection commutes with average pooling, pooling first projects dw_stride ** 2 fewer pixels
+        x = self.sample_pooling(x)
+        B, C, H, W = x.shape
+        # [B, num_branch * C, H, W] -> branch-major tokens [B, num_branch * H * W, C]
+        x = x.reshape(B, self.num_branch, C // self.num_branch, H * W).transpose(2, 3)
+        x = self.ln(self.project(x)).flatten(1, 2)
 
         x = self.act(x)
 
@@ -363,112 +363,62 @@ class FCUUp(nn.Module):
 
         self.up_stride = up_stride
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_project_{i}", nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=1, padding=0))
-            setattr(self, f"bn_{i}", norm_layer(outplanes))
-
+        self.conv_project = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch)
+        self.bn = norm_layer(outplanes * num_branch)
 
         self.act = act_layer()
 
-    def forward(self, x, H, W):
-        B, _, C = x.shape
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_project_{}.", prefix + "conv_project.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "bn_{}.", prefix + "bn.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        x_r = x[:, 1:]
-        xrs = []
-        cpb = x_r.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x_r = x_r[:, i*cpb : i*cpb + cpb, :].transpose(1, 2).reshape(B, C, H, W)
-            _x_r = getattr(self, f"conv_project_{i}")(_x_r)
-            _x_r = self.act(getattr(self, f"bn_{i}")(_x_r))
-            _x_r = F.interpolate(_x_r, size=(H * self.up_stride, W * self.up_stride))
-            xrs.append(_x_r)
-        _x_r = torch.cat(xrs, 1)
+    project = FCUDown.project
 
+    def forward(self, x, H, W):
+        B, _, C = x.shape
 
+        # branch-major tokens [B, num_branch * H * W, C] -> [B, num_branch * C_out, H, W]
+        x_r = self.project(x[:, 1:].reshape(B, self.num_branch, H * W, C))
+        x_r = x_r.transpose(2, 3).reshape(B, -1, H, W)
+        x_r = self.act(self.bn(x_r))
 
-        return _x_r
+        return F.interpolate(x_r, size=(H * self.up_stride, W * self.up_stride))
 
 
-class Med_ConvBlockSingle(nn.Module):
-    """ special case for Convblock with down sampling,
+class Med_ConvBlock(nn.Module):
+    """ special case for Convblock with down sampling, grouped per branch like ConvBlock
     """
     def __init__(self, inplanes, act_layer=nn.LeakyReLU, groups=1, norm_layer=partial(nn.BatchNorm2d, eps=1e-6),
-                 drop_block=None, drop_path=None):
+                 drop_block=None, drop_path=None, num_branch=4):
 
-        super(Med_ConvBlockSingle, self).__init__()
+        super(Med_ConvBlock, self).__init__()
+        self.num_branch = num_branch
 
         expansion = 4
         med_planes = inplanes // expansion
 
-        self.conv1 = nn.Conv2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.Conv2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.Conv2d(med_planes, med_planes, kernel_size=3, stride=1, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.Conv2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=1, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.Conv2d(med_planes, inplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(inplanes)
+        self.conv3 = nn.Conv2d(med_planes * num_branch, inplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(inplanes * num_branch)
         self.act3 = act_layer()
 
         self.drop_block = drop_block
         self.drop_path = drop_path
+        self.res_conv = False
 
-    def zero_init_last_bn(self):
-        nn.init.zeros_(self.bn3.weight)
+    zero_init_last_bn = ConvBlock.zero_init_last_bn
+    _load_from_state_dict = ConvBlock._load_from_state_dict
 
     def forward(self, x):
-        residual = x
-
-        x = self.conv1(x)
-        x = self.bn1(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act1(x)
-
-        x = self.conv2(x)
-        x = self.bn2(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act2(x)
-
-        x = self.conv3(x)
-        x = self.bn3(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-
-        if self.drop_path is not None:
-            x = self.drop_path(x)
-
-        x += residual
-        x = self.act3(x)
-
-        return x
-
-
-
-class Med_ConvBlock(nn.Module):
-
-    def __init__(self, inplanes, act_layer=nn.LeakyReLU, groups=1, norm_layer=partial(nn.BatchNorm2d, eps=1e-6),
-                 drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlockDecode, self).__init__()
-        self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", Med_ConvBlockSingle(inplanes, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
-
-    def forward(self, x):
-        xs = []
-        cpb = x.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :])
-            xs.append(_x)
-        return torch.cat(xs, 1)
+        return ConvBlock.forward(self, x, return_x_2=False)
 
 
 class ConvTransBlock(nn.Module):
@@ -517,13 +467,13 @@ class ConvTransBlock(nn.Module):
         self.num_med_block = num_med_block
         self.last_fusion = last_fusion
 
-    def forward(self, x, x_t):
+    def forward(self, x, x_t, packing=None):
         x, x2 = self.cnn_block(x)
 
 
         _, _, H, W = x2.shape
         x_st = self.squeeze_block(x2, x_t)
-        x_t = self.trans_block(x_st + x_t)
+        x_t = self.trans_block(x_st + x_t, packing)
 
         if self.num_med_block > 0:
             for m in self.med_block:
@@ -563,6 +513,9 @@ class encoder(nn.Module):
         num_patches = ((im_size // patch_size) ** 2) * 4
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        # other input sizes interpolate pos_embed from this grid, see pos_embed_for
+        self.pos_grid = (im_size // patch_size, im_size // patch_size)
+        self.pos_cache = {}
         self.trans_dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
 
         # Latent output
@@ -579,6 +532,8 @@ class encoder(nn.Module):
 
         # Stem stage: get the feature maps by conv block (copied form resnet.py)
         self.num_branch = num_branch
+        self.patch_size = patch_size
+        self.sparse_tokens = 0.  # min foreground coverage of a kept patch, see set_sparse_tokens
         for i in range(num_branch):
             setattr(self, f"conv1_{i}", nn.Conv2d(in_chans, 64, kernel_size=7, stride=2, padding=3, bias=False))
             setattr(self, f"bn1_{i}", nn.BatchNorm2d(64))
@@ -603,10 +558,12 @@ class encoder(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride // 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -624,7 +581,7 @@ class encoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 4, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -642,7 +599,7 @@ class encoder(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 8, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -651,6 +608,7 @@ class encoder(nn.Module):
                     )
             )
         self.fin_stage = fin_stage
+        self.grad_ckpt_stages = set()  # conv_trans stages recomputed in backward, see set_grad_checkpointing
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
@@ -674,15 +632,30 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
 
 
+    def token_keep(self, x):
+        """
+        [B, num_branch, patches] mask of the patches whose share of foreground pixels reaches
+        sparse_tokens. x is normalize(msk * im), so the thresholded background is -1 up to the
+        error of the antialiased resize; only pixels at least one 8-bit step (2 / 255 after the
+        normalization) above it count as foreground.
+        """
+        B, _, H, W = x.shape
+        fg = (x > -1 + 2 / 255).view(B, self.num_branch, -1, H, W).any(2).to(x.dtype)
+        return F.avg_pool2d(fg, self.patch_size).flatten(2) >= self.sparse_tokens
+
     def forward(self, x):
         B = x.shape[0]
         cls_tokens = self.cls_token.expand(B, -1, -1)
-        pos_embed = self.pos_embed.repeat(B, 1, 1)
+        packing = token_packing(self.token_keep(x)) if self.sparse_tokens > 0 else None
         
 
         # pdb.set_trace()
@@ -700,16 +673,21 @@ class encoder(nn.Module):
         cpb = x_base.shape[1] // self.num_branch
         x_t = []
         for i in range(self.num_branch):
-            x_t.append(getattr(self, f"trans_patch_conv_{i}")(x_base[:, i*cpb : i*cpb + cpb, :, :]).flatten(2).transpose(1, 2))
+            x_t.append(getattr(self, f"trans_patch_conv_{i}")(x_base[:, i*cpb : i*cpb + cpb, :, :]))
+        grid = x_t[0].shape[-2:]
+        x_t = [t.flatten(2).transpose(1, 2) for t in x_t]
         
         x_t = torch.cat([cls_tokens] + x_t, dim=1)
-        x_t = x_t + pos_embed
-        x_t = self.trans_1(x_t)
+        x_t = x_t + pos_embed_for(self, grid)
+        x_t = self.trans_1(x_t, packing)
 
     
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x, x_t = eval('self.conv_trans_' + str(i))(x, x_t)
+        for i, block in enumerate(self.conv_trans, self.first_stage):
+            if i in self.grad_ckpt_stages and self.training and torch.is_grad_enabled():
+                x, x_t = checkpoint_stage(block, x, x_t, packing)
+            else:
+                x, x_t = block(x, x_t, packing)
 
 
         x_p = self.pooling(x)
@@ -751,6 +729,8 @@ class decoder(nn.Module):
         self.im_size = im_size
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_grid = (im_size // patch_size, im_size // patch_size)
+        self.pos_cache = {}
 
 
         # Latent to map
@@ -775,11 +755,13 @@ class decoder(nn.Module):
         init_stage = 0  # 0
         fin_stage = init_stage
         fin_stage = fin_stage + depth // 3  # 4
+        self.first_stage = 0
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_1_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -796,7 +778,7 @@ class decoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -816,7 +798,7 @@ class decoder(nn.Module):
             last_fusion = True if i == fin_stage - 1 else False
             res_conv = True if i == init_stage or last_fusion else False
             channel = stage_3_channel // 2 if i == fin_stage - 1 else stage_3_channel
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -826,6 +808,7 @@ class decoder(nn.Module):
             )
         
         self.fin_stage = fin_stage
+        self.grad_ckpt_stages = set()  # conv_trans stages recomputed in backward, see set_grad_checkpointing
         self.dw_stride = trans_dw_stride * 2 * 2 * 2 * 2
 
 
@@ -870,33 +853,49 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
 
 
-    def forward(self, x):
+    def forward(self, x, size=None):
+        """
+        size: (H, W) of the reconstruction, multiples of 16; im_size when not given.
+        """
         B, _ = x.shape
         cls_tokens = self.cls_token.expand(B, -1, -1)
-        pos_embed = self.pos_embed.repeat(B, 1, 1)
         x = self.first_fc(x).reshape(B, -1, (self.im_size // (16 * self.first_up_scale)), (self.im_size // (16 * self.first_up_scale)))
 
         xs = []
         for i in range(self.num_branch):
             xs.append(getattr(self, f"first_cnn_{i}")(x))
         x = torch.cat(xs, 1)
-        x = self.frist_up(x)
+        if size is not None and tuple(size) != (self.im_size, self.im_size):
+            # the rest of the decoder upsamples 16x, so resize straight to the size / 16 grid in place of
+            # frist_up: it need not be a whole multiple of the first_fc grid (e.g. 112 = 3.5 * 32)
+            x = F.interpolate(x, size=(size[0] // 16, size[1] // 16), mode='bilinear', align_corners=False)
+        else:
+            x = self.frist_up(x)
 
         xt = []
         cpb = x.shape[1] // self.num_branch
         for i in range(self.num_branch):
-            xt.append(getattr(self, f"trans_patch_conv_{i}")(x[:, i*cpb : i*cpb + cpb, :, :]).flatten(2).transpose(1, 2))
+            xt.append(getattr(self, f"trans_patch_conv_{i}")(x[:, i*cpb : i*cpb + cpb, :, :]))
+        grid = xt[0].shape[-2:]
+        xt = [t.flatten(2).transpose(1, 2) for t in xt]
         xt = torch.cat([cls_tokens] + xt, 1)
-        xt = xt + pos_embed
+        xt = xt + pos_embed_for(self, grid)
 
         # 1 ~ final 
-        for i in range(self.fin_stage):
-            x, xt = eval('self.conv_trans_' + str(i))(x, xt)
+        for i, block in enumerate(self.conv_trans, self.first_stage):
+            if i in self.grad_ckpt_stages and self.training and torch.is_grad_enabled():
+                x, xt = checkpoint_stage(block, x, xt)
+            else:
+                x, xt = block(x, xt)
 
         _, _, H, W = x.shape
         x = self.conv_last(x, return_x_2=False)
@@ -943,7 +942,7 @@ class auto_encoder_multi_cnn_attn_share(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384, base_channel=64, channel_ratio=4, num_med_block=0,
                  embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_vae=True, **kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_vae=True, use_decoder=True, **kwargs):
         
         super().__init__()
         
@@ -951,13 +950,35 @@ class auto_encoder_multi_cnn_attn_share(nn.Module):
                                channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=embed_dim, depth=depth, 
                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, num_branch=num_branch, use_vae=use_vae)
-        self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
-                               channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up, num_branch=num_branch)
+        self.decoder = None
+        if use_decoder:
+            self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
+                                   channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up, num_branch=num_branch)
+        self.num_branch = num_branch
 
 
 
+    @torch.jit.ignore
+    def set_grad_checkpointing(self, encoder_stages=(), decoder_stages=()):
+        """
+        Recompute the given conv_trans stages of the encoder / decoder in the backward pass
+        instead of keeping their activations alive (training only).
+        """
+        self.encoder.grad_ckpt_stages = set(encoder_stages)
+        if self.decoder is not None:
+            self.decoder.grad_ckpt_stages = set(decoder_stages)
+
+    @torch.jit.ignore
+    def set_sparse_tokens(self, min_coverage=0.):
+        """
+        Run the encoder's transformer blocks only on the patches with at least min_coverage
+        foreground pixels (0 runs all of them). The other patch tokens skip the blocks and still
+        reach the FCU bridges.
+        """
+        self.encoder.sparse_tokens = min_coverage
+
     def sample(self, mu, log_var):
         if log_var is not None:
             var = torch.exp(0.5 * log_var)
@@ -968,9 +989,17 @@ class auto_encoder_multi_cnn_attn_share(nn.Module):
         return z
 
 
+    def encode(self, x):
+        """
+        Latent mean of x without running the decoder (what extract.py keeps as the embedding).
+        """
+        mu, _ = self.encoder(x)
+        return mu
+
+
     def forward(self, x):
         mu, var  = self.encoder(x)
         latent = self.sample(mu, var)
-        pred = self.decoder(latent)
+        pred = self.decoder(latent, x.shape[-2:])
         return pred, mu, var
         
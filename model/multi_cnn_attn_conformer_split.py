@@ -5,6 +5,9 @@ from functools import partial
 import random
 
 from timm.models.layers import DropPath, trunc_normal_
+from .grad_ckpt import checkpoint_stage
+from .pos_embed import pos_embed_for
+from .state_dict_compat import merge_branch_state_dict, remap_stage_state_dict
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -32,6 +35,29 @@ class Mlp(nn.Module):
 
 
 
+class BranchLinear(nn.Module):
+    """ num_branch independent nn.Linear layers applied to branch-major x: [num_branch, N, in_features]
+    as one batched matmul, the weights of branch i are rows i * out_features : (i + 1) * out_features.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, num_branch=4):
+        super(BranchLinear, self).__init__()
+        self.num_branch = num_branch
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(num_branch * out_features, in_features))
+        self.bias = nn.Parameter(torch.zeros(num_branch * out_features)) if bias else None
+        for i in range(num_branch):
+            # same init as the separate nn.Linear layers
+            nn.init.kaiming_uniform_(self.weight[i * out_features : (i + 1) * out_features], a=5 ** 0.5)
+
+    def forward(self, x):
+        weight = self.weight.view(self.num_branch, self.out_features, self.in_features).transpose(1, 2)
+        if self.bias is None:
+            return torch.bmm(x, weight)
+        return torch.baddbmm(self.bias.view(self.num_branch, 1, self.out_features), x, weight)
+
+
 class Attention_Sep(nn.Module):
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., num_branch=4):
         super().__init__()
@@ -42,9 +68,8 @@ class Attention_Sep(nn.Module):
         self.num_branch = num_branch
         self.attn_drop = attn_drop
 
-        for i in range(num_branch):
-            setattr(self, f"qkv_{i}", nn.Linear(dim, dim * 3, bias=qkv_bias))
-            setattr(self, f"proj_{i}", nn.Linear(dim, dim))
+        self.qkv = BranchLinear(dim, dim * 3, bias=qkv_bias, num_branch=num_branch)
+        self.proj = BranchLinear(dim, dim, num_branch=num_branch)
         
         self.fuse_q = nn.Linear(dim, dim, bias=qkv_bias)
         self.fuse_kv = nn.Linear(dim, dim * 2, bias=qkv_bias)
@@ -52,6 +77,11 @@ class Attention_Sep(nn.Module):
 
         self.proj_drop = nn.Dropout(proj_drop)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "qkv_{}.", prefix + "qkv.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "proj_{}.", prefix + "proj.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         B, N, C = x.shape
         spb = (N-1) // self.num_branch
@@ -67,20 +97,21 @@ class Attention_Sep(nn.Module):
 
         
 
-        xs = []
-        for i in range(self.num_branch):
-            qkv = getattr(self, f"qkv_{i}")(torch.cat((cls, x[:, 1+i*spb:1+i*spb+spb, :]), 1)).reshape(B, spb+1, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-            q, k, v = qkv[0], qkv[1], qkv[2]  # [B, num_head, seq_len, dim]
-
-            _x = F.scaled_dot_product_attention(q, k, v, 
-                                                     scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :].reshape(B, (N-1) // self.num_branch, C)
-            
-            xs.append(getattr(self, f"proj_{i}")(_x))
+        # every branch attends over [updated CLS, its own tokens] with its own qkv / proj weights,
+        # batched branch-major over [num_branch, B, 1 + spb, C]
+        xs = torch.cat((cls.unsqueeze(0).expand(self.num_branch, B, 1, C), x[:, 1:].reshape(B, self.num_branch, spb, C).transpose(0, 1)), 2)
+        qkv = self.qkv(xs.reshape(self.num_branch, B * (spb+1), C))
+        qkv = qkv.reshape(self.num_branch * B, spb+1, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]  # [num_branch * B, num_head, seq_len, dim]
+        xs = F.scaled_dot_product_attention(q, k, v, scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :]
+        # same (head-major) flattening of every branch's [num_head, spb, dim] output as before
+        xs = self.proj(xs.reshape(self.num_branch, B * spb, C))
+        xs = xs.reshape(self.num_branch, B, spb, C).transpose(0, 1).reshape(B, self.num_branch * spb, C)
 
         cls = self.cls_proj(cls)
 
 
-        x = torch.cat([cls] + xs, 1)
+        x = torch.cat([cls, xs], 1)
         x = self.proj_drop(x)
         return x
 
@@ -127,30 +158,51 @@ class Block(nn.Module):
 
 
 
-class ConvBlockSingle(nn.Module):
+class BranchLayerNorm(nn.Module):
+    """ LayerNorm with its own affine parameters per branch, x: [B, num_branch, N, C]
+    """
+
+    def __init__(self, dim, num_branch=4, eps=1e-6):
+        super(BranchLayerNorm, self).__init__()
+        self.dim = dim
+        self.num_branch = num_branch
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_branch * dim))
+        self.bias = nn.Parameter(torch.zeros(num_branch * dim))
+
+    def forward(self, x):
+        x = F.layer_norm(x, (self.dim,), eps=self.eps)
+        return x * self.weight.view(self.num_branch, 1, self.dim) + self.bias.view(self.num_branch, 1, self.dim)
+
+
+class ConvBlock(nn.Module):
+    """ num_branch bottleneck blocks side by side, every branch on its own slice of the channels.
+    The branches are run as grouped convolutions (groups=num_branch) in a single call.
+    """
 
     def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None):
-        super(ConvBlockSingle, self).__init__()
+                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
+        super(ConvBlock, self).__init__()
+        self.num_branch = num_branch
 
         expansion = 4
         med_planes = outplanes // expansion if outplanes > expansion else outplanes
 
-        self.conv1 = nn.Conv2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.Conv2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.Conv2d(med_planes, med_planes, kernel_size=3, stride=stride, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.Conv2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=stride, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.Conv2d(med_planes, outplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(outplanes)
+        self.conv3 = nn.Conv2d(med_planes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(outplanes * num_branch)
         self.act3 = act_layer()
 
         if res_conv:
-            self.residual_conv = nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=stride, padding=0, bias=False)
-            self.residual_bn = norm_layer(outplanes)
+            self.residual_conv = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=stride, padding=0, groups=num_branch, bias=False)
+            self.residual_bn = norm_layer(outplanes * num_branch)
 
         self.res_conv = res_conv
         self.drop_block = drop_block
@@ -159,6 +211,11 @@ class ConvBlockSingle(nn.Module):
     def zero_init_last_bn(self):
         nn.init.zeros_(self.bn3.weight)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_{}.", prefix, self.num_branch)
+        # shared with ConvBlockDecode / Med_ConvBlock, hence no super()
+        nn.Module._load_from_state_dict(self, state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, x_t=None, return_x_2=True):
         residual = x
 
@@ -180,7 +237,9 @@ class ConvBlockSingle(nn.Module):
             x = self.drop_block(x)
 
         if self.drop_path is not None:
-            x = self.drop_path(x)
+            # one drop decision per sample and branch, as with separate blocks
+            B, C, H, W = x.shape
+            x = self.drop_path(x.reshape(B * self.num_branch, C // self.num_branch, H, W)).reshape(B, C, H, W)
 
         if self.res_conv:
             residual = self.residual_conv(residual)
@@ -195,132 +254,41 @@ class ConvBlockSingle(nn.Module):
             return x
 
 
-class ConvBlock(nn.Module):
+class ConvBlockDecode(nn.Module):
+    """ Transposed-convolution counterpart of ConvBlock, also grouped per branch.
+    """
 
     def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
                  norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlock, self).__init__()
+        super(ConvBlockDecode, self).__init__()
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", ConvBlockSingle(inplanes, outplanes, stride, res_conv, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
-
-    def forward(self, x, x_t=None, return_x_2=True):
-        xs = []
-        x2s = []
-        cpb = x.shape[1] // self.num_branch
-        spb = x_t.shape[1] // self.num_branch if x_t is not None else 0
-        for i in range(self.num_branch):
-            _x, _x2 = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :], x_t[:, spb*i : spb*i+spb, :] if x_t is not None else x_t, True)
-            xs.append(_x)
-            x2s.append(_x2)
-        if return_x_2: 
-            return torch.cat(xs, 1), torch.cat(x2s, 1)  
-        else:
-            return torch.cat(xs, 1)
-
-
-
-class ConvBlockDecodeSingle(nn.Module):
-
-    def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None):
-        super(ConvBlockDecodeSingle, self).__init__()
 
         expansion = 4
         med_planes = outplanes // expansion if outplanes > expansion else outplanes
 
-        self.conv1 = nn.ConvTranspose2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.ConvTranspose2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.ConvTranspose2d(med_planes, med_planes, kernel_size=3, stride=stride, output_padding=stride-1, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.ConvTranspose2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=stride, output_padding=stride-1, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.ConvTranspose2d(med_planes, outplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(outplanes)
+        self.conv3 = nn.ConvTranspose2d(med_planes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(outplanes * num_branch)
         self.act3 = act_layer()
 
         if res_conv:
-            self.residual_conv = nn.ConvTranspose2d(inplanes, outplanes, kernel_size=1, stride=stride, output_padding=stride-1, padding=0, bias=False)
-            self.residual_bn = norm_layer(outplanes)
+            self.residual_conv = nn.ConvTranspose2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=stride, output_padding=stride-1, padding=0, groups=num_branch, bias=False)
+            self.residual_bn = norm_layer(outplanes * num_branch)
 
         self.res_conv = res_conv
         self.drop_block = drop_block
         self.drop_path = drop_path
 
-    def zero_init_last_bn(self):
-        nn.init.zeros_(self.bn3.weight)
-
-    def forward(self, x, x_t=None, return_x_2=True):
-        residual = x
-
-        x = self.conv1(x)
-        x = self.bn1(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act1(x)
-
-        x = self.conv2(x) if x_t is None else self.conv2(x + x_t)
-        x = self.bn2(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x2 = self.act2(x)
-
-        x = self.conv3(x2)
-        x = self.bn3(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-
-        if self.drop_path is not None:
-            x = self.drop_path(x)
-
-        if self.res_conv:
-            residual = self.residual_conv(residual)
-            residual = self.residual_bn(residual)
-
-        x += residual
-        x = self.act3(x)
-
-        if return_x_2:
-            return x, x2
-        else:
-            return x
-
-
-
-class ConvBlockDecode(nn.Module):
-
-    def __init__(self, inplanes, outplanes, stride=1, res_conv=False, act_layer=nn.LeakyReLU, groups=1,
-                 norm_layer=partial(nn.BatchNorm2d, eps=1e-6), drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlockDecode, self).__init__()
-        self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", ConvBlockDecodeSingle(inplanes, outplanes, stride, res_conv, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
-
-    def forward(self, x, x_t=None, return_x_2=True):    
-        xs = []
-        x2s = []
-        cpb = x.shape[1] // self.num_branch
-        spb = x_t.shape[1] // self.num_branch if x_t is not None else 0
-        for i in range(self.num_branch):
-            _x, _x2 = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :], x_t[:, spb*i : spb*i+spb, :] if x_t is not None else x_t, True)
-            xs.append(_x)
-            x2s.append(_x2)
-        if return_x_2: 
-            return torch.cat(xs, 1), torch.cat(x2s, 1)  
-        else:
-            return torch.cat(xs, 1)
+    zero_init_last_bn = ConvBlock.zero_init_last_bn
+    _load_from_state_dict = ConvBlock._load_from_state_dict
+    forward = ConvBlock.forward
 
 
 class FCUDown(nn.Module):
@@ -332,26 +300,32 @@ class FCUDown(nn.Module):
         super(FCUDown, self).__init__()
         self.dw_stride = dw_stride
         self.num_branch = num_branch
- 
-        for i in range(num_branch):
-            setattr(self, f"conv_project_{i}", nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=1, padding=0))
-            setattr(self, f"ln_{i}", norm_layer(outplanes))
 
+        self.conv_project = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch)
+        self.ln = BranchLayerNorm(outplanes, num_branch=num_branch, eps=norm_layer(outplanes).eps)
 
         self.sample_pooling = nn.AvgPool2d(kernel_size=dw_stride, stride=dw_stride)
 
         self.act = act_layer()
 
-    def forward(self, x, x_t):
-        xs = []
-        cpb = x.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x = getattr(self, f"conv_project_{i}")(x[:, i*cpb : i*cpb + cpb, :, :])
-            _x = self.sample_pooling(_x).flatten(2).transpose(1, 2)
-            _x = getattr(self, f"ln_{i}")(_x)
-            xs.append(_x)
-        x = torch.cat(xs, 1)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_project_{}.", prefix + "conv_project.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "ln_{}.", prefix + "ln.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def project(self, x):
+        """ the grouped 1x1 projection on [B, num_branch, N, C_in] tokens as one batched matmul
+        """
+        w = self.conv_project.weight.view(self.num_branch, -1, x.shape[-1])
+        return torch.matmul(x, w.transpose(1, 2)) + self.conv_project.bias.view(self.num_branch, 1, -1)
+
+    def forward(self, x, x_t):
+        # a 1x1 projection commutes with average pooling, pooling first projects dw_stride ** 2 fewer pixels
+        x = self.sample_pooling(x)
+        B, C, H, W = x.shape
+        # [B, num_branch * C, H, W] -> branch-major tokens [B, num_branch * H * W, C]
+        x = x.reshape(B, self.num_branch, C // self.num_branch, H * W).transpose(2, 3)
+        x = self.ln(self.project(x)).flatten(1, 2)
 
         x = self.act(x)
 
@@ -370,112 +344,62 @@ class FCUUp(nn.Module):
 
         self.up_stride = up_stride
         self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_project_{i}", nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=1, padding=0))
-            setattr(self, f"bn_{i}", norm_layer(outplanes))
-
+        self.conv_project = nn.Conv2d(inplanes * num_branch, outplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch)
+        self.bn = norm_layer(outplanes * num_branch)
 
         self.act = act_layer()
 
-    def forward(self, x, H, W):
-        B, _, C = x.shape
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "conv_project_{}.", prefix + "conv_project.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "bn_{}.", prefix + "bn.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        x_r = x[:, 1:]
-        xrs = []
-        cpb = x_r.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x_r = x_r[:, i*cpb : i*cpb + cpb, :].transpose(1, 2).reshape(B, C, H, W)
-            _x_r = getattr(self, f"conv_project_{i}")(_x_r)
-            _x_r = self.act(getattr(self, f"bn_{i}")(_x_r))
-            _x_r = F.interpolate(_x_r, size=(H * self.up_stride, W * self.up_stride))
-            xrs.append(_x_r)
-        _x_r = torch.cat(xrs, 1)
+    project = FCUDown.project
 
+    def forward(self, x, H, W):
+        B, _, C = x.shape
 
+        # branch-major tokens [B, num_branch * H * W, C] -> [B, num_branch * C_out, H, W]
+        x_r = self.project(x[:, 1:].reshape(B, self.num_branch, H * W, C))
+        x_r = x_r.transpose(2, 3).reshape(B, -1, H, W)
+        x_r = self.act(self.bn(x_r))
 
-        return _x_r
+        return F.interpolate(x_r, size=(H * self.up_stride, W * self.up_stride))
 
 
-class Med_ConvBlockSingle(nn.Module):
-    """ special case for Convblock with down sampling,
+class Med_ConvBlock(nn.Module):
+    """ special case for Convblock with down sampling, grouped per branch like ConvBlock
     """
     def __init__(self, inplanes, act_layer=nn.LeakyReLU, groups=1, norm_layer=partial(nn.BatchNorm2d, eps=1e-6),
-                 drop_block=None, drop_path=None):
+                 drop_block=None, drop_path=None, num_branch=4):
 
-        super(Med_ConvBlockSingle, self).__init__()
+        super(Med_ConvBlock, self).__init__()
+        self.num_branch = num_branch
 
         expansion = 4
         med_planes = inplanes // expansion
 
-        self.conv1 = nn.Conv2d(inplanes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn1 = norm_layer(med_planes)
+        self.conv1 = nn.Conv2d(inplanes * num_branch, med_planes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn1 = norm_layer(med_planes * num_branch)
         self.act1 = act_layer()
 
-        self.conv2 = nn.Conv2d(med_planes, med_planes, kernel_size=3, stride=1, groups=groups, padding=1, bias=False)
-        self.bn2 = norm_layer(med_planes)
+        self.conv2 = nn.Conv2d(med_planes * num_branch, med_planes * num_branch, kernel_size=3, stride=1, groups=groups * num_branch, padding=1, bias=False)
+        self.bn2 = norm_layer(med_planes * num_branch)
         self.act2 = act_layer()
 
-        self.conv3 = nn.Conv2d(med_planes, inplanes, kernel_size=1, stride=1, padding=0, bias=False)
-        self.bn3 = norm_layer(inplanes)
+        self.conv3 = nn.Conv2d(med_planes * num_branch, inplanes * num_branch, kernel_size=1, stride=1, padding=0, groups=num_branch, bias=False)
+        self.bn3 = norm_layer(inplanes * num_branch)
         self.act3 = act_layer()
 
         self.drop_block = drop_block
         self.drop_path = drop_path
+        self.res_conv = False
 
-    def zero_init_last_bn(self):
-        nn.init.zeros_(self.bn3.weight)
-
-    def forward(self, x):
-        residual = x
-
-        x = self.conv1(x)
-        x = self.bn1(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act1(x)
-
-        x = self.conv2(x)
-        x = self.bn2(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-        x = self.act2(x)
-
-        x = self.conv3(x)
-        x = self.bn3(x)
-        if self.drop_block is not None:
-            x = self.drop_block(x)
-
-        if self.drop_path is not None:
-            x = self.drop_path(x)
-
-        x += residual
-        x = self.act3(x)
-
-        return x
-
-
-
-class Med_ConvBlock(nn.Module):
-
-    def __init__(self, inplanes, act_layer=nn.LeakyReLU, groups=1, norm_layer=partial(nn.BatchNorm2d, eps=1e-6),
-                 drop_block=None, drop_path=None, num_branch=4):
-        super(ConvBlockDecode, self).__init__()
-        self.num_branch = num_branch
-        for i in range(num_branch):
-            setattr(self, f"conv_{i}", Med_ConvBlockSingle(inplanes, act_layer, groups,
-                 norm_layer, drop_block, drop_path))
-
-    def zero_init_last_bn(self):
-        for i in range(self.num_branch):
-            nn.init.zeros_(getattr(getattr(self, f"conv_{i}"), "bn3")).weight
+    zero_init_last_bn = ConvBlock.zero_init_last_bn
+    _load_from_state_dict = ConvBlock._load_from_state_dict
 
     def forward(self, x):
-        xs = []
-        cpb = x.shape[1] // self.num_branch
-        for i in range(self.num_branch):
-            _x = getattr(self, f"conv_{i}")(x[:, cpb*i : cpb*i+cpb, :, :])
-            xs.append(_x)
-        return torch.cat(xs, 1)
+        return ConvBlock.forward(self, x, return_x_2=False)
 
 
 class ConvTransBlock(nn.Module):
@@ -570,6 +494,9 @@ class encoder(nn.Module):
         num_patches = ((im_size // patch_size) ** 2) * 4
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        # other input sizes interpolate pos_embed from this grid, see pos_embed_for
+        self.pos_grid = (im_size // patch_size, im_size // patch_size)
+        self.pos_cache = {}
         self.trans_dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
 
         # Latent output
@@ -610,10 +537,12 @@ class encoder(nn.Module):
         # 2~4 stage
         init_stage = 2
         fin_stage = depth // 3 + 1
+        self.first_stage = 2
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         stage_1_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride // 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -631,7 +560,7 @@ class encoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 4, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -649,7 +578,7 @@ class encoder(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 8, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -658,6 +587,7 @@ class encoder(nn.Module):
                     )
             )
         self.fin_stage = fin_stage
+        self.grad_ckpt_stages = set()  # conv_trans stages recomputed in backward, see set_grad_checkpointing
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
@@ -665,9 +595,9 @@ class encoder(nn.Module):
         self.apply(self._init_weights)
 
     def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
+        if isinstance(m, (nn.Linear, BranchLinear)):
             trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
+            if isinstance(m, (nn.Linear, BranchLinear)) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
         elif isinstance(m, nn.LayerNorm):
             nn.init.constant_(m.bias, 0)
@@ -681,6 +611,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -689,7 +623,6 @@ class encoder(nn.Module):
     def forward(self, x):
         B = x.shape[0]
         cls_tokens = self.cls_token.expand(B, -1, -1)
-        pos_embed = self.pos_embed.repeat(B, 1, 1)
         
 
         # pdb.set_trace()
@@ -707,16 +640,21 @@ class encoder(nn.Module):
         cpb = x_base.shape[1] // self.num_branch
         x_t = []
         for i in range(self.num_branch):
-            x_t.append(getattr(self, f"trans_patch_conv_{i}")(x_base[:, i*cpb : i*cpb + cpb, :, :]).flatten(2).transpose(1, 2))
+            x_t.append(getattr(self, f"trans_patch_conv_{i}")(x_base[:, i*cpb : i*cpb + cpb, :, :]))
+        grid = x_t[0].shape[-2:]
+        x_t = [t.flatten(2).transpose(1, 2) for t in x_t]
         
         x_t = torch.cat([cls_tokens] + x_t, dim=1)
-        x_t = x_t + pos_embed
+        x_t = x_t + pos_embed_for(self, grid)
         x_t = self.trans_1(x_t)
 
     
         # 2 ~ final 
-        for i in range(2, self.fin_stage):
-            x, x_t = eval('self.conv_trans_' + str(i))(x, x_t)
+        for i, block in enumerate(self.conv_trans, self.first_stage):
+            if i in self.grad_ckpt_stages and self.training and torch.is_grad_enabled():
+                x, x_t = checkpoint_stage(block, x, x_t)
+            else:
+                x, x_t = block(x, x_t)
 
 
         x_p = self.pooling(x)
@@ -758,6 +696,8 @@ class decoder(nn.Module):
         self.im_size = im_size
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_grid = (im_size // patch_size, im_size // patch_size)
+        self.pos_cache = {}
 
 
         # Latent to map
@@ -782,11 +722,13 @@ class decoder(nn.Module):
         init_stage = 0  # 0
         fin_stage = init_stage
         fin_stage = fin_stage + depth // 3  # 4
+        self.first_stage = 0
+        self.conv_trans = nn.ModuleList()  # stage i is self.conv_trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_1_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_1_channel, res_conv, s, dw_stride=trans_dw_stride * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -803,7 +745,7 @@ class decoder(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -823,7 +765,7 @@ class decoder(nn.Module):
             last_fusion = True if i == fin_stage - 1 else False
             res_conv = True if i == init_stage or last_fusion else False
             channel = stage_3_channel // 2 if i == fin_stage - 1 else stage_3_channel
-            self.add_module('conv_trans_' + str(i),
+            self.conv_trans.append(
                     ConvTransBlock(
                         in_channel, channel, res_conv, s, dw_stride=trans_dw_stride * 2 * 2 * 2, embed_dim=embed_dim,
                         num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -833,6 +775,7 @@ class decoder(nn.Module):
             )
         
         self.fin_stage = fin_stage
+        self.grad_ckpt_stages = set()  # conv_trans stages recomputed in backward, see set_grad_checkpointing
         self.dw_stride = trans_dw_stride * 2 * 2 * 2 * 2
 
 
@@ -861,9 +804,9 @@ class decoder(nn.Module):
         self.apply(self._init_weights)
 
     def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
+        if isinstance(m, (nn.Linear, BranchLinear)):
             trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
+            if isinstance(m, (nn.Linear, BranchLinear)) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
         elif isinstance(m, nn.LayerNorm):
             nn.init.constant_(m.bias, 0)
@@ -877,33 +820,49 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "conv_trans_", prefix + "conv_trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
 
 
-    def forward(self, x):
+    def forward(self, x, size=None):
+        """
+        size: (H, W) of the reconstruction, multiples of 16; im_size when not given.
+        """
         B, _ = x.shape
         cls_tokens = self.cls_token.expand(B, -1, -1)
-        pos_embed = self.pos_embed.repeat(B, 1, 1)
         x = self.first_fc(x).reshape(B, -1, (self.im_size // (16 * self.first_up_scale)), (self.im_size // (16 * self.first_up_scale)))
 
         xs = []
         for i in range(self.num_branch):
             xs.append(getattr(self, f"first_cnn_{i}")(x))
         x = torch.cat(xs, 1)
-        x = self.frist_up(x)
+        if size is not None and tuple(size) != (self.im_size, self.im_size):
+            # the rest of the decoder upsamples 16x, so resize straight to the size / 16 grid in place of
+            # frist_up: it need not be a whole multiple of the first_fc grid (e.g. 112 = 3.5 * 32)
+            x = F.interpolate(x, size=(size[0] // 16, size[1] // 16), mode='bilinear', align_corners=False)
+        else:
+            x = self.frist_up(x)
 
         xt = []
         cpb = x.shape[1] // self.num_branch
         for i in range(self.num_branch):
-            xt.append(getattr(self, f"trans_patch_conv_{i}")(x[:, i*cpb : i*cpb + cpb, :, :]).flatten(2).transpose(1, 2))
+            xt.append(getattr(self, f"trans_patch_conv_{i}")(x[:, i*cpb : i*cpb + cpb, :, :]))
+        grid = xt[0].shape[-2:]
+        xt = [t.flatten(2).transpose(1, 2) for t in xt]
         xt = torch.cat([cls_tokens] + xt, 1)
-        xt = xt + pos_embed
+        xt = xt + pos_embed_for(self, grid)
 
         # 1 ~ final 
-        for i in range(self.fin_stage):
-            x, xt = eval('self.conv_trans_' + str(i))(x, xt)
+        for i, block in enumerate(self.conv_trans, self.first_stage):
+            if i in self.grad_ckpt_stages and self.training and torch.is_grad_enabled():
+                x, xt = checkpoint_stage(block, x, xt)
+            else:
+                x, xt = block(x, xt)
 
         _, _, H, W = x.shape
         x = self.conv_last(x, return_x_2=False)
@@ -950,7 +909,7 @@ class auto_encoder_multi_cnn_attn_split(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384, base_channel=64, channel_ratio=4, num_med_block=0,
                  embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_vae=True, **kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, first_up=2, num_branch=4, use_vae=True, use_decoder=True, **kwargs):
         
         super().__init__()
         
@@ -958,13 +917,26 @@ class auto_encoder_multi_cnn_attn_split(nn.Module):
                                channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=embed_dim, depth=depth, 
                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, num_branch=num_branch, use_vae=use_vae)
-        self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
-                               channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up, num_branch=num_branch)
+        self.decoder = None
+        if use_decoder:
+            self.decoder = decoder(patch_size=patch_size, base_channel=base_channel, 
+                                   channel_ratio=channel_ratio, num_med_block=num_med_block,embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, first_up=first_up, num_branch=num_branch)
+        self.num_branch = num_branch
 
 
 
+    @torch.jit.ignore
+    def set_grad_checkpointing(self, encoder_stages=(), decoder_stages=()):
+        """
+        Recompute the given conv_trans stages of the encoder / decoder in the backward pass
+        instead of keeping their activations alive (training only).
+        """
+        self.encoder.grad_ckpt_stages = set(encoder_stages)
+        if self.decoder is not None:
+            self.decoder.grad_ckpt_stages = set(decoder_stages)
+
     def sample(self, mu, log_var):
         if log_var is not None:
             var = torch.exp(0.5 * log_var)
@@ -975,9 +947,17 @@ class auto_encoder_multi_cnn_attn_split(nn.Module):
         return z
 
 
+    def encode(self, x):
+        """
+        Latent mean of x without running the decoder (what extract.py keeps as the embedding).
+        """
+        mu, _ = self.encoder(x)
+        return mu
+
+
     def forward(self, x):
         mu, var  = self.encoder(x)
         latent = self.sample(mu, var)
-        pred = self.decoder(latent)
+        pred = self.decoder(latent, x.shape[-2:])
         return pred, mu, var
         
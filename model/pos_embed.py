@@ -0,0 +1,33 @@
+"""
+Position embeddings of the share/split conformers at token grids other than the one they were
+built for (progressive resolution training, fine-tuning at another --im-size).
+"""
+import torch
+import torch.nn.functional as F
+
+
+def resize_pos_embed(pos_embed, grid, size):
+    """
+    pos_embed [1, 1 + n * gh * gw, C] holds a cls embedding and n branch grids of grid = (gh, gw);
+    bicubically resize every branch grid to size.
+    """
+    C = pos_embed.shape[-1]
+    tokens = pos_embed[:, 1:].reshape(-1, grid[0], grid[1], C).permute(0, 3, 1, 2)
+    tokens = F.interpolate(tokens, size=size, mode='bicubic', align_corners=False)
+    return torch.cat([pos_embed[:, :1], tokens.permute(0, 2, 3, 1).reshape(1, -1, C)], 1)
+
+
+def pos_embed_for(module, size):
+    """
+    module.pos_embed for an h x w patch grid per branch. Outside of training the resized
+    embedding is cached per size until the parameter is updated or moved.
+    """
+    if tuple(size) == module.pos_grid:
+        return module.pos_embed
+    if torch.is_grad_enabled() and module.pos_embed.requires_grad:
+        return resize_pos_embed(module.pos_embed, module.pos_grid, size)
+    stamp = (module.pos_embed.data_ptr(), module.pos_embed._version)
+    cached = module.pos_cache.get(tuple(size))
+    if cached is None or cached[0] != stamp:
+        cached = module.pos_cache[tuple(size)] = (stamp, resize_pos_embed(module.pos_embed, module.pos_grid, size).detach())
+    return cached[1]
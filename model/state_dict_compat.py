@@ -0,0 +1,29 @@
+"""
+Key remapping for checkpoints written before the model refactors, called from the modules'
+_load_from_state_dict hooks.
+"""
+import torch
+
+
+def merge_branch_state_dict(state_dict, old, new, num_branch):
+    """
+    Checkpoints written before the branches were fused hold one copy of every parameter per branch
+    under old.format(i) + name; concatenate them (along dim 0, the output channels / groups) into the
+    single new + name tensor of the grouped layer.
+    """
+    first = old.format(0)
+    for key in [k for k in state_dict if k.startswith(first)]:
+        name = key[len(first):]
+        parts = [state_dict.pop(old.format(i) + name) for i in range(num_branch)]
+        state_dict[new + name] = parts[0] if name.endswith("num_batches_tracked") else torch.cat(parts, 0)
+
+
+def remap_stage_state_dict(state_dict, old, new, first_stage):
+    """
+    Checkpoints written before the stages were held in an nn.ModuleList name stage i old + str(i);
+    rename those keys to new.{i - first_stage} of the list.
+    """
+    for key in [k for k in state_dict if k.startswith(old)]:
+        stage, _, name = key[len(old):].partition(".")
+        if stage.isdigit():
+            state_dict[f"{new}.{int(stage) - first_stage}.{name}"] = state_dict.pop(key)
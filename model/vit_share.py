@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from functools import partial
 
 from timm.models.layers import DropPath, trunc_normal_
+from .state_dict_compat import remap_stage_state_dict
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -45,7 +46,7 @@ class Attention_Sep(nn.Module):
 
     def forward(self, x):
         B, N, C = x.shape
-        spb = N // self.num_branch
+        spb = (N-1) // self.num_branch
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # [B, num_head, seq_len, dim]
 
@@ -59,17 +60,22 @@ class Attention_Sep(nn.Module):
 
         
 
-        xs = []
-        for i in range(self.num_branch):
-            xs.append(F.scaled_dot_product_attention(torch.cat((q_cls, q[:, :, 1+i*spb:1+i*spb+spb, :]), 2), 
-                                                     torch.cat((k_cls, k[:, :, 1+i*spb:1+i*spb+spb, :]), 2), 
-                                                     torch.cat((v_cls, v[:, :, 1+i*spb:1+i*spb+spb, :]), 2), 
-                                                     scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :].reshape(B, (N-1) // self.num_branch, C))
-
+        # every branch attends over [updated CLS, its own tokens]: one SDPA call on a
+        # [B * num_branch, num_head, 1 + spb, dim] batch instead of one call per branch
+        H, D = self.num_heads, C // self.num_heads
 
+        def per_branch(t, t_cls):
+            return torch.cat((t_cls.unsqueeze(1).expand(B, self.num_branch, H, 1, D),
+                              t[:, :, 1:].reshape(B, H, self.num_branch, spb, D).transpose(1, 2)), 3) \
+                .reshape(B * self.num_branch, H, 1 + spb, D)
 
+        # called once per tensor rather than unpacked from a generator, which torch.export cannot trace
+        q, k, v = per_branch(q, q_cls), per_branch(k, k_cls), per_branch(v, v_cls)
+        xs = F.scaled_dot_product_attention(q, k, v, scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :]
+        # same (head-major) flattening of every branch's [num_head, spb, dim] output as before
+        xs = xs.reshape(B, self.num_branch * spb, C)
 
-        x = torch.cat([cls] + xs, 1)
+        x = torch.cat([cls, xs], 1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -139,8 +145,10 @@ class encoder(nn.Module):
         # 1~12 stage
         init_stage = 1
         fin_stage = init_stage + depth
+        self.first_stage = 1
+        self.trans = nn.ModuleList()  # stage i is self.trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
-            self.add_module('trans_' + str(i),
+            self.trans.append(
                     Block(dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, num_branch=num_branch,
                              qk_scale=qk_scale, drop=drop_rate, attn_drop=attn_drop_rate, drop_path=self.trans_dpr[i-1])
             )
@@ -169,6 +177,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "trans_", prefix + "trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -191,8 +203,8 @@ class encoder(nn.Module):
         x_t = self.pos_drop(x_t)
     
         # 1 ~ final 
-        for i in range(1, 13):
-            x_t = eval('self.trans_' + str(i))(x_t)
+        for block in self.trans:
+            x_t = block(x_t)
 
 
 
@@ -228,8 +240,10 @@ class decoder(nn.Module):
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         
+        self.first_stage = 1
+        self.trans = nn.ModuleList()  # stage i is self.trans[i - self.first_stage]
         for i in range(1, 1+depth):
-            self.add_module('trans_' + str(i),
+            self.trans.append(
                     Block(dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias,
                              qk_scale=qk_scale, drop=drop_rate, attn_drop=attn_drop_rate, drop_path=self.trans_dpr[i-1])
             )
@@ -265,6 +279,10 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "trans_", prefix + "trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -278,8 +296,8 @@ class decoder(nn.Module):
 
 
         # 1 ~ final 
-        for i in range(1, 13):
-            x = eval('self.trans_' + str(i))(x)
+        for block in self.trans:
+            x = block(x)
         x = self.decoder_norm(x)
 
         
@@ -327,7 +345,7 @@ class auto_encoder_vit_share(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384,
                  embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, use_vae=True, num_branch=1, **kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, use_vae=True, num_branch=1, use_decoder=True, **kwargs):
         
         super().__init__()
         
@@ -335,10 +353,13 @@ class auto_encoder_vit_share(nn.Module):
                                embed_dim=embed_dim, depth=depth, 
                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, use_vae=use_vae, num_branch=num_branch)
-        self.decoder = decoder(patch_size=patch_size, 
-                              embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, num_branch=num_branch)
+        self.decoder = None
+        if use_decoder:
+            self.decoder = decoder(patch_size=patch_size, 
+                                  embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, num_branch=num_branch)
+        self.num_branch = num_branch
 
     def sample(self, mu, log_var):
         if log_var is not None:
@@ -350,6 +371,14 @@ class auto_encoder_vit_share(nn.Module):
         return z
 
 
+    def encode(self, x):
+        """
+        Latent mean of x without running the decoder (what extract.py keeps as the embedding).
+        """
+        mu, _ = self.encoder(x)
+        return mu
+
+
     def forward(self, x):
         mu, var  = self.encoder(x)
         latent = self.sample(mu, var)
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from functools import partial
 
 from timm.models.layers import DropPath, trunc_normal_
+from .state_dict_compat import merge_branch_state_dict, remap_stage_state_dict
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -25,6 +26,29 @@ class Mlp(nn.Module):
 
 
 
+class BranchLinear(nn.Module):
+    """ num_branch independent nn.Linear layers applied to branch-major x: [num_branch, N, in_features]
+    as one batched matmul, the weights of branch i are rows i * out_features : (i + 1) * out_features.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, num_branch=4):
+        super(BranchLinear, self).__init__()
+        self.num_branch = num_branch
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(num_branch * out_features, in_features))
+        self.bias = nn.Parameter(torch.zeros(num_branch * out_features)) if bias else None
+        for i in range(num_branch):
+            # same init as the separate nn.Linear layers
+            nn.init.kaiming_uniform_(self.weight[i * out_features : (i + 1) * out_features], a=5 ** 0.5)
+
+    def forward(self, x):
+        weight = self.weight.view(self.num_branch, self.out_features, self.in_features).transpose(1, 2)
+        if self.bias is None:
+            return torch.bmm(x, weight)
+        return torch.baddbmm(self.bias.view(self.num_branch, 1, self.out_features), x, weight)
+
+
 class Attention_Sep(nn.Module):
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., num_branch=4):
         super().__init__()
@@ -35,9 +59,8 @@ class Attention_Sep(nn.Module):
         self.num_branch = num_branch
         self.attn_drop = attn_drop
 
-        for i in range(num_branch):
-            setattr(self, f"qkv_{i}", nn.Linear(dim, dim * 3, bias=qkv_bias))
-            setattr(self, f"proj_{i}", nn.Linear(dim, dim))
+        self.qkv = BranchLinear(dim, dim * 3, bias=qkv_bias, num_branch=num_branch)
+        self.proj = BranchLinear(dim, dim, num_branch=num_branch)
         
         self.fuse_q = nn.Linear(dim, dim, bias=qkv_bias)
         self.fuse_kv = nn.Linear(dim, dim * 2, bias=qkv_bias)
@@ -45,6 +68,11 @@ class Attention_Sep(nn.Module):
 
         self.proj_drop = nn.Dropout(proj_drop)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_branch_state_dict(state_dict, prefix + "qkv_{}.", prefix + "qkv.", self.num_branch)
+        merge_branch_state_dict(state_dict, prefix + "proj_{}.", prefix + "proj.", self.num_branch)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         B, N, C = x.shape
         spb = (N-1) // self.num_branch
@@ -60,20 +88,21 @@ class Attention_Sep(nn.Module):
 
         
 
-        xs = []
-        for i in range(self.num_branch):
-            qkv = getattr(self, f"qkv_{i}")(torch.cat((cls, x[:, 1+i*spb:1+i*spb+spb, :]), 1)).reshape(B, spb+1, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-            q, k, v = qkv[0], qkv[1], qkv[2]  # [B, num_head, seq_len, dim]
-
-            _x = F.scaled_dot_product_attention(q, k, v, 
-                                                     scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :].reshape(B, (N-1) // self.num_branch, C)
-            
-            xs.append(getattr(self, f"proj_{i}")(_x))
+        # every branch attends over [updated CLS, its own tokens] with its own qkv / proj weights,
+        # batched branch-major over [num_branch, B, 1 + spb, C]
+        xs = torch.cat((cls.unsqueeze(0).expand(self.num_branch, B, 1, C), x[:, 1:].reshape(B, self.num_branch, spb, C).transpose(0, 1)), 2)
+        qkv = self.qkv(xs.reshape(self.num_branch, B * (spb+1), C))
+        qkv = qkv.reshape(self.num_branch * B, spb+1, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]  # [num_branch * B, num_head, seq_len, dim]
+        xs = F.scaled_dot_product_attention(q, k, v, scale=self.scale, dropout_p=self.attn_drop)[:, :, 1:, :]
+        # same (head-major) flattening of every branch's [num_head, spb, dim] output as before
+        xs = self.proj(xs.reshape(self.num_branch, B * spb, C))
+        xs = xs.reshape(self.num_branch, B, spb, C).transpose(0, 1).reshape(B, self.num_branch * spb, C)
 
         cls = self.cls_proj(cls)
 
 
-        x = torch.cat([cls] + xs, 1)
+        x = torch.cat([cls, xs], 1)
         x = self.proj_drop(x)
         return x
 
@@ -145,8 +174,10 @@ class encoder(nn.Module):
         # 1~12 stage
         init_stage = 1
         fin_stage = init_stage + depth
+        self.first_stage = 1
+        self.trans = nn.ModuleList()  # stage i is self.trans[i - self.first_stage]
         for i in range(init_stage, fin_stage):
-            self.add_module('trans_' + str(i),
+            self.trans.append(
                     Block(dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias,
                              qk_scale=qk_scale, drop=drop_rate, attn_drop=attn_drop_rate, drop_path=self.trans_dpr[i-1])
             )
@@ -159,9 +190,9 @@ class encoder(nn.Module):
         self.apply(self._init_weights)
 
     def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
+        if isinstance(m, (nn.Linear, BranchLinear)):
             trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
+            if isinstance(m, (nn.Linear, BranchLinear)) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
         elif isinstance(m, nn.LayerNorm):
             nn.init.constant_(m.bias, 0)
@@ -175,6 +206,10 @@ class encoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "trans_", prefix + "trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -197,8 +232,8 @@ class encoder(nn.Module):
         x_t = self.pos_drop(x_t)
     
         # 1 ~ final 
-        for i in range(1, 13):
-            x_t = eval('self.trans_' + str(i))(x_t)
+        for block in self.trans:
+            x_t = block(x_t)
 
 
 
@@ -233,8 +268,10 @@ class decoder(nn.Module):
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         
+        self.first_stage = 1
+        self.trans = nn.ModuleList()  # stage i is self.trans[i - self.first_stage]
         for i in range(1, 1+depth):
-            self.add_module('trans_' + str(i),
+            self.trans.append(
                     Block(dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias,
                              qk_scale=qk_scale, drop=drop_rate, attn_drop=attn_drop_rate, drop_path=self.trans_dpr[i-1])
             )
@@ -254,9 +291,9 @@ class decoder(nn.Module):
 
 
     def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
+        if isinstance(m, (nn.Linear, BranchLinear)):
             trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
+            if isinstance(m, (nn.Linear, BranchLinear)) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
         elif isinstance(m, nn.LayerNorm):
             nn.init.constant_(m.bias, 0)
@@ -270,6 +307,10 @@ class decoder(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_stage_state_dict(state_dict, prefix + "trans_", prefix + "trans", self.first_stage)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
@@ -283,8 +324,8 @@ class decoder(nn.Module):
 
 
         # 1 ~ final 
-        for i in range(1, 13):
-            x = eval('self.trans_' + str(i))(x)
+        for block in self.trans:
+            x = block(x)
         x = self.decoder_norm(x)
 
         
@@ -332,7 +373,7 @@ class auto_encoder_vit_split(nn.Module):
 
     def __init__(self, patch_size=16, in_chans=3, decode_embed=384,
                  embed_dim=768, depth=12, num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, use_vae=True, **kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., im_size=224, use_vae=True, use_decoder=True, **kwargs):
         
         super().__init__()
         
@@ -340,10 +381,14 @@ class auto_encoder_vit_split(nn.Module):
                                embed_dim=embed_dim, depth=depth, 
                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
                                attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size, use_vae=use_vae)
-        self.decoder = decoder(patch_size=patch_size, 
-                              embed_dim=decode_embed, depth=depth, 
-                               num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
-                               attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size)
+        self.decoder = None
+        if use_decoder:
+            self.decoder = decoder(patch_size=patch_size, 
+                                  embed_dim=decode_embed, depth=depth, 
+                                   num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, 
+                                   attn_drop_rate=attn_drop_rate, drop_path_rate=drop_path_rate, im_size=im_size)
+        # the encoder has one patch embedding per scale
+        self.num_branch = 4
 
     def sample(self, mu, log_var):
         if log_var is not None:
@@ -355,6 +400,14 @@ class auto_encoder_vit_split(nn.Module):
         return z
 
 
+    def encode(self, x):
+        """
+        Latent mean of x without running the decoder (what extract.py keeps as the embedding).
+        """
+        mu, _ = self.encoder(x)
+        return mu
+
+
     def forward(self, x):
         mu, var  = self.encoder(x)
         latent = self.sample(mu, var)
@@ -0,0 +1,87 @@
+"""
+Pack a gs2 tree into shards read by data.gs2_shard_dataset.
+
+Every glitch becomes one uint8 record of shape [num_scale, 3, H, W] holding all of its scales,
+appended to shard_XXXXX.bin files. index.pkl maps each record to (fname, shard, offset, shape),
+where fname is the _0.5 path gs2_dataset would have returned.
+
+With --im-size 0 the planes are stored at their native resolution and the dataset reproduces
+gs2_dataset exactly. A positive --im-size pre-resizes the planes in uint8, which makes the shards
+much smaller but only matches gs2_dataset up to the uint8 rounding of the resize.
+"""
+import argparse
+import os
+import pickle
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('gs2 shard packing script', add_help=False)
+    parser.add_argument('--data-path', required=True, type=str, help='gs2 tree to pack')
+    parser.add_argument('--output-dir', required=True, type=str, help='where to write shards and index.pkl')
+    parser.add_argument('--scale', default=["0.5", "1.0", "2.0", "4.0"], nargs='+', type=str,
+                        help='scales stored in every record')
+    parser.add_argument('--im-size', default=0, type=int,
+                        help='pre-resize planes to this size, 0 keeps the native resolution')
+    parser.add_argument('--shard-size', default=1024, type=int, help='approximate shard size in MB')
+    parser.add_argument('--num_workers', default=8, type=int)
+    return parser
+
+
+def load_record(fname, scale, im_size):
+    resize = transforms.Resize(im_size, antialias=True) if im_size > 0 else None
+    planes = []
+    for s in scale:
+        im = np.asarray(Image.open(fname.replace("_0.5.png", f"_{s}.png")).convert("RGB"))
+        im = torch.from_numpy(im).permute(2, 0, 1).contiguous()
+        if resize is not None:
+            im = resize(im)
+        planes.append(im)
+    if any(p.shape != planes[0].shape for p in planes):
+        raise ValueError(f"scales of {fname} have different sizes: {[tuple(p.shape) for p in planes]}")
+    return fname, torch.stack(planes, 0).numpy()
+
+
+def _load_record(job):
+    return load_record(*job)
+
+
+def main(args):
+    fnames = sorted(os.path.join(root, fname) for root, _, fnames in os.walk(args.data_path) for fname in fnames if "0.5" in fname)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    shard_bytes = args.shard_size * 1024 * 1024
+    records = []
+    shard, offset = 0, 0
+    fh = open(os.path.join(args.output_dir, f"shard_{shard:05d}.bin"), "wb")
+    with Pool(args.num_workers) as pool:
+        jobs = ((fname, args.scale, args.im_size) for fname in fnames)
+        for i, (fname, record) in enumerate(pool.imap(_load_record, jobs, chunksize=16)):
+            if offset > 0 and offset + record.nbytes > shard_bytes:
+                fh.close()
+                shard, offset = shard + 1, 0
+                fh = open(os.path.join(args.output_dir, f"shard_{shard:05d}.bin"), "wb")
+            fh.write(record.tobytes())
+            records.append((fname, shard, offset, record.shape))
+            offset += record.nbytes
+            if i % 1000 == 0:
+                print(f"[{i}/{len(fnames)}] shard {shard}")
+    fh.close()
+
+    # write the index last so a crashed run never leaves a readable but partial dataset
+    index_path = os.path.join(args.output_dir, "index.pkl")
+    with open(index_path + ".tmp", "wb") as fh:
+        pickle.dump(dict(scale=args.scale, im_size=args.im_size, records=records), fh)
+    os.replace(index_path + ".tmp", index_path)
+    print(f"packed {len(records)} glitches into {shard + 1} shards")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('gs2 shard packing script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,164 @@
+"""
+Crop, resize and split the raw Gravity Spy scales in one pass (replaces process_data.py and split.py).
+
+Reads <src>/sub_<scale>/<class>/<name>_<scale>.png and writes
+<dst>/{train,val,test}/sub_<scale>/<class>/<name>_<scale>.png across a process pool. Outputs that
+already exist and are newer than their source are skipped, so an interrupted run can simply be
+restarted. Every output is written to a temporary file and renamed, so a crash never leaves a
+truncated png behind. With --no-transform the files are hard-linked (or reflinked / copied, see
+--link) instead of being re-encoded.
+
+The split assignment is read from --split-file when it exists, otherwise a stratified random split
+is drawn. The full split assignment is written atomically to --split-out at the end, failed glitches
+included, so a rerun retries them; the failures are listed and the run exits non-zero.
+"""
+import argparse
+import fcntl
+import os
+import pickle
+import random
+import shutil
+import sys
+from multiprocessing import Pool
+
+import cv2
+
+
+FICLONE = 0x40049409
+SPLITS = ["train", "val", "test"]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Gravity Spy preprocessing script', add_help=False)
+    parser.add_argument('--src', default='../gravityspy/raw/', type=str, help='raw tree with sub_<scale>/<class>/ dirs')
+    parser.add_argument('--dst', default='../gravityspy/', type=str, help='root of the train/val/test output')
+    parser.add_argument('--scale', default=["0.5", "1.0", "2.0", "4.0"], nargs='+', type=str)
+    parser.add_argument('--crop', default=[61, 540, 101, 674], nargs=4, type=int, metavar=('Y0', 'Y1', 'X0', 'X1'),
+                        help='crop box applied before resizing')
+    parser.add_argument('--resize', default=512, type=int, help='output size after cropping')
+    parser.add_argument('--no-transform', action='store_true', default=False,
+                        help='only split: link or copy the source files without cropping / resizing')
+    parser.add_argument('--link', default='hard', choices=['hard', 'reflink', 'copy'], type=str,
+                        help='how files are placed with --no-transform, falls back to copy if unsupported')
+    parser.add_argument('--split-file', default='fnames.pkl', type=str,
+                        help='existing split assignment, a new one is drawn if the file does not exist')
+    parser.add_argument('--split-out', default='fnames.pkl', type=str, help='where to write the final split manifest')
+    parser.add_argument('--val-ratio', default=0.1, type=float)
+    parser.add_argument('--test-ratio', default=0.2, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--num_workers', default=16, type=int)
+    return parser
+
+
+def draw_split(src, scale, val_ratio, test_ratio, seed):
+    rng = random.Random(seed)
+    split = {f"{s}_fnames": {} for s in SPLITS}
+    ref = os.path.join(src, f"sub_{scale}")
+    for c in sorted(os.listdir(ref)):
+        fnames = sorted(os.listdir(os.path.join(ref, c)))
+        rng.shuffle(fnames)
+        n_val, n_test = int(len(fnames) * val_ratio), int(len(fnames) * test_ratio)
+        split["val_fnames"][c] = fnames[:n_val]
+        split["test_fnames"][c] = fnames[n_val:n_val + n_test]
+        split["train_fnames"][c] = fnames[n_val + n_test:]
+    return split
+
+
+def is_done(src, dst):
+    return os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+
+def place(src, dst, link):
+    tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.tmp")
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        if link == 'hard':
+            os.link(src, tmp)
+        elif link == 'reflink':
+            with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        else:
+            shutil.copy2(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def transform(src, dst, crop, size):
+    im = cv2.imread(src)
+    if im is None:
+        raise IOError(f"could not read {src}")
+    y0, y1, x0, x1 = crop
+    im = cv2.resize(im[y0:y1, x0:x1, :], (size, size))
+    ok, buf = cv2.imencode(".png", im)
+    if not ok:
+        raise IOError(f"could not encode {dst}")
+    tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.tmp")
+    with open(tmp, "wb") as fh:
+        fh.write(buf.tobytes())
+    os.replace(tmp, dst)
+
+
+def process_glitch(job):
+    split, c, fname, args = job
+    done = 0
+    try:
+        for scale in args.scale:
+            name = fname.replace(f"_{args.scale[0]}", f"_{scale}")
+            src = os.path.join(args.src, f"sub_{scale}", c, name)
+            dst = os.path.join(args.dst, split, f"sub_{scale}", c, name)
+            if is_done(src, dst):
+                continue
+            if args.no_transform:
+                place(src, dst, args.link)
+            else:
+                transform(src, dst, args.crop, args.resize)
+            done += 1
+    except (IOError, OSError, cv2.error) as e:
+        # a corrupt png makes cv2 raise; record the glitch as failed instead of killing the worker
+        return split, c, fname, done, str(e)
+    return split, c, fname, done, None
+
+
+def main(args):
+    if os.path.exists(args.split_file):
+        with open(args.split_file, "rb") as fh:
+            split = pickle.load(fh)
+    else:
+        split = draw_split(args.src, args.scale[0], args.val_ratio, args.test_ratio, args.seed)
+
+    for s in SPLITS:
+        for c in split[f"{s}_fnames"]:
+            for scale in args.scale:
+                os.makedirs(os.path.join(args.dst, s, f"sub_{scale}", c), exist_ok=True)
+
+    jobs = [(s, c, fname, args) for s in SPLITS for c, fnames in split[f"{s}_fnames"].items() for fname in fnames]
+    written, failed = 0, []
+    with Pool(args.num_workers) as pool:
+        for i, (s, c, fname, done, err) in enumerate(pool.imap_unordered(process_glitch, jobs, chunksize=64)):
+            written += done
+            if err is not None:
+                failed.append((os.path.join(s, c, fname), err))
+            if i % 1000 == 0:
+                print(f"[{i}/{len(jobs)}] written: {written} failed: {len(failed)}")
+
+    for s in SPLITS:
+        for c in split[f"{s}_fnames"]:
+            print(f"{s}: {c} {len(split[f'{s}_fnames'][c])}")
+
+    tmp = args.split_out + ".tmp"
+    with open(tmp, "wb") as fh:
+        pickle.dump(split, fh)
+    os.replace(tmp, args.split_out)
+    print(f"{len(jobs) - len(failed)} glitches done, {written} files written, {len(failed)} failed")
+    if failed:
+        for fname, err in sorted(failed):
+            print(f"failed {fname}: {err}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Gravity Spy preprocessing script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,154 @@
+"""
+Decoded-sample cache in named shared memory, shared by every DataLoader worker and every rank
+on a node.
+"""
+import fcntl
+import hashlib
+import os
+import tempfile
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch.distributed as dist
+
+import utils
+
+
+class SharedSampleCache(object):
+    """
+    Fixed-size slots holding the raw uint8 planes of one glitch each, with LRU eviction once the
+    byte budget is used up. The local rank 0 process creates the segment (create=True) and every
+    other process on the node attaches to it by name; forked or spawned DataLoader workers
+    re-attach on unpickling. A lock file serializes lookups and inserts between processes.
+
+    Samples whose shape differs from sample_shape are simply not cached.
+    """
+
+    def __init__(self, name, budget, sample_shape, create=False):
+        self.name = name
+        self.budget = budget
+        self.sample_shape = tuple(sample_shape)
+        self.slot_bytes = int(np.prod(self.sample_shape))
+        self.num_slots = budget // self.slot_bytes
+        if self.num_slots == 0:
+            raise ValueError(f"cache budget of {budget} bytes is smaller than one sample ({self.slot_bytes} bytes)")
+        self.create = create
+        self._attach()
+
+    def _attach(self):
+        size = 8 * (4 + 2 * self.num_slots) + self.num_slots * self.slot_bytes
+        if self.create:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+            except FileExistsError:
+                # left behind by a run that was killed
+                stale = shared_memory.SharedMemory(name=self.name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name, track=False)
+            except TypeError:
+                # python < 3.13 registers attached segments too and would unlink them on exit
+                from multiprocessing import resource_tracker
+                register = resource_tracker.register
+                resource_tracker.register = lambda *args, **kwargs: None
+                try:
+                    self.shm = shared_memory.SharedMemory(name=self.name)
+                finally:
+                    resource_tracker.register = register
+        buf = self.shm.buf
+        # [clock, hits, misses, evictions]
+        self.counters = np.ndarray((4,), dtype=np.int64, buffer=buf)
+        self.keys = np.ndarray((self.num_slots,), dtype=np.int64, buffer=buf, offset=8 * 4)
+        self.last_used = np.ndarray((self.num_slots,), dtype=np.int64, buffer=buf, offset=8 * (4 + self.num_slots))
+        self.data = np.ndarray((self.num_slots,) + self.sample_shape, dtype=np.uint8, buffer=buf,
+                               offset=8 * (4 + 2 * self.num_slots))
+        if self.create:
+            self.counters[:] = 0
+            self.keys[:] = 0
+            self.last_used[:] = 0
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"{self.name}.lock")
+        self._lock_fh = None
+        self._pid = None
+
+    def __getstate__(self):
+        return dict(name=self.name, budget=self.budget, sample_shape=self.sample_shape)
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["budget"], state["sample_shape"], create=False)
+
+    def _lock(self):
+        # flock on a descriptor inherited through fork would not exclude the parent, so every
+        # process opens its own
+        if self._pid != os.getpid():
+            self._lock_fh = open(self._lock_path, "a")
+            self._pid = os.getpid()
+        return self._lock_fh
+
+    @staticmethod
+    def key(glitch_id):
+        h = int.from_bytes(hashlib.blake2b(glitch_id.encode(), digest_size=8).digest(), "little") >> 1
+        return h or 1
+
+    def get(self, glitch_id):
+        key = self.key(glitch_id)
+        fh = self._lock()
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            self.counters[0] += 1
+            slot = np.flatnonzero(self.keys == key)
+            if len(slot) == 0:
+                self.counters[2] += 1
+                return None
+            self.counters[1] += 1
+            self.last_used[slot[0]] = self.counters[0]
+            return self.data[slot[0]].copy()
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def put(self, glitch_id, planes):
+        if planes.shape != self.sample_shape or planes.dtype != np.uint8:
+            return
+        key = self.key(glitch_id)
+        fh = self._lock()
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            if (self.keys == key).any():
+                return
+            self.counters[0] += 1
+            slot = int(np.argmin(self.last_used))
+            if self.keys[slot] != 0:
+                self.counters[3] += 1
+            self.data[slot] = planes
+            self.keys[slot] = key
+            self.last_used[slot] = self.counters[0]
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def stats(self):
+        hits, misses, evictions = (int(c) for c in self.counters[1:])
+        return dict(hit_rate=hits / max(hits + misses, 1), fill=float((self.keys != 0).mean()),
+                    hits=hits, misses=misses, evictions=evictions)
+
+    def close(self):
+        self.shm.close()
+        if self.create:
+            self.shm.unlink()
+            if os.path.exists(self._lock_path):
+                os.remove(self._lock_path)
+
+
+def build_cache(name, budget, sample_shape):
+    """
+    Local rank 0 creates the segment, the other ranks of the node attach once it exists.
+    """
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if local_rank == 0:
+        cache = SharedSampleCache(name, budget, sample_shape, create=True)
+    if utils.is_dist_avail_and_initialized():
+        dist.barrier()
+    if local_rank != 0:
+        cache = SharedSampleCache(name, budget, sample_shape)
+    return cache
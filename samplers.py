@@ -55,3 +55,70 @@ class RASampler(torch.utils.data.Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+class ShardedSampler(torch.utils.data.Sampler):
+    """Deterministic DistributedSampler replacement that can resume in the middle of an epoch.
+    The permutation only depends on (seed, epoch), so every rank draws the same one and takes
+    its own strided slice of it; the DataLoader then hands consecutive batches of that slice to
+    its workers. state_dict() records how many samples of the epoch have been consumed over all
+    ranks, so a run resumed with a different number of ranks still neither replays nor skips
+    data (up to the padding of the last round).
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        # samples of the current epoch already consumed per rank, set by load_state_dict
+        self.start = 0
+        if self.drop_last:
+            self.num_samples = len(self.dataset) // self.num_replicas
+        else:
+            self.num_samples = int(math.ceil(len(self.dataset) / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+    def indices(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+
+        if self.drop_last:
+            indices = indices[:self.total_size]
+        else:
+            indices += (indices * math.ceil(self.total_size / len(indices)))[:self.total_size - len(indices)]
+        assert len(indices) == self.total_size
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.indices()[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def set_epoch(self, epoch):
+        # a resumed epoch starts at self.start, every later one from the beginning
+        if epoch != self.epoch:
+            self.start = 0
+        self.epoch = epoch
+
+    def state_dict(self, consumed=0):
+        """consumed: samples of this epoch the calling rank has trained on since set_epoch."""
+        return {"seed": self.seed, "epoch": self.epoch,
+                "consumed": (self.start + consumed) * self.num_replicas}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.start = min(state["consumed"] // self.num_replicas, self.num_samples)
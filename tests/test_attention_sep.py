@@ -0,0 +1,20 @@
+import pytest
+import torch
+
+from benchmark_attention import share_loop, split_loop
+from model import multi_cnn_attn_conformer_share, multi_cnn_attn_conformer_split, vit_share, vit_split
+
+VARIANTS = [(multi_cnn_attn_conformer_share, share_loop), (vit_share, share_loop),
+            (multi_cnn_attn_conformer_split, split_loop), (vit_split, split_loop)]
+
+
+@pytest.mark.parametrize("num_branch", [1, 4])
+@pytest.mark.parametrize("module,loop", VARIANTS, ids=lambda v: getattr(v, "__name__", "").split(".")[-1])
+def test_batched_matches_loop(module, loop, num_branch):
+    torch.manual_seed(0)
+    attn = module.Attention_Sep(32, num_heads=4, qkv_bias=True, num_branch=num_branch).eval()
+    x = torch.randn(3, 1 + num_branch * 10, 32)
+    with torch.no_grad():
+        out, expected = attn(x), loop(attn, x)
+    assert out.shape == expected.shape == x.shape
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,148 @@
+import copy
+
+import pytest
+import torch
+
+from model import conformer
+from model import multi_branch_conformer, multi_cnn_attn_conformer_share, multi_cnn_attn_conformer_split, \
+    multi_cnn_attn_encoder_cnn_decoder
+
+NUM_BRANCH = 4
+MODULES = [multi_branch_conformer, multi_cnn_attn_conformer_share, multi_cnn_attn_conformer_split,
+           multi_cnn_attn_encoder_cnn_decoder]
+
+
+def old_state_dict(refs, per_branch_prefix):
+    """ the pre-fusion checkpoint layout, built from one single-branch reference layer per branch
+    """
+    state_dict = {}
+    for i, ref in enumerate(refs):
+        for k, v in ref.state_dict().items():
+            state_dict[per_branch_prefix(k, i)] = v.clone()
+    return state_dict
+
+
+def conv_prefix(k, i):
+    return "conv_{}.{}".format(i, k)
+
+
+def fcu_prefix(k, i):
+    name, rest = k.split(".", 1)
+    return "{}_{}.{}".format(name, i, rest)
+
+
+def randomize(refs):
+    torch.manual_seed(1)
+    for ref in refs:
+        for m in ref.modules():
+            if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 1.5)
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+            elif isinstance(m, torch.nn.LayerNorm):
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+
+
+def load_fused(fused, refs, per_branch_prefix):
+    randomize(refs)
+    fused.load_state_dict(old_state_dict(refs, per_branch_prefix))
+
+
+def check(fused, refs, per_branch_prefix, run_fused, run_refs):
+    for training in (True, False):
+        fused.train(training)
+        for ref in refs:
+            ref.train(training)
+        with torch.no_grad():
+            out, expected = run_fused(), run_refs()
+        if not isinstance(out, tuple):
+            out, expected = (out,), (expected,)
+        for o, e in zip(out, expected):
+            assert o.shape == e.shape
+            torch.testing.assert_close(o, e, rtol=1e-4, atol=1e-5)
+
+    # the training pass moved the running stats, they must still round-trip through the hook
+    expected = copy.deepcopy(fused)
+    expected.load_state_dict(old_state_dict(refs, per_branch_prefix))
+    for k, v in expected.state_dict().items():
+        torch.testing.assert_close(fused.state_dict()[k], v, rtol=1e-4, atol=1e-6)
+
+
+def branch(x, i, n=NUM_BRANCH):
+    c = x.shape[1] // n
+    return x[:, c * i:c * (i + 1)]
+
+
+@pytest.mark.parametrize("module", MODULES, ids=lambda m: m.__name__.split(".")[-1])
+@pytest.mark.parametrize("block,inplanes,stride,res_conv", [("ConvBlock", 8, 2, True), ("ConvBlock", 16, 1, False),
+                                                            ("ConvBlockDecode", 8, 2, True)])
+def test_conv_block(module, block, inplanes, stride, res_conv):
+    outplanes = 16
+    refs = [getattr(conformer, block)(inplanes, outplanes, stride=stride, res_conv=res_conv) for _ in range(NUM_BRANCH)]
+    fused = getattr(module, block)(inplanes, outplanes, stride=stride, res_conv=res_conv, num_branch=NUM_BRANCH)
+    load_fused(fused, refs, conv_prefix)
+
+    torch.manual_seed(0)
+    x = torch.randn(2, inplanes * NUM_BRANCH, 8, 8)
+    x_t = torch.randn(2, outplanes // 4 * NUM_BRANCH, 8, 8)
+
+    def run_refs():
+        outs = [ref(branch(x, i), branch(x_t, i)) for i, ref in enumerate(refs)]
+        return tuple(torch.cat(o, dim=1) for o in zip(*outs))
+
+    check(fused, refs, conv_prefix, lambda: fused(x, x_t), run_refs)
+
+
+@pytest.mark.parametrize("module", MODULES, ids=lambda m: m.__name__.split(".")[-1])
+def test_med_conv_block(module):
+    inplanes = 16
+    refs = [conformer.Med_ConvBlock(inplanes) for _ in range(NUM_BRANCH)]
+    fused = module.Med_ConvBlock(inplanes, num_branch=NUM_BRANCH)
+    load_fused(fused, refs, conv_prefix)
+
+    torch.manual_seed(0)
+    x = torch.randn(2, inplanes * NUM_BRANCH, 8, 8)
+
+    check(fused, refs, conv_prefix, lambda: fused(x),
+          lambda: torch.cat([ref(branch(x, i)) for i, ref in enumerate(refs)], dim=1))
+
+
+@pytest.mark.parametrize("module", MODULES, ids=lambda m: m.__name__.split(".")[-1])
+def test_fcu_down(module):
+    inplanes, outplanes, dw_stride = 8, 12, 4
+    refs = [conformer.FCUDown(inplanes, outplanes, dw_stride) for _ in range(NUM_BRANCH)]
+    fused = module.FCUDown(inplanes, outplanes, dw_stride, num_branch=NUM_BRANCH)
+    load_fused(fused, refs, fcu_prefix)
+
+    torch.manual_seed(0)
+    x = torch.randn(2, inplanes * NUM_BRANCH, 16, 16)
+    x_t = torch.randn(2, 1 + NUM_BRANCH * 16, outplanes)
+
+    def run_refs():
+        # every old branch prepended the cls token, the fused module keeps it once in front
+        tokens = [ref(branch(x, i), x_t)[:, 1:] for i, ref in enumerate(refs)]
+        return torch.cat([x_t[:, :1]] + tokens, dim=1)
+
+    check(fused, refs, fcu_prefix, lambda: fused(x, x_t), run_refs)
+
+
+@pytest.mark.parametrize("module", MODULES, ids=lambda m: m.__name__.split(".")[-1])
+def test_fcu_up(module):
+    inplanes, outplanes, up_stride, H, W = 12, 8, 4, 4, 4
+    refs = [conformer.FCUUp(inplanes, outplanes, up_stride) for _ in range(NUM_BRANCH)]
+    fused = module.FCUUp(inplanes, outplanes, up_stride, num_branch=NUM_BRANCH)
+    load_fused(fused, refs, fcu_prefix)
+
+    torch.manual_seed(0)
+    x = torch.randn(2, 1 + NUM_BRANCH * H * W, inplanes)
+
+    def run_refs():
+        outs = []
+        for i, ref in enumerate(refs):
+            tokens = x[:, 1 + i * H * W:1 + (i + 1) * H * W]
+            outs.append(ref(torch.cat([x[:, :1], tokens], dim=1), H, W))
+        return torch.cat(outs, dim=1)
+
+    check(fused, refs, fcu_prefix, lambda: fused(x, H, W), run_refs)
@@ -0,0 +1,43 @@
+"""
+Activation checkpointed conv_trans stages against the plain forward: same outputs, gradients and
+BatchNorm running stats (the recomputation must not update them a second time).
+"""
+import copy
+
+import pytest
+import torch
+from timm.models import create_model
+
+import models
+from model.conformer_no_communicate import auto_encoder_no_comm
+
+
+def build(name):
+    torch.manual_seed(0)
+    if name == 'no_comm':
+        # small no-comm model; cnn_nofuse_attn is too slow for a CPU test
+        return auto_encoder_no_comm(patch_size=16, channel_ratio=1, embed_dim=64, decode_embed=32, depth=12, num_heads=2,
+                                    mlp_ratio=2, qkv_bias=True, im_size=64, first_up=2, num_branch=4)
+    return create_model(name, pretrained=False)
+
+
+@pytest.mark.parametrize('name', ['cnn_share_attn', 'cnn_split_attn', 'no_comm'])
+def test_checkpointed_stages_match(name):
+    ref = build(name).train()
+    ckpt = copy.deepcopy(ref)
+    ckpt.set_grad_checkpointing(range(2, 13), range(0, 13))
+    x = torch.randn(2, 12, 64, 64)
+
+    outs = []
+    for model in (ref, ckpt):
+        torch.manual_seed(1)
+        out = model(x)[0]
+        out.square().mean().backward()
+        outs.append(out)
+
+    assert torch.equal(outs[0], outs[1])
+    for p, q in zip(ref.parameters(), ckpt.parameters()):
+        if p.grad is not None:
+            assert torch.equal(p.grad, q.grad)
+    for (key, a), b in zip(ref.named_buffers(), ckpt.buffers()):
+        assert torch.equal(a, b), key
@@ -0,0 +1,29 @@
+"""
+The share/split autoencoders at input sizes other than the im_size they were built for
+(--progressive-sizes): any multiple of 16 reconstructs at the input's size.
+"""
+import pytest
+import torch
+from timm.models import create_model
+
+import models
+
+
+@pytest.mark.parametrize('size', [112, 160])
+@pytest.mark.parametrize('name', ['cnn_share_attn', 'cnn_split_attn'])
+def test_forward_at_size(name, size):
+    torch.manual_seed(0)
+    model = create_model(name, pretrained=False).train()
+    x = torch.randn(2, 12, size, size)
+
+    pred, mu, _ = model(x)
+    pred.square().mean().backward()
+
+    assert pred.shape == x.shape
+    assert torch.isfinite(pred).all()
+    assert model.encoder.pos_embed.grad is not None
+    assert model.decoder.pos_embed.grad is not None
+
+    model.eval()
+    with torch.no_grad():
+        assert torch.equal(model.encode(x), model.encode(x))
@@ -5,6 +5,9 @@ import time
 import torch
 import torch.backends.cudnn as cudnn
 import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 from pathlib import Path
 
@@ -13,16 +16,19 @@ from timm.models import create_model
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
 from timm.scheduler import create_scheduler
 from timm.optim import create_optimizer
-from timm.utils import NativeScaler, get_state_dict, ModelEma
+from timm.utils import get_state_dict
 
 from datasets import build_dataset
-from engine import train_one_epoch, evaluate
-from samplers import RASampler
+from engine import train_one_epoch, evaluate, reconstruction_error
+from samplers import RASampler, ShardedSampler
 import utils
 import models
 import random
 from torchvision.utils import save_image
-from data import four_scale_dataset, gs2_dataset
+from data import four_scale_dataset, gs2_dataset, batch_transform, four_scale_collate, read_planes
+from manifest import load_manifest
+from ema import ModelEma
+from sample_cache import build_cache
 
 # from fvcore.nn import FlopCountAnalysis
 
@@ -48,6 +54,8 @@ def get_args_parser():
     parser.set_defaults(model_ema=True)
     parser.add_argument('--model-ema-decay', type=float, default=0.99996, help='')
     parser.add_argument('--model-ema-force-cpu', action='store_true', default=False, help='')
+    parser.add_argument('--model-ema-every', type=int, default=1,
+                        help='update the EMA every N optimizer steps, with the decay corrected to decay ** N')
 
     # Optimizer parameters
     parser.add_argument('--opt', default='adamw', type=str, metavar='OPTIMIZER',
@@ -139,6 +147,15 @@ def get_args_parser():
                         help='dataset threshold')
     parser.add_argument('--im-size', default=224, type=int,
                         help='dataset path')
+    parser.add_argument('--scale', default=["0.5", "1.0", "2.0", "4.0"], nargs='+', type=str,
+                        help='scales to load, one per model branch (e.g. --scale 4.0 for single-branch models)')
+    parser.add_argument('--manifest', default='', type=str,
+                        help='cached file index of --data-path, built by rank 0 on first use and refreshed incrementally')
+    parser.add_argument('--cache-size', default=0, type=float,
+                        help='GB of shared memory per node for decoded samples, 0 disables the cache')
+    parser.add_argument('--batch-transform', default='none', choices=['none', 'cpu', 'device'], type=str,
+                        help='threshold and normalize whole batches in the loader workers ("cpu") or on the '
+                             'training device ("device") instead of per sample')
     # * Finetuning params
     parser.add_argument('--finetune', default='', help='finetune from checkpoint')
 
@@ -166,9 +183,55 @@ def get_args_parser():
 
 
     parser.add_argument('--save_freq', default=10, type=int, help='frequency of save')
+    parser.add_argument('--grad-ckpt-encoder', default=None, nargs=2, type=int, metavar=('START', 'END'),
+                        help='recompute encoder conv_trans stages START..END-1 in the backward pass')
+    parser.add_argument('--grad-ckpt-decoder', default=None, nargs=2, type=int, metavar=('START', 'END'),
+                        help='recompute decoder conv_trans stages START..END-1 in the backward pass')
+    parser.add_argument('--accum-iter', default=1, type=int,
+                        help='batches accumulated per optimizer step (effective batch size is batch_size * accum_iter * world size)')
+    parser.add_argument('--ckpt-steps', default=0, type=int,
+                        help='also write checkpoint_last.pth every this many steps (a multiple of --accum-iter), 0 disables it')
+    parser.add_argument('--auto-resume', action='store_true', default=False,
+                        help='resume from output_dir/checkpoint_last.pth when it exists and --resume is not given')
+    parser.add_argument('--progressive-sizes', default=[], nargs='+', type=int,
+                        help='train at these input sizes (multiples of 16) before --im-size, e.g. 112 160')
+    parser.add_argument('--progressive-epochs', default=[], nargs='+', type=int,
+                        help='epoch at which each of --progressive-sizes ends, e.g. 10 20')
+    parser.add_argument('--keep-full-ckpt', default=3, type=int,
+                        help='keep the full training state in the latest N checkpoint_<epoch>.pth only, older ones '
+                             'are reduced to their model weights; 0 keeps every checkpoint in full')
+    parser.add_argument('--ckpt-fp16', action='store_true', default=False,
+                        help='store the reduced (weights-only) checkpoints in fp16')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile the autoencoder and report its forward speedup over eager mode')
+    parser.add_argument('--preview-size', default=16, type=int,
+                        help='training samples reconstructed into <output_dir>/<epoch>.png by rank 0, 0 disables the preview')
+    parser.add_argument('--heldout-path', default='', type=str,
+                        help='gs2 layout directory; rank 0 logs the L1 / L2 reconstruction error of the model and its '
+                             'EMA on --heldout-size samples of it every --save_freq epochs')
+    parser.add_argument('--heldout-size', default=64, type=int,
+                        help='held-out samples cached (fp16, on the CPU) for the reconstruction metric')
     return parser
 
 
+def progressive_size(args, epoch):
+    for size, end in zip(args.progressive_sizes, args.progressive_epochs):
+        if epoch < end:
+            return size
+    return args.im_size
+
+
+def load_samples(dataset, indices, transform):
+    """
+    (thresh_im, im) of dataset[indices] as CPU batches, thresholded and normalized as in training.
+    """
+    samples = [dataset[i] for i in indices]
+    if dataset.raw:
+        thresh_im, im, _ = transform(four_scale_collate()(samples)[0])
+        return thresh_im, im
+    return torch.stack([s[0] for s in samples]), torch.stack([s[1] for s in samples])
+
+
 def main(args):
     utils.init_distributed_mode(args)
 
@@ -180,11 +243,23 @@ def main(args):
     seed = args.seed + utils.get_rank()
     torch.manual_seed(seed)
     np.random.seed(seed)
-    # random.seed(seed)
+    random.seed(seed)
 
     cudnn.benchmark = True
 
-    dataset_train = gs2_dataset(args.data_path, args.threshold, args.im_size)
+    manifest = load_manifest(args.data_path, args.manifest) if args.manifest else None
+    dataset_train = gs2_dataset(args.data_path, args.threshold, args.im_size, raw=args.batch_transform != 'none', manifest=manifest,
+                                scale=args.scale)
+    if args.cache_size > 0:
+        sample_shape = read_planes([dataset_train.fnames[0].replace("_0.5.png", f"_{s}.png") for s in dataset_train.scale]).shape
+        cache_name = f"gs2_cache_{zlib.crc32(os.path.abspath(args.data_path).encode())}"
+        dataset_train.cache = build_cache(cache_name, int(args.cache_size * 1024 ** 3), sample_shape)
+    transform_train = batch_transform(args.threshold, args.im_size)
+    collate_fn = None
+    if args.batch_transform == 'cpu':
+        collate_fn = four_scale_collate(transform_train)
+    elif args.batch_transform == 'device':
+        collate_fn = four_scale_collate()
 
     if True:  # args.distributed:
         num_tasks = utils.get_world_size()
@@ -194,8 +269,9 @@ def main(args):
                 dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
             )
         else:
-            sampler_train = torch.utils.data.DistributedSampler(
-                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
+            # same permutation on every rank whatever the rank's seed, resumable mid-epoch
+            sampler_train = ShardedSampler(
+                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed
             )
     else:
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
@@ -206,6 +282,7 @@ def main(args):
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=True,
+        collate_fn=collate_fn,
     )
 
 
@@ -226,6 +303,22 @@ def main(args):
         drop_path_rate=args.drop_path,
         drop_block_rate=args.drop_block,
     )
+    if len(args.scale) != model.num_branch:
+        raise ValueError(f"{args.model} has {model.num_branch} branch(es) but {len(args.scale)} scales were requested: {args.scale}")
+    if args.ckpt_steps % args.accum_iter:
+        raise ValueError(f"--ckpt-steps {args.ckpt_steps} must be a multiple of --accum-iter {args.accum_iter}")
+    if args.progressive_sizes:
+        if len(args.progressive_sizes) != len(args.progressive_epochs):
+            raise ValueError("--progressive-sizes and --progressive-epochs need the same number of values")
+        if not hasattr(model, "encoder") or not hasattr(model.encoder, "pos_grid"):
+            raise ValueError(f"{args.model} does not support progressive resolution training")
+        if any(size % 16 for size in args.progressive_sizes):
+            raise ValueError(f"--progressive-sizes must be multiples of 16: {args.progressive_sizes}")
+    if args.grad_ckpt_encoder or args.grad_ckpt_decoder:
+        if not hasattr(model, "set_grad_checkpointing"):
+            raise ValueError(f"{args.model} does not support activation checkpointing")
+        model.set_grad_checkpointing(range(*args.grad_ckpt_encoder) if args.grad_ckpt_encoder else (),
+                                     range(*args.grad_ckpt_decoder) if args.grad_ckpt_decoder else ())
 
     if utils.is_main_process():
         if hasattr(model, "encoder"):
@@ -246,26 +339,34 @@ def main(args):
             model,
             decay=args.model_ema_decay,
             device='cpu' if args.model_ema_force_cpu else '',
-            resume='')
+            resume='',
+            update_every=args.model_ema_every)
 
     model_without_ddp = model
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
         model_without_ddp = model.module
+    if args.compile:
+        # checkpoints keep coming from model_without_ddp, so their keys have no _orig_mod. prefix
+        sample = torch.randn(args.batch_size, 3 * len(args.scale), args.im_size, args.im_size, device=device)
+        model = utils.compile_model(model, sample)
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
 
-    linear_scaled_lr = args.lr * args.batch_size * utils.get_world_size() / 512.0
+    linear_scaled_lr = args.lr * args.batch_size * args.accum_iter * utils.get_world_size() / 512.0
     args.lr = linear_scaled_lr
     optimizer = create_optimizer(args, model)
     # optimizer = torch.optim.Adam(model.parameters(), 0.0001)
-    loss_scaler = NativeScaler()
+    loss_scaler = utils.NativeScaler()
 
     lr_scheduler, _ = create_scheduler(args, optimizer)
 
     criterion = torch.nn.MSELoss(reduction="sum")
 
     output_dir = Path(args.output_dir)
+    if not args.resume and args.auto_resume and (output_dir / 'checkpoint_last.pth').exists():
+        args.resume = str(output_dir / 'checkpoint_last.pth')
+    start_step = 0
     if args.resume:
         if args.resume.startswith('https'):
             checkpoint = torch.hub.load_state_dict_from_url(
@@ -283,73 +384,131 @@ def main(args):
             optimizer.load_state_dict(checkpoint['optimizer'])
             lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
             args.start_epoch = checkpoint['epoch'] + 1
+            if checkpoint.get('step') is not None:
+                # written in the middle of an epoch, continue that epoch
+                args.start_epoch = checkpoint['epoch']
+                start_step = checkpoint['step']
+            if 'scaler' in checkpoint:
+                loss_scaler.load_state_dict(checkpoint['scaler'])
+            if 'rng' in checkpoint:
+                utils.set_rng_state(checkpoint['rng'])
             if args.model_ema:
                 utils._load_checkpoint_for_ema(model_ema, checkpoint['model_ema'])
-
-
+            if checkpoint.get('sampler') is not None and isinstance(sampler_train, ShardedSampler):
+                sampler_train.load_state_dict(checkpoint['sampler'])
+
+
+
+    existing = sorted(output_dir.glob('checkpoint_[0-9]*.pth'), key=lambda p: int(p.stem.split('_')[-1])) if args.output_dir else []
+    ckpt_writer = utils.CheckpointWriter(args.keep_full_ckpt, args.ckpt_fp16, existing)
+
+    def save_last(epoch, step=None):
+        # small enough to write every few hundred steps: no preview, no log entry
+        rng = utils.get_rng_state()
+        first_step = start_step if epoch == args.start_epoch else 0
+        consumed = (step - first_step) * args.batch_size if step is not None else len(sampler_train)
+        ckpt_writer.save({
+            'model': model_without_ddp.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'scaler': loss_scaler.state_dict(),
+            'epoch': epoch,
+            'step': step,
+            'model_ema': get_state_dict(model_ema),
+            'sampler': sampler_train.state_dict(consumed) if isinstance(sampler_train, ShardedSampler) else None,
+            'rng': rng,
+            'args': args,
+        }, output_dir / 'checkpoint_last.pth')
+
+    # the preview batch and held-out set are decoded once, by rank 0 only; the other ranks never
+    # leave the training loop for them
+    preview = heldout = image_writer = last_image = None
+    if args.output_dir and utils.is_main_process():
+        rng = random.Random(args.seed)
+        if args.preview_size > 0:
+            preview = load_samples(dataset_train, rng.sample(range(len(dataset_train)), min(args.preview_size, len(dataset_train))),
+                                   transform_train)
+        if args.heldout_path:
+            dataset_heldout = gs2_dataset(args.heldout_path, args.threshold, args.im_size, scale=args.scale)
+            heldout, _ = load_samples(dataset_heldout, rng.sample(range(len(dataset_heldout)), min(args.heldout_size, len(dataset_heldout))),
+                                      transform_train)
+            heldout = heldout.half()
+        image_writer = ThreadPoolExecutor(max_workers=1)
 
     print("Start training")
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            data_loader_train.sampler.set_epoch(epoch)
+        data_loader_train.sampler.set_epoch(epoch)
 
 
         train_stats = train_one_epoch(
             model, criterion, data_loader_train,
             optimizer, device, epoch, loss_scaler,
             args.clip_grad, model_ema, mixup_fn,
-            set_training_mode=args.finetune == ''  # keep in eval mode during finetuning
+            set_training_mode=args.finetune == '',  # keep in eval mode during finetuning
+            batch_transform=transform_train if args.batch_transform == 'device' else None,
+            start_step=start_step if epoch == args.start_epoch else 0,
+            checkpoint_freq=args.ckpt_steps if args.output_dir else 0,
+            checkpoint_fn=lambda step: save_last(epoch, step),
+            accum_iter=args.accum_iter,
+            im_size=progressive_size(args, epoch) if args.progressive_sizes else None,
         )
 
         lr_scheduler.step(epoch)
+        if args.output_dir and args.ckpt_steps > 0:
+            save_last(epoch)
 
         if epoch % args.save_freq == 0:
-
-
             log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                             'epoch': epoch,
                             'n_parameters': n_parameters}
 
-
-            model.eval()
-            test_samples = random.sample(range(len(dataset_train)), 16)
-            with torch.no_grad():
-
-
-
-
-                im = torch.cat([dataset_train[i][1].unsqueeze(0) for i in test_samples], dim=0).to(global_rank)
-                N, C, H, W = im.shape
-                thresh_im = torch.cat([dataset_train[i][0].unsqueeze(0) for i in test_samples], dim=0).to(global_rank)
-                pred, _, _ = model(thresh_im)
-                im = torch.cat([im[:, 3*i : 3*(i+1), ...] for i in range(C // 3)], 0)
-                thresh_im = torch.cat([thresh_im[:, 3*i : 3*(i+1), ...] for i in range(C // 3)], 0)
-                pred = torch.cat([pred[:, 3*i : 3*(i+1), ...] for i in range(C // 3)], 0)
-                
-
-                res = torch.cat([im, thresh_im, pred], dim=0) if args.threshold > 0 else torch.cat([thresh_im, pred], dim=0)
-            model.train()
-
-
-
-
+            # model_without_ddp: a forward through DDP on rank 0 alone would wait on the other ranks
+            if args.output_dir and utils.is_main_process():
+                model_without_ddp.eval()
+                if preview is not None:
+                    with torch.no_grad():
+                        thresh_im, im = preview
+                        pred = model_without_ddp(thresh_im.to(device))[0].cpu()
+                    C = im.shape[1]
+                    im = torch.cat([im[:, 3*i : 3*(i+1), ...] for i in range(C // 3)], 0)
+                    thresh_im = torch.cat([thresh_im[:, 3*i : 3*(i+1), ...] for i in range(C // 3)], 0)
+                    pred = torch.cat([pred[:, 3*i : 3*(i+1), ...] for i in range(C // 3)], 0)
+                    res = torch.cat([im, thresh_im, pred], dim=0) if args.threshold > 0 else torch.cat([thresh_im, pred], dim=0)
+                    if last_image is not None:
+                        last_image.result()  # re-raises a failed write
+                    last_image = image_writer.submit(save_image, res, f"{args.output_dir}/{epoch}.png", nrow=len(preview[0]),
+                                                     normalize=True, value_range=(-1, 1))
+                if heldout is not None:
+                    log_stats['heldout_l1'], log_stats['heldout_l2'] = reconstruction_error(model_without_ddp, heldout, args.batch_size)
+                    if model_ema is not None:
+                        log_stats['heldout_ema_l1'], log_stats['heldout_ema_l2'] = reconstruction_error(model_ema.averaged(), heldout,
+                                                                                                        args.batch_size)
+                model_without_ddp.train()
 
             if args.output_dir and utils.is_main_process():
                 with (output_dir / "log.txt").open("a") as f:
                     f.write(json.dumps(log_stats) + "\n")
-                save_image(res, f"{args.output_dir}/{epoch}.png", nrow=len(test_samples), normalize=True, value_range=(-1, 1))
                 if args.output_dir:
                     checkpoint_paths = [output_dir / f'checkpoint_{epoch}.pth']
                     for checkpoint_path in checkpoint_paths:
-                        utils.save_on_master({
+                        ckpt_writer.save({
                             'model': model_without_ddp.state_dict(),
                             'optimizer': optimizer.state_dict(),
                             'lr_scheduler': lr_scheduler.state_dict(),
                             'epoch': epoch,
                             'model_ema': get_state_dict(model_ema),
+                            'sampler': sampler_train.state_dict(len(sampler_train)) if isinstance(sampler_train, ShardedSampler) else None,
                             'args': args,
-                        }, checkpoint_path)
+                        }, checkpoint_path, retain=True)
+
+    ckpt_writer.close()
+    if image_writer is not None:
+        image_writer.shutdown()
+        if last_image is not None:
+            last_image.result()
+    if dataset_train.cache is not None:
+        dataset_train.cache.close()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -5,10 +5,14 @@ Mostly copy-paste from torchvision references.
 """
 import io
 import os
+import queue
+import random
+import threading
 import time
 from collections import defaultdict, deque
 import datetime
 
+import numpy as np
 import torch
 import torch.distributed as dist
 
@@ -79,16 +83,43 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.pending = []
 
     def update(self, **kwargs):
+        """
+        Tensors are not read back right away, which would block the host until the device has
+        caught up: they are queued and materialized together by flush(), in the same order, so
+        the meters end up with exactly the values .item() would have given.
+        """
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
-                v = v.item()
+                self.pending.append((k, v.detach()))
+                continue
             assert isinstance(v, (float, int))
+            if self.pending:
+                self.pending.append((k, v))
+            else:
+                self.meters[k].update(v)
+
+    def flush(self):
+        if not self.pending:
+            return
+        # one device -> host copy per (device, dtype) instead of one sync per value
+        groups = defaultdict(list)
+        for i, (_, v) in enumerate(self.pending):
+            if isinstance(v, torch.Tensor):
+                groups[(v.device, v.dtype)].append(i)
+        values = [v for _, v in self.pending]
+        for idx in groups.values():
+            for i, v in zip(idx, torch.stack([values[i].reshape(()) for i in idx]).tolist()):
+                values[i] = v
+        pending, self.pending = self.pending, []
+        for (k, _), v in zip(pending, values):
             self.meters[k].update(v)
 
     def __getattr__(self, attr):
         if attr in self.meters:
+            self.flush()
             return self.meters[attr]
         if attr in self.__dict__:
             return self.__dict__[attr]
@@ -96,6 +127,7 @@ class MetricLogger(object):
             type(self).__name__, attr))
 
     def __str__(self):
+        self.flush()
         loss_str = []
         for name, meter in self.meters.items():
             loss_str.append(
@@ -104,6 +136,7 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
+        self.flush()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -151,6 +184,7 @@ class MetricLogger(object):
                         time=str(iter_time), data=str(data_time)))
             i += 1
             end = time.time()
+        self.flush()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('{} Total time: {} ({:.4f} s / it)'.format(
@@ -211,6 +245,168 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def save_on_master_atomic(obj, path):
+    """
+    torch.save to a temporary file and rename it, so a preemption while writing never corrupts
+    the previous checkpoint at path.
+    """
+    if is_main_process():
+        path = str(path)
+        torch.save(obj, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+
+class NativeScaler(object):
+    """
+    timm's NativeScaler (same state_dict / load_state_dict) with need_update=False for gradient
+    accumulation: the scaled backward runs, the unscale, clipping, optimizer step and scale
+    update wait for the call that closes the window.
+    """
+    state_dict_key = "amp_scaler"
+
+    def __init__(self):
+        self._scaler = torch.cuda.amp.GradScaler()
+
+    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, need_update=True):
+        self._scaler.scale(loss).backward(create_graph=create_graph)
+        if not need_update:
+            return
+        if clip_grad is not None:
+            assert parameters is not None
+            self._scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
+        self._scaler.step(optimizer)
+        self._scaler.update()
+
+    def state_dict(self):
+        return self._scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self._scaler.load_state_dict(state_dict)
+
+
+def _to_cpu(obj, pin):
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        if obj.device.type == "cpu":
+            return obj.clone()
+        out = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=pin)
+        return out.copy_(obj, non_blocking=pin)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v, pin)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v, pin) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread on the main process. save() only snapshots the
+    tensors to (pinned) CPU memory, the thread then torch.saves to a temporary file and renames
+    it. One write runs and at most one more waits; a further save() blocks until there is room.
+
+    Retention: of the checkpoints saved with retain=True only the latest keep_full keep their full
+    state, older ones are rewritten with just 'model' (optionally fp16), 'epoch' and 'args', which
+    is all extract.py reads. keep_full=0 keeps every checkpoint in full.
+    """
+
+    def __init__(self, keep_full=0, weights_fp16=False, existing=()):
+        self.keep_full = keep_full
+        self.weights_fp16 = weights_fp16
+        # oldest first, e.g. the checkpoints a resumed run finds in its output_dir
+        self.full = [str(path) for path in existing]
+        self.error = None
+        self.jobs = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True) if is_main_process() else None
+        if self.thread is not None:
+            self.thread.start()
+
+    def save(self, obj, path, retain=False):
+        if self.thread is None:
+            return
+        if self.error is not None:
+            raise self.error
+        pin = torch.cuda.is_available()
+        obj = _to_cpu(obj, pin)
+        if pin:
+            # the non_blocking device to host copies have to land before the thread reads them
+            torch.cuda.synchronize()
+        self.jobs.put((obj, str(path), retain))
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is not None:
+                    self._write(*job)
+            except Exception as e:  # re-raised by the next save() / close() on the training thread
+                self.error = e
+            finally:
+                self.jobs.task_done()
+            if job is None:
+                return
+
+    def _write(self, obj, path, retain):
+        torch.save(obj, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        if not retain or self.keep_full <= 0:
+            return
+        if path in self.full:
+            self.full.remove(path)
+        self.full.append(path)
+        while len(self.full) > self.keep_full:
+            old = self.full.pop(0)
+            self._strip(old)
+
+    def _strip(self, path):
+        if not os.path.exists(path):
+            return
+        full = torch.load(path, map_location="cpu")
+        if "optimizer" not in full:
+            return
+        model = full["model"]
+        if self.weights_fp16:
+            model = {k: v.half() if v.is_floating_point() else v for k, v in model.items()}
+        torch.save({"model": model, "epoch": full.get("epoch"), "args": full.get("args")}, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.error is not None:
+                raise self.error
+
+
+def get_rng_state():
+    """
+    RNG states of this process (python, numpy, torch and cuda), gathered from every rank.
+    """
+    state = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state(),
+                 cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+    if not is_dist_avail_and_initialized():
+        return [state]
+    states = [None] * get_world_size()
+    dist.all_gather_object(states, state)
+    return states
+
+
+def set_rng_state(states):
+    """
+    Restores the state saved by get_rng_state for this rank; ranks beyond the saved world
+    size keep their seeded state.
+    """
+    if get_rank() >= len(states):
+        return
+    state = states[get_rank()]
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
@@ -234,3 +430,39 @@ def init_distributed_mode(args):
                                          world_size=args.world_size, rank=args.rank)
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
+
+
+def _time_forward(model, sample, steps):
+    with torch.no_grad():
+        model(sample)
+        if sample.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(steps):
+            model(sample)
+        if sample.is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start) / steps
+
+
+def compile_model(model, sample, steps=5):
+    """
+    torch.compile model and print the eager and compiled forward time on sample. The first
+    compiled call captures the graph and is left out of the timing.
+    """
+    compiled = torch.compile(model)
+    training = model.training
+    model.eval()
+    eager = _time_forward(model, sample, steps)
+    fast = _time_forward(compiled, sample, steps)
+    model.train(training)
+    print(f"torch.compile: eager {eager * 1000:.1f} ms, compiled {fast * 1000:.1f} ms per forward "
+          f"({eager / fast:.2f}x)")
+    return compiled
+
+
+def load_encoder_state_dict(model, state_dict):
+    """
+    Load a full autoencoder checkpoint into a model built with use_decoder=False.
+    """
+    model.load_state_dict({k: v for k, v in state_dict.items() if not k.startswith("decoder")})